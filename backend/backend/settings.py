@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 from decouple import config
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -42,12 +43,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
+    'core.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'core.identity.ClientIdentityMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.ratelimit.RateLimitMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -71,6 +76,16 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backend.wsgi.application'
+ASGI_APPLICATION = 'backend.asgi.application'
+
+# Channel layer for the WebSocket chat transport (core/consumers.py). The
+# in-memory layer only reaches connections of the same process: fine for a
+# single node, use channels_redis to cancel generations across processes
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -143,6 +158,9 @@ CORS_ALLOWED_ORIGINS = config(
 
 CORS_ALLOW_CREDENTIALS = True
 
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key', 'x-chat-client', 'x-request-timeout', 'x-profile', 'if-none-match', 'if-modified-since')
+CORS_EXPOSE_HEADERS = ['x-chat-client', 'retry-after', 'server-timing', 'etag', 'last-modified']
+
 # CSRF settings
 CSRF_TRUSTED_ORIGINS = config(
     'CSRF_TRUSTED_ORIGINS',
@@ -150,10 +168,15 @@ CSRF_TRUSTED_ORIGINS = config(
     cast=lambda v: [s.strip() for s in v.split(',')]
 )
 
-# Session settings
+# Session settings (only used by logged-in users and the admin; anonymous chat
+# clients are identified by a signed token instead, see core/identity.py)
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_COOKIE_AGE = config('SESSION_COOKIE_AGE', default=86400, cast=int)  # 24 hours
-SESSION_SAVE_EVERY_REQUEST = True
+SESSION_SAVE_EVERY_REQUEST = False
+
+# Anonymous chat client identity
+CHAT_CLIENT_COOKIE_NAME = 'chat_client'
+CHAT_CLIENT_TOKEN_MAX_AGE = config('CHAT_CLIENT_TOKEN_MAX_AGE', default=365 * 86400, cast=int)  # seconds, renewed while in use
 
 # REST Framework settings
 REST_FRAMEWORK = {
@@ -223,6 +246,95 @@ os.makedirs(BASE_DIR / 'logs', exist_ok=True)
 
 # Google Gemini AI settings
 GEMINI_API_KEY = config('GEMINI_API_KEY')
+LLM_PROVIDER = config('LLM_PROVIDER', default='gemini')  # 'gemini' or 'fake' (local, for tests/offline dev)
+AI_CONFIG_CHECK_INTERVAL = config('AI_CONFIG_CHECK_INTERVAL', default=5, cast=float)  # seconds between checks for admin changes to AIConfig
+
+# Register the static system prompt with Gemini's context cache and reuse it
+LLM_CONTEXT_CACHE = config('LLM_CONTEXT_CACHE', default=False, cast=bool)  # only pays off for long system prompts
+LLM_CONTEXT_CACHE_TTL = config('LLM_CONTEXT_CACHE_TTL', default=3600, cast=int)  # seconds
+LLM_CONTEXT_CACHE_RETRY = config('LLM_CONTEXT_CACHE_RETRY', default=600, cast=int)  # back-off after a failed registration
+LLM_CONTEXT_CACHE_MIN_TOKENS = config('LLM_CONTEXT_CACHE_MIN_TOKENS', default=4096, cast=int)  # provider minimum; shorter prompts are not registered
+
+# Resilient model calls (see core/resilience.py)
+LLM_DEADLINE = config('LLM_DEADLINE', default=60, cast=float)  # seconds per turn, unless the client asks for less
+LLM_MAX_DEADLINE = config('LLM_MAX_DEADLINE', default=120, cast=float)  # cap on X-Request-Timeout
+LLM_RETRIES = config('LLM_RETRIES', default=2, cast=int)  # for rate limits, 5xx and timeouts only
+LLM_RETRY_BACKOFF = config('LLM_RETRY_BACKOFF', default=0.25, cast=float)  # seconds, doubled per retry, jittered
+LLM_RETRY_MAX_BACKOFF = config('LLM_RETRY_MAX_BACKOFF', default=4.0, cast=float)
+LLM_HEDGE = config('LLM_HEDGE', default=False, cast=bool)  # send a second request when the first is slow
+LLM_HEDGE_PERCENTILE = config('LLM_HEDGE_PERCENTILE', default=95, cast=float)
+LLM_HEDGE_MIN_DELAY = config('LLM_HEDGE_MIN_DELAY', default=1.0, cast=float)  # seconds
+LLM_HEDGE_WORKERS = config('LLM_HEDGE_WORKERS', default=16, cast=int)  # threads racing hedged requests, per process
+LLM_BREAKER_FAILURES = config('LLM_BREAKER_FAILURES', default=5, cast=int)  # consecutive failures that open the circuit
+LLM_BREAKER_COOLDOWN = config('LLM_BREAKER_COOLDOWN', default=30, cast=float)  # seconds before a trial call
+LLM_BREAKER_TRIAL_TIMEOUT = config('LLM_BREAKER_TRIAL_TIMEOUT', default=120, cast=float)  # seconds before a trial that never ended is retried
+LLM_FALLBACK_MODEL = config('LLM_FALLBACK_MODEL', default='')  # used while the configured model's circuit is open
+LLM_FAKE_LATENCY = config('LLM_FAKE_LATENCY', default=0, cast=float)  # fake provider only
+LLM_FAKE_ERROR_RATE = config('LLM_FAKE_ERROR_RATE', default=0, cast=float)  # fake provider only
+LLM_FAKE_CHUNK_LATENCY = config('LLM_FAKE_CHUNK_LATENCY', default=0, cast=float)  # fake provider only: seconds between streamed chunks
+
+# Conversation context window
+CHAT_CONTEXT_TOKEN_BUDGET = config('CHAT_CONTEXT_TOKEN_BUDGET', default=6000, cast=int)
+CHAT_CONTEXT_SUMMARY_WORDS = config('CHAT_CONTEXT_SUMMARY_WORDS', default=250, cast=int)
+
+# Concurrent turns on one session run one at a time
+CHAT_TURN_LOCK_WAIT = config('CHAT_TURN_LOCK_WAIT', default=30, cast=int)  # seconds a turn waits before a 409
+CHAT_TURN_LOCK_LEASE = config('CHAT_TURN_LOCK_LEASE', default=180, cast=int)  # lease expiry if a worker dies mid-turn
+
+# How chat turns are written (see core/persistence.py):
+# 'sync' commits each turn before replying, 'group' batches turns from many
+# sessions into one commit and waits for it, 'async' replies without waiting
+CHAT_PERSISTENCE_MODE = config('CHAT_PERSISTENCE_MODE', default='sync')
+CHAT_WRITE_BEHIND_INTERVAL = config('CHAT_WRITE_BEHIND_INTERVAL', default=0.05, cast=float)  # seconds between group commits
+CHAT_WRITE_BEHIND_MAX_BATCH = config('CHAT_WRITE_BEHIND_MAX_BATCH', default=500, cast=int)  # turns per commit
+
+# Conversation history cache (see core/history_cache.py): an in-process LRU,
+# backed by the shared cache when Redis is configured
+CHAT_HISTORY_CACHE = config('CHAT_HISTORY_CACHE', default=True, cast=bool)
+CHAT_HISTORY_CACHE_MAX_BYTES = config('CHAT_HISTORY_CACHE_MAX_BYTES', default=32 * 1024 * 1024, cast=int)  # per process
+CHAT_HISTORY_SHARED_CACHE = config('CHAT_HISTORY_SHARED_CACHE', default=config('USE_REDIS', default=False, cast=bool), cast=bool)
+CHAT_HISTORY_SHARED_CACHE_TTL = config('CHAT_HISTORY_SHARED_CACHE_TTL', default=3600, cast=int)  # seconds
+
+# Chat retention, applied off the request path by `manage.py apply_retention`
+# (0 disables a rule; archived sessions are always kept)
+CHAT_RETENTION_MAX_SESSIONS_PER_USER = config('CHAT_RETENTION_MAX_SESSIONS_PER_USER', default=20, cast=int)
+CHAT_RETENTION_INACTIVE_TTL_DAYS = config('CHAT_RETENTION_INACTIVE_TTL_DAYS', default=30, cast=int)
+CHAT_RETENTION_ANONYMOUS_TTL_DAYS = config('CHAT_RETENTION_ANONYMOUS_TTL_DAYS', default=90, cast=int)
+CHAT_RETENTION_CHUNK_SIZE = config('CHAT_RETENTION_CHUNK_SIZE', default=500, cast=int)
+
+# Rate limiting and admission control (see core/ratelimit.py). Rates are
+# '<count>/<period>[:<burst>]' token buckets per client; '' disables a scope
+RATE_LIMIT_ENABLED = config('RATE_LIMIT_ENABLED', default=True, cast=bool)
+RATE_LIMIT_BACKEND = config('RATE_LIMIT_BACKEND', default='redis' if config('USE_REDIS', default=False, cast=bool) else 'local')
+RATE_LIMIT_KEY = config('RATE_LIMIT_KEY', default='user')  # 'user' (falls back to IP), 'ip' or 'session'
+RATE_LIMIT_TRUST_FORWARDED = config('RATE_LIMIT_TRUST_FORWARDED', default=False, cast=bool)  # behind a proxy
+RATE_LIMITS = {
+    'chat': config('RATE_LIMIT_CHAT', default='20/min:10'),
+    'new_chat': config('RATE_LIMIT_NEW_CHAT', default='30/min'),
+}
+CHAT_MAX_INFLIGHT = config('CHAT_MAX_INFLIGHT', default=32, cast=int)  # generations per process; 0 = no cap
+
+# Metrics (/api/metrics/ and Server-Timing headers)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')  # if set, scrapers must send 'Authorization: Bearer <token>'
+
+# Sampling profiler (see core/profiling.py and `manage.py profile_report`)
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=False, cast=bool)
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=0.0, cast=float)  # fraction of requests profiled
+PROFILING_TRACEMALLOC = config('PROFILING_TRACEMALLOC', default=False, cast=bool)  # also snapshot memory (slower)
+PROFILING_DIR = config('PROFILING_DIR', default=str(BASE_DIR / 'profiles'))
+PROFILING_MAX_FILES = config('PROFILING_MAX_FILES', default=500, cast=int)  # newest samples kept
+PROFILING_TOKEN_MAX_AGE = config('PROFILING_TOKEN_MAX_AGE', default=3600, cast=int)  # seconds an X-Profile token is valid
+
+# Cold storage of idle sessions (see core/cold_storage.py and `manage.py tier_sessions`)
+CHAT_COLD_STORAGE_IDLE_DAYS = config('CHAT_COLD_STORAGE_IDLE_DAYS', default=90, cast=int)  # 0 disables
+CHAT_COLD_STORAGE_ARCHIVED_IDLE_DAYS = config('CHAT_COLD_STORAGE_ARCHIVED_IDLE_DAYS', default=30, cast=int)  # 0 disables
+CHAT_COLD_STORAGE_MIN_MESSAGES = config('CHAT_COLD_STORAGE_MIN_MESSAGES', default=4, cast=int)  # smaller sessions stay hot
+CHAT_COLD_STORAGE_CODEC = config('CHAT_COLD_STORAGE_CODEC', default='zlib')  # 'zlib' or 'zstd' (needs zstandard)
+
+# Idempotency keys for chat POSTs
+IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', default=86400, cast=int)  # seconds a stored result is replayed
+IDEMPOTENCY_WAIT_TIMEOUT = config('IDEMPOTENCY_WAIT_TIMEOUT', default=60, cast=int)  # max wait on an in-flight duplicate
+IDEMPOTENCY_PENDING_LEASE = config('IDEMPOTENCY_PENDING_LEASE', default=3 * LLM_DEADLINE, cast=float)  # seconds an unfinished request holds its key
 
 # Cache configuration (optional - for production)
 if config('USE_REDIS', default=False, cast=bool):
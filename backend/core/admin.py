@@ -1,30 +1,70 @@
 from django.contrib import admin
-from .models import ChatSession, ChatMessage, AIConfig
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.db.models import Q
+from .search import matching_messages
+from .transfer import export_lines, gzip_stream
+from .models import ChatSession, ChatMessage, ColdTranscript, AIConfig, IdempotencyRecord
 
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'session_key', 'created_at', 'updated_at', 'is_active']
-    list_filter = ['is_active', 'created_at', 'updated_at']
+    list_display = ['id', 'user', 'session_key', 'message_count', 'created_at', 'updated_at', 'is_active', 'is_cold']
+    list_filter = ['is_active', 'is_archived', 'is_cold', 'created_at', 'updated_at']
     search_fields = ['session_key', 'user__username']
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['created_at', 'updated_at', 'summary', 'summary_last_message_id',
+                       'message_count', 'user_message_count', 'ai_message_count', 'total_characters',
+                       'last_message_at', 'last_message_preview', 'is_cold']
+    actions = ['export_jsonl']
+    
+    @admin.action(description='Export selected sessions as gzip JSON Lines')
+    def export_jsonl(self, request, queryset):
+        # Streamed in chunks, so "select all" works on any number of sessions
+        response = StreamingHttpResponse(gzip_stream(export_lines(queryset)), content_type='application/gzip')
+        filename = f"chats-{timezone.now().strftime('%Y%m%d-%H%M%S')}.jsonl.gz"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
 
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'session', 'message_type', 'content_preview', 'timestamp', 'character_count']
+    list_display = ['id', 'session', 'message_type', 'content_preview', 'timestamp', 'character_count', 'token_count']
     list_filter = ['message_type', 'timestamp']
-    search_fields = ['content', 'session__session_key']
-    readonly_fields = ['timestamp', 'character_count']
+    search_fields = ['=session__session_key']  # Content is searched through the full-text index
+    readonly_fields = ['timestamp', 'character_count', 'token_count']
+    
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return queryset.filter(
+            Q(session__session_key=search_term) | matching_messages(search_term, using=queryset.db)
+        ), False
     
     def content_preview(self, obj):
         return obj.content[:100] + '...' if len(obj.content) > 100 else obj.content
     content_preview.short_description = 'Content Preview'
 
 
+@admin.register(ColdTranscript)
+class ColdTranscriptAdmin(admin.ModelAdmin):
+    list_display = ['session', 'codec', 'message_count', 'raw_bytes', 'compressed_bytes', 'frozen_at']
+    list_filter = ['codec']
+    search_fields = ['=session__session_key']
+    exclude = ['data']
+    readonly_fields = ['session', 'codec', 'message_count', 'raw_bytes', 'compressed_bytes', 'frozen_at']
+
+
 @admin.register(AIConfig)
 class AIConfigAdmin(admin.ModelAdmin):
-    list_display = ['name', 'model_name', 'is_active', 'created_at', 'updated_at']
+    list_display = ['name', 'model_name', 'max_tokens', 'temperature', 'is_active', 'updated_at']
     list_filter = ['is_active', 'model_name', 'created_at']
     search_fields = ['name', 'model_name']
     readonly_fields = ['created_at', 'updated_at']
+
+
+@admin.register(IdempotencyRecord)
+class IdempotencyRecordAdmin(admin.ModelAdmin):
+    list_display = ['scope', 'key', 'status', 'response_status', 'created_at', 'expires_at']
+    list_filter = ['scope', 'status']
+    search_fields = ['key']
+    readonly_fields = ['created_at']
@@ -0,0 +1,123 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import AIConfig
+from .llm import DEFAULT_MODEL
+from .prompt import get_prompt, get_system_instruction
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_active = None
+_active_lock = threading.Lock()
+_version = None
+_checked_at = 0.0  # time.monotonic() of the last version check
+
+
+class ActiveConfig:
+    """Immutable snapshot of the active AIConfig row, shared by all requests in a process"""
+
+    def __init__(self, version, model_name=DEFAULT_MODEL, system_prompt=None, max_tokens=None,
+                 temperature=None, name=None):
+        self.version = version
+        self.name = name
+        self.model_name = model_name or DEFAULT_MODEL
+        self.system_prompt = system_prompt or get_prompt()
+        self.system_instruction = get_system_instruction(self.system_prompt)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    @property
+    def generation_config(self):
+        """Generation parameters for the provider; unset values use the provider's defaults"""
+        generation_config = {}
+        if self.max_tokens:
+            generation_config['max_output_tokens'] = self.max_tokens
+        if self.temperature is not None:
+            generation_config['temperature'] = self.temperature
+        return generation_config
+
+
+def _version_due():
+    return _version is None or time.monotonic() - _checked_at >= getattr(settings, 'AI_CONFIG_CHECK_INTERVAL', 5)
+
+
+def _current_version():
+    """Version stamp of the AIConfig table, read from the database at most every AI_CONFIG_CHECK_INTERVAL"""
+    global _version, _checked_at
+    if _version_due():
+        # The database is the one stamp every process sees (a LocMemCache is per process).
+        # The active count catches queryset updates, which leave updated_at alone.
+        stamp = AIConfig.objects.aggregate(
+            updated=Max('updated_at'), rows=Count('id'), active=Count('id', filter=Q(is_active=True))
+        )
+        _version = (stamp['updated'], stamp['rows'], stamp['active'])
+        _checked_at = time.monotonic()
+    return _version
+
+
+def _load(version):
+    global _active
+    with _active_lock:
+        if _active is not None and _active.version == version:
+            return _active
+        row = AIConfig.objects.filter(is_active=True).order_by('-updated_at', '-id').first()
+        if row is None:
+            _active = ActiveConfig(version)
+        else:
+            _active = ActiveConfig(
+                version,
+                model_name=row.model_name,
+                system_prompt=row.system_prompt,
+                max_tokens=row.max_tokens,
+                temperature=row.temperature,
+                name=row.name,
+            )
+        logger.info(f"Loaded AI config {_active.name or '(defaults)'} for model {_active.model_name}")
+        return _active
+
+
+def get_active_config():
+    """
+    Get the active AI configuration.
+
+    The row is read once per process and reused until the table's version
+    stamp (newest updated_at and row counts) changes. Each process re-checks
+    the stamp with one aggregate query at most every AI_CONFIG_CHECK_INTERVAL
+    seconds, so an admin change reaches every worker within that interval.
+    The process that saved it reloads on its next request.
+    """
+    version = _current_version()
+    active = _active
+    if active is not None and active.version == version:
+        return active
+    return _load(version)
+
+
+async def aget_active_config():
+    """Get the active AI configuration (async)"""
+    version = await sync_to_async(_current_version)() if _version_due() else _version
+    active = _active
+    if active is not None and active.version == version:
+        return active
+    return await sync_to_async(_load)(version)
+
+
+def invalidate_ai_config():
+    """Reload the active AI configuration on this process's next request (others follow within the check interval)"""
+    global _active, _version
+    with _active_lock:
+        _active = None
+        _version = None
+
+
+@receiver(post_save, sender=AIConfig)
+@receiver(post_delete, sender=AIConfig)
+def _invalidate_on_change(sender, **kwargs):
+    # Wait for the commit so the reload cannot read the old row
+    transaction.on_commit(invalidate_ai_config)
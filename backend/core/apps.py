@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # Connect the AIConfig cache invalidation signals
+        from . import ai_config  # noqa: F401
+        # Count the queries of every database connection
+        from . import metrics  # noqa: F401
+        # core has no migrations: create the full-text search index after migrate
+        from .search import ensure_search_index
+        post_migrate.connect(ensure_search_index, sender=self)
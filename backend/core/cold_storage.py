@@ -0,0 +1,260 @@
+"""
+Cold storage tier for idle chat sessions.
+
+Sessions nobody has touched for a while are packed by `manage.py
+tier_sessions` into one compressed ColdTranscript row per session, and their
+ChatMessage rows are deleted. This keeps the message table (and its indexes,
+buffer pool share and backups) down to conversations that are actually in
+use. Session counters and titles are untouched, so listings are unaffected.
+
+Reading a cold session's history, in full, by page or since a cursor,
+decompresses the blob without writing anything. Only a new turn thaws the
+session: its messages are restored with their original ids and timestamps.
+The message table's full-text index loses the frozen rows, so each
+transcript is indexed as one document instead (see core/search.py) and
+cold chats stay searchable. The document goes when the transcript is
+deleted, however that happens (thawing, retention, the admin).
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Sum
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import ChatSession, ChatMessage, ColdTranscript
+from .locks import SessionTurnLock, TurnLockTimeout
+from .search import index_cold_transcript, unindex_cold_transcript
+import json
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 19
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImproperlyConfigured("CHAT_COLD_STORAGE_CODEC='zstd' requires the zstandard package")
+    return zstandard
+
+
+def compress(data, codec):
+    if codec == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ImproperlyConfigured(f"Unknown cold storage codec {codec!r}: use zlib or zstd")
+
+
+def decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown cold storage codec {codec!r}")
+
+
+def pack_messages(messages):
+    """Serialise messages to compact JSON bytes"""
+    return json.dumps([
+        [m.id, m.message_type, m.content, m.timestamp.isoformat(), m.character_count, m.token_count]
+        for m in messages
+    ], separators=(',', ':')).encode()
+
+
+def unpack_messages(transcript):
+    """Unsaved ChatMessage objects of a cold transcript, oldest first"""
+    rows = json.loads(decompress(bytes(transcript.data), transcript.codec))
+    return [
+        ChatMessage(
+            id=message_id,
+            session_id=transcript.session_id,
+            message_type=message_type,
+            content=content,
+            timestamp=parse_datetime(timestamp),
+            character_count=character_count,
+            token_count=token_count,
+            plain_content=ChatMessage.plain_text(message_type, content),
+        )
+        for message_id, message_type, content, timestamp, character_count, token_count in rows
+    ]
+
+
+def session_messages(session):
+    """All messages of a session, oldest first, whether it is cold or not"""
+    messages = list(session.messages.order_by('timestamp', 'id'))
+    if not session.is_cold:
+        return messages
+    try:
+        cold = unpack_messages(ColdTranscript.objects.get(session=session))
+    except ColdTranscript.DoesNotExist:  # Thawed since the session was loaded
+        return list(session.messages.order_by('timestamp', 'id'))
+    # A turn that raced the freeze may have left newer messages in the table
+    return sorted(cold + messages, key=lambda m: (m.timestamp, m.id))
+
+
+def last_cold_message(session):
+    """Newest message in a session's cold transcript, or None"""
+    transcript = ColdTranscript.objects.filter(session=session).first()
+    if transcript is None:
+        return None
+    messages = unpack_messages(transcript)
+    return max(messages, key=lambda m: (m.timestamp, m.id)) if messages else None
+
+
+def freeze_session(session, codec=None):
+    """
+    Pack a session's messages into a ColdTranscript and delete them.
+
+    Takes the session's turn lock without waiting, so a session with a turn
+    in flight is skipped. Returns the transcript, or None if nothing was done.
+    """
+    codec = codec or getattr(settings, 'CHAT_COLD_STORAGE_CODEC', 'zlib')
+    try:
+        lock = SessionTurnLock(session, wait_timeout=0).acquire()
+    except TurnLockTimeout:
+        return None
+    try:
+        with transaction.atomic():
+            messages = list(session.messages.order_by('timestamp', 'id'))
+            if not messages or ColdTranscript.objects.filter(session=session).exists():
+                return None
+            raw = pack_messages(messages)
+            data = compress(raw, codec)
+            transcript = ColdTranscript.objects.create(
+                session=session,
+                codec=codec,
+                data=data,
+                message_count=len(messages),
+                raw_bytes=len(raw),
+                compressed_bytes=len(data),
+            )
+            ChatMessage.objects.filter(id__in=[m.id for m in messages]).delete()
+            index_cold_transcript(session.pk, messages)
+            ChatSession.objects.filter(pk=session.pk).update(is_cold=True)
+            session.is_cold = True
+        return transcript
+    finally:
+        lock.release()
+
+
+@receiver(pre_delete, sender=ColdTranscript)
+def _unindex_deleted_transcript(sender, instance, using, **kwargs):
+    # Also runs for transcripts deleted with their session (retention)
+    unindex_cold_transcript(instance, using)
+
+
+def thaw_session(session):
+    """Restore a cold session's messages to the message table"""
+    restored = 0
+    try:
+        with transaction.atomic():
+            transcript = ColdTranscript.objects.select_for_update().filter(session=session).first()
+            if transcript is not None:
+                # bulk_create skips save(), so the session counters are not counted twice
+                ChatMessage.objects.bulk_create(unpack_messages(transcript), batch_size=500)
+                transcript.delete()
+                restored = transcript.message_count
+            ChatSession.objects.filter(pk=session.pk).update(is_cold=False)
+    except IntegrityError:
+        # A concurrent thaw restored the messages first
+        restored = 0
+    session.is_cold = False
+    if restored:
+        logger.info(f"Thawed session {session.pk} ({restored} messages)")
+
+
+class TieringPolicy:
+    """
+    Which sessions move to cold storage.
+
+    - idle_days: sessions not updated for this long
+    - archived_idle_days: archived sessions not updated for this long
+    - min_messages: leave sessions smaller than this alone (not worth a blob)
+    """
+
+    def __init__(self, idle_days=None, archived_idle_days=None, min_messages=None, chunk_size=None):
+        self.idle_days = idle_days
+        self.archived_idle_days = archived_idle_days
+        self.min_messages = min_messages or 1
+        self.chunk_size = chunk_size or 200
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            idle_days=getattr(settings, 'CHAT_COLD_STORAGE_IDLE_DAYS', 90),
+            archived_idle_days=getattr(settings, 'CHAT_COLD_STORAGE_ARCHIVED_IDLE_DAYS', 30),
+            min_messages=getattr(settings, 'CHAT_COLD_STORAGE_MIN_MESSAGES', 4),
+        )
+
+    def candidates(self, now=None):
+        """Sessions due for cold storage, least recently updated first"""
+        now = now or timezone.now()
+        rules = Q(pk__in=[])
+        if self.idle_days:
+            rules |= Q(updated_at__lt=now - timedelta(days=self.idle_days))
+        if self.archived_idle_days:
+            rules |= Q(is_archived=True, updated_at__lt=now - timedelta(days=self.archived_idle_days))
+        return ChatSession.objects.filter(
+            rules, is_cold=False, message_count__gte=self.min_messages
+        ).order_by('updated_at')
+
+
+def tier_sessions(policy=None, now=None, limit=None):
+    """Freeze every candidate session; returns counts of what was packed"""
+    policy = policy or TieringPolicy.from_settings()
+    totals = {'sessions': 0, 'messages': 0, 'raw_bytes': 0, 'compressed_bytes': 0, 'skipped': 0}
+    skipped = set()  # Busy sessions; frozen ones drop out of the candidates by themselves
+    while limit is None or totals['sessions'] < limit:
+        chunk = list(policy.candidates(now).exclude(pk__in=skipped)[:policy.chunk_size])
+        if not chunk:
+            break
+        for session in chunk:
+            transcript = freeze_session(session)
+            if transcript is None:
+                skipped.add(session.pk)
+                totals['skipped'] += 1
+                continue
+            totals['sessions'] += 1
+            totals['messages'] += transcript.message_count
+            totals['raw_bytes'] += transcript.raw_bytes
+            totals['compressed_bytes'] += transcript.compressed_bytes
+            if limit is not None and totals['sessions'] >= limit:
+                break
+    if totals['sessions']:
+        logger.info(
+            f"Moved {totals['sessions']} sessions ({totals['messages']} messages) to cold storage, "
+            f"{totals['raw_bytes']} -> {totals['compressed_bytes']} bytes"
+        )
+    return totals
+
+
+def storage_report(policy=None, now=None):
+    """Sizes of the hot and cold tiers and what the next tiering run would move"""
+    policy = policy or TieringPolicy.from_settings()
+    cold = ColdTranscript.objects.aggregate(
+        messages=Sum('message_count'), raw_bytes=Sum('raw_bytes'), compressed_bytes=Sum('compressed_bytes')
+    )
+    hot = ChatMessage.objects.aggregate(characters=Sum('character_count'))
+    candidates = policy.candidates(now)
+    raw_bytes = cold['raw_bytes'] or 0
+    compressed_bytes = cold['compressed_bytes'] or 0
+    return {
+        'hot_messages': ChatMessage.objects.count(),
+        'hot_characters': hot['characters'] or 0,
+        'cold_sessions': ColdTranscript.objects.count(),
+        'cold_messages': cold['messages'] or 0,
+        'cold_raw_bytes': raw_bytes,
+        'cold_compressed_bytes': compressed_bytes,
+        'saved_bytes': raw_bytes - compressed_bytes,
+        'ratio': round(raw_bytes / compressed_bytes, 2) if compressed_bytes else None,
+        'candidate_sessions': candidates.count(),
+        'candidate_messages': candidates.aggregate(messages=Sum('message_count'))['messages'] or 0,
+    }
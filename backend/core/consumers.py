@@ -0,0 +1,207 @@
+"""
+WebSocket chat transport (ws/chat/, served by backend/asgi.py).
+
+One connection carries any number of the caller's chats. Clients send JSON
+messages:
+
+    {"type": "send", "session_key": "...", "message": "..."}    reply in one "done" message
+    {"type": "stream", "session_key": "...", "message": "..."}  "token" messages, then "done"
+    {"type": "cancel", "session_key": "..."}
+
+and every server message carries the session_key it belongs to. A chat has
+at most one generation in flight per connection. Cancelling it, starting a
+new chat over HTTP (NewChatAPIView) or closing the connection aborts the
+upstream model call; the reply generated so far is saved, and the client
+gets a "cancelled" message with it. Nothing is saved if no text had arrived.
+
+Generations join the channel layer group of their session, which is how
+HTTP views reach them. With the InMemoryChannelLayer that only covers
+connections served by the same process, i.e. a single-node deployment.
+"""
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from contextlib import aclosing
+from django.conf import settings
+from urllib.parse import parse_qs
+from .identity import issue_client_token, read_client_token
+from .ratelimit import get_rate_limiter, rate_limit_key, try_admit, release_admission
+from .serializers import ChatRequestSerializer
+from .services import AIService, SessionManager
+import asyncio
+import hashlib
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+CANCEL_EVENT = 'generation.cancel'
+
+
+def generation_group(session_key):
+    """Channel layer group of the generations of a session (group names are restricted to ASCII)"""
+    return f"chat-generation.{hashlib.sha1(session_key.encode()).hexdigest()}"
+
+
+def cancel_generation(session_key):
+    """Abort the WebSocket generations of a session, from sync code such as a view"""
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    try:
+        async_to_sync(layer.group_send)(generation_group(session_key), {
+            'type': CANCEL_EVENT,
+            'session_key': session_key,
+        })
+    except Exception as e:
+        # Clearing the chat must not fail because the transport is unavailable
+        logger.error(f"Error cancelling generations of session {session_key}: {str(e)}")
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """Multiplexes send, stream and cancel for the caller's chats"""
+
+    async def connect(self):
+        user = self.scope.get('user')
+        self.user = user if user is not None and user.is_authenticated else None
+        self.client_id = ''
+        self.presented_client = False
+        self.generations = {}  # session_key -> task
+        self.closed = False
+        minted = None
+        if self.user is None:
+            # Browsers cannot set headers on a WebSocket: the token comes in
+            # the chat_client cookie or a ?client= query parameter
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+            token = query.get('client', [None])[0] or self.scope.get('cookies', {}).get(
+                settings.CHAT_CLIENT_COOKIE_NAME
+            )
+            self.client_id, _ = read_client_token(token)
+            self.presented_client = self.client_id is not None
+            if self.client_id is None:
+                self.client_id = uuid.uuid4().hex
+                minted = issue_client_token(self.client_id)
+        await self.accept()
+        await self.send_json({'type': 'ready', 'client_token': minted})
+
+    async def disconnect(self, code):
+        self.closed = True
+        tasks = list(self.generations.values())
+        for task in tasks:
+            task.cancel()
+        # Let the partial replies be saved before the consumer goes away
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def receive_json(self, content, **kwargs):
+        kind = content.get('type') if isinstance(content, dict) else None
+        if kind in ('send', 'stream'):
+            await self.start(kind, content)
+        elif kind == 'cancel':
+            self.cancel(str(content.get('session_key') or ''))
+        else:
+            await self.send_json({'type': 'error', 'error': "Unknown message type. Use send, stream or cancel"})
+
+    def rate_limit_key(self):
+        """The bucket client_key would pick for the same caller over HTTP"""
+        session = self.scope.get('session')
+        return rate_limit_key(
+            (self.scope.get('client') or ('',))[0],
+            user=self.user,
+            session_key=session.session_key if session is not None else None,
+            client_id=self.client_id if self.presented_client else None,
+        )
+
+    async def start(self, kind, content):
+        serializer = ChatRequestSerializer(data={
+            'message': content.get('message'),
+            **({'session_key': content['session_key']} if content.get('session_key') else {}),
+        })
+        if not serializer.is_valid():
+            await self.send_json({'type': 'error', 'session_key': content.get('session_key'), 'error': serializer.errors})
+            return
+        user_message = serializer.validated_data['message']
+        session_key = serializer.validated_data.get('session_key') or SessionManager.generate_session_key()
+
+        if not user_message.strip():
+            await self.send_json({'type': 'error', 'session_key': session_key, 'error': "Message cannot be empty"})
+            return
+        if session_key in self.generations:
+            await self.send_json({
+                'type': 'error',
+                'session_key': session_key,
+                'busy': True,
+                'error': "A reply is still being generated in this chat",
+            })
+            return
+
+        # The same guards as the HTTP chat views (core/ratelimit.py)
+        if getattr(settings, 'RATE_LIMIT_ENABLED', True):
+            allowed, retry_after = await sync_to_async(get_rate_limiter().check)('chat', self.rate_limit_key())
+            if not allowed:
+                await self.send_json({
+                    'type': 'error',
+                    'session_key': session_key,
+                    'error': "Too many requests, please slow down",
+                    'retry_after': retry_after,
+                })
+                return
+        if not try_admit():
+            logger.warning("Chat admission cap reached, rejecting WebSocket message")
+            await self.send_json({
+                'type': 'error',
+                'session_key': session_key,
+                'unavailable': True,
+                'error': "The assistant is busy, please try again shortly",
+            })
+            return
+
+        if self.channel_layer is not None:
+            await self.channel_layer.group_add(generation_group(session_key), self.channel_name)
+        self.generations[session_key] = asyncio.create_task(self.generate(kind, session_key, user_message))
+
+    async def generate(self, kind, session_key, user_message):
+        partial = []
+        try:
+            events = AIService().astream_message(
+                user_message=user_message,
+                session_key=session_key,
+                user=self.user,
+                client_id=self.client_id,
+            )
+            # aclosing: a cancel while a message is being sent still reaches the service
+            async with aclosing(events):
+                async for event in events:
+                    if event['event'] == 'token':
+                        partial.append(event['html'])
+                        if kind == 'stream':
+                            await self.send_json({
+                                'type': 'token',
+                                'session_key': session_key,
+                                'text': event['text'],
+                                'html': event['html'],
+                            })
+                    else:
+                        await self.send_json({'type': event.pop('event'), **event})
+        except asyncio.CancelledError:
+            if not self.closed:
+                await self.send_json({'type': 'cancelled', 'session_key': session_key, 'response': ''.join(partial)})
+            raise
+        except Exception as e:
+            logger.error(f"Error in WebSocket generation: {str(e)}")
+            if not self.closed:
+                await self.send_json({'type': 'error', 'session_key': session_key, 'error': str(e)})
+        finally:
+            release_admission()
+            if self.generations.get(session_key) is asyncio.current_task():
+                del self.generations[session_key]
+            if self.channel_layer is not None:
+                await self.channel_layer.group_discard(generation_group(session_key), self.channel_name)
+
+    def cancel(self, session_key):
+        """Abort a chat's generation on this connection (a no-op if there is none)"""
+        task = self.generations.get(session_key)
+        if task is not None:
+            task.cancel()
+
+    async def generation_cancel(self, event):
+        self.cancel(event['session_key'])
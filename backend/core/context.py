@@ -0,0 +1,147 @@
+from django.conf import settings
+from .formatting import to_markdown
+from .models import ChatSession
+from .prompt import get_summary_prompt
+from .tokens import estimate_tokens
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOKEN_BUDGET = 6000
+DEFAULT_SUMMARY_WORDS = 250
+
+# When the window overflows, fold turns until the kept turns use at most this
+# share of the budget, so summarisation runs once per batch of turns rather
+# than on every message
+REFILL_RATIO = 0.75
+
+
+class ContextWindow:
+    """
+    Keeps the most recent turns of a session within a token budget and folds
+    older turns into the session's rolling summary as they age out
+    """
+    
+    def __init__(self, client, token_budget=None, summary_words=None, model_name=None, deadline=None):
+        self.client = client
+        # Summaries use the active model and count against the turn's deadline
+        self.model_name = model_name
+        self.deadline = deadline
+        self.token_budget = token_budget or getattr(settings, 'CHAT_CONTEXT_TOKEN_BUDGET', DEFAULT_TOKEN_BUDGET)
+        self.summary_words = summary_words or getattr(settings, 'CHAT_CONTEXT_SUMMARY_WORDS', DEFAULT_SUMMARY_WORDS)
+    
+    def _pending_messages(self, session, exclude=None):
+        """Messages that have not been folded into the summary yet"""
+        messages = session.messages.filter(message_type__in=['user', 'ai'])
+        if session.summary_last_message_id:
+            messages = messages.filter(id__gt=session.summary_last_message_id)
+        if exclude is not None:
+            messages = messages.exclude(id=exclude.id)
+        return messages.only('id', 'message_type', 'content', 'token_count').order_by('timestamp', 'id')
+    
+    def split(self, session, messages):
+        """Split messages into (aged_out, kept) according to the token budget"""
+        budget = self.token_budget - estimate_tokens(session.summary)
+        total = sum(message.token_count for message in messages)
+        if total <= budget:
+            return [], list(messages)
+        
+        # Keep the newest turns that fit in the refill target
+        target = int(budget * REFILL_RATIO)
+        kept_tokens = 0
+        cut = len(messages)
+        while cut > 0 and kept_tokens + messages[cut - 1].token_count <= target:
+            cut -= 1
+            kept_tokens += messages[cut].token_count
+        
+        # Always start the kept window on a user turn
+        while cut < len(messages) and messages[cut].message_type != 'user':
+            cut += 1
+        
+        return list(messages[:cut]), list(messages[cut:])
+    
+    def _summary_request(self, session, aged_out):
+        transcript = "\n".join(
+            f"{'User' if message.message_type == 'user' else 'AdvisorOP'}: {self.model_text(message)}"
+            for message in aged_out
+        )
+        return get_summary_prompt(session.summary, transcript, self.summary_words)
+    
+    def fold(self, session, aged_out):
+        """Fold aged-out turns into the session's rolling summary"""
+        try:
+            summary = self.client.summarize(
+                self._summary_request(session, aged_out), model_name=self.model_name, deadline=self.deadline
+            )
+        except Exception as e:
+            # Keep serving the bounded window; folding is retried next turn
+            logger.error(f"Error summarising session {session.pk}: {str(e)}")
+            return
+        
+        session.summary = summary
+        session.summary_last_message_id = aged_out[-1].id
+        ChatSession.objects.filter(pk=session.pk).update(
+            summary=session.summary,
+            summary_last_message_id=session.summary_last_message_id
+        )
+    
+    async def afold(self, session, aged_out):
+        """Fold aged-out turns into the session's rolling summary (async)"""
+        try:
+            summary = await self.client.asummarize(
+                self._summary_request(session, aged_out), model_name=self.model_name, deadline=self.deadline
+            )
+        except Exception as e:
+            logger.error(f"Error summarising session {session.pk}: {str(e)}")
+            return
+        
+        session.summary = summary
+        session.summary_last_message_id = aged_out[-1].id
+        await ChatSession.objects.filter(pk=session.pk).aupdate(
+            summary=session.summary,
+            summary_last_message_id=session.summary_last_message_id
+        )
+    
+    @staticmethod
+    def model_text(message):
+        """A message as the model should see it: replies are stored as HTML"""
+        return to_markdown(message.content) if message.message_type == 'ai' else message.content
+    
+    def to_history(self, session, messages):
+        """Convert the summary and kept turns into chat history entries"""
+        history = []
+        if session.summary:
+            history.append({
+                "role": "user",
+                "parts": [{"text": f"Here is a summary of our conversation so far:\n{session.summary}"}]
+            })
+            history.append({
+                "role": "model",
+                "parts": [{"text": "Thank you, I'll keep that in mind as we continue."}]
+            })
+        for message in messages:
+            role = "user" if message.message_type == 'user' else "model"
+            history.append({"role": role, "parts": [{"text": self.model_text(message)}]})
+        return history
+    
+    def build(self, session, exclude=None, messages=None):
+        """Build the bounded conversation history for a session.
+
+        messages, if given, are the session's pending messages (e.g. from
+        core/history_cache.py) and replace the query for them.
+        """
+        if messages is None:
+            messages = list(self._pending_messages(session, exclude))
+        aged_out, kept = self.split(session, messages)
+        if aged_out:
+            self.fold(session, aged_out)
+        return self.to_history(session, kept)
+    
+    async def abuild(self, session, exclude=None, messages=None):
+        """Build the bounded conversation history for a session (async)"""
+        if messages is None:
+            messages = [message async for message in self._pending_messages(session, exclude)]
+        aged_out, kept = self.split(session, messages)
+        if aged_out:
+            await self.afold(session, aged_out)
+        return self.to_history(session, kept)
@@ -0,0 +1,158 @@
+"""
+In-process stand-in for the Gemini provider.
+
+Select it with LLM_PROVIDER='fake' to run the backend and its tests without
+network access or an API key. It mirrors the small part of the
+google-generativeai surface the app uses and records every request so tests
+can assert on what would have been sent.
+
+It can also act degraded, to exercise core/resilience.py: every reply can be
+delayed (LLM_FAKE_LATENCY), streamed slowly (LLM_FAKE_CHUNK_LATENCY between
+chunks) or fail at random (LLM_FAKE_ERROR_RATE), and tests
+can inject() latency and errors into specific requests. Like the real SDK,
+a request that takes longer than its request_options timeout fails with a
+504 DeadlineExceeded.
+"""
+from django.conf import settings
+from google.api_core import exceptions as api_exceptions
+from .llm import CachedPrefix
+import asyncio
+import itertools
+import random
+import threading
+import time
+
+
+class FakeResponse:
+    """Response or stream chunk with a .text attribute, like the SDK's"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def _reply(self, content):
+        provider = self.model.provider
+        provider.requests.append({
+            'model': self.model,
+            'history': self.history,
+            'message': content,
+        })
+        return provider.reply(content, self.history)
+
+    def _chunks(self, text):
+        size = self.model.provider.chunk_size
+        return [FakeResponse(text[i:i + size]) for i in range(0, len(text), size)]
+
+    def _fault(self, request_options):
+        """Injected (latency, error) for this request, cut short by its timeout"""
+        latency, error = self.model.provider.next_fault(self.model.model_name)
+        timeout = (request_options or {}).get('timeout')
+        if timeout is not None and latency > timeout:
+            return max(0, timeout), api_exceptions.DeadlineExceeded("Fake provider timed out")
+        return latency, error
+
+    def send_message(self, content, stream=False, request_options=None, **kwargs):
+        latency, error = self._fault(request_options)
+        time.sleep(latency)
+        text = self._reply(content)
+        if error is not None:
+            raise error
+        if stream:
+            return self._slow(self._chunks(text))
+        return FakeResponse(text)
+
+    def _slow(self, chunks):
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(self.model.provider.chunk_latency)
+            yield chunk
+
+    async def send_message_async(self, content, stream=False, request_options=None, **kwargs):
+        latency, error = self._fault(request_options)
+        await asyncio.sleep(latency)
+        text = self._reply(content)
+        if error is not None:
+            raise error
+        if stream:
+            chunks = self._chunks(text)
+
+            async def iterate():
+                for index, chunk in enumerate(chunks):
+                    if index:
+                        await asyncio.sleep(self.model.provider.chunk_latency)
+                    yield chunk
+            return iterate()
+        return FakeResponse(text)
+
+
+class FakeModel:
+    def __init__(self, provider, model_name, system_instruction=None, cached_prefix=None, generation_config=None):
+        self.provider = provider
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.cached_prefix = cached_prefix
+        self.generation_config = generation_config
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
+
+    def generate_content(self, contents, request_options=None, **kwargs):
+        return FakeChat(self, []).send_message(contents, request_options=request_options)
+
+    async def generate_content_async(self, contents, request_options=None, **kwargs):
+        return await FakeChat(self, []).send_message_async(contents, request_options=request_options)
+
+
+class FakeProvider:
+    """Provider that answers locally with deterministic replies"""
+
+    def __init__(self, reply=None, chunk_size=8, latency=None, error_rate=None, chunk_latency=None):
+        self.reply = reply or (lambda message, history: f"You said: {message}")
+        self.chunk_size = chunk_size
+        self.latency = latency if latency is not None else getattr(settings, 'LLM_FAKE_LATENCY', 0)
+        self.chunk_latency = chunk_latency if chunk_latency is not None else getattr(settings, 'LLM_FAKE_CHUNK_LATENCY', 0)
+        self.error_rate = error_rate if error_rate is not None else getattr(settings, 'LLM_FAKE_ERROR_RATE', 0)
+        self.requests = []
+        self.cached_prefixes = []
+        self._faults = []
+        self._faults_lock = threading.Lock()
+        self._cache_ids = itertools.count(1)
+
+    def configure(self, api_key):
+        pass
+
+    def inject(self, error=None, latency=0, times=1, model_name=None):
+        """Make the next `times` requests (to model_name, if given) take `latency` seconds, then fail with `error`"""
+        with self._faults_lock:
+            self._faults.append({'model_name': model_name, 'error': error, 'latency': latency, 'times': times})
+
+    def next_fault(self, model_name):
+        """(latency, error) for the next request to a model"""
+        with self._faults_lock:
+            for fault in self._faults:
+                if fault['model_name'] in (None, model_name):
+                    fault['times'] -= 1
+                    if fault['times'] <= 0:
+                        self._faults.remove(fault)
+                    return fault['latency'], fault['error']
+        if self.error_rate and random.random() < self.error_rate:
+            return self.latency, api_exceptions.ServiceUnavailable("Injected fake provider error")
+        return self.latency, None
+
+    def create_model(self, model_name, system_instruction=None, cached_prefix=None, generation_config=None):
+        return FakeModel(self, model_name, system_instruction, cached_prefix, generation_config)
+
+    def create_cached_prefix(self, model_name, system_instruction, ttl):
+        prefix = CachedPrefix(
+            f"cachedContents/fake-{next(self._cache_ids)}",
+            model_name,
+            time.monotonic() + ttl,
+        )
+        prefix.system_instruction = system_instruction
+        self.cached_prefixes.append(prefix)
+        return prefix
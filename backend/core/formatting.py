@@ -0,0 +1,225 @@
+"""
+Markdown-to-HTML formatter for model replies.
+
+Handles the subset the model actually produces: **bold**, *italics*,
+bulleted and numbered lists, and line breaks. Everything else is escaped,
+so the output is safe to insert as HTML. The formatter makes one pass over
+its input and can be fed a reply chunk by chunk while it streams: it only
+holds back the few characters whose meaning depends on what comes next
+(a trailing "*", or the start of a line that may turn out to be a list item,
+up to the first character after its marker).
+
+Replies are stored formatted. to_markdown() turns that HTML back into the
+markdown the model wrote, for when its earlier replies are sent back to it.
+"""
+import html
+import re
+
+ESCAPES = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&#x27;',
+})
+
+SPECIAL = re.compile(r'[*\n\r]')
+LIST_ITEM = re.compile(r' {0,3}(?:([-*+])|\d{1,9}[.)])[ \t]+')
+# A line start that could still become a list item once more text arrives
+LIST_PREFIX = re.compile(r' {0,3}(?:[-*+]|\d{1,9}[.)]?)?')
+
+TAGS = {'bold': 'strong', 'italic': 'em'}
+MARKUP = re.compile(r'<(/?)(strong|em|br|ul|ol|li)>')
+MARKERS = {'strong': '**', 'em': '*'}
+
+
+class MarkdownFormatter:
+    """Incremental formatter: feed() chunks as they arrive, then call finish() once"""
+
+    def __init__(self):
+        self._pending = ''
+        self._inline = []  # open inline styles, innermost last
+        self._list = None  # 'ul' or 'ol' while inside a list
+        self._in_item = False
+        self._at_line_start = True
+        self._breaks = 0  # line breaks not emitted yet, so trailing newlines produce nothing
+
+    def feed(self, chunk):
+        """Format a chunk, returning the HTML that is final so far"""
+        out = []
+        self._pending = self._process(self._pending + chunk, out, final=False)
+        return ''.join(out)
+
+    def finish(self):
+        """Format whatever was held back and close every open tag"""
+        out = []
+        self._process(self._pending, out, final=True)
+        self._pending = ''
+        self._end_line(out)
+        self._close_list(out)
+        return ''.join(out)
+
+    def _process(self, text, out, final):
+        """Consume text, returning the unconsumed tail that needs more input"""
+        i = 0
+        end = len(text)
+        while i < end:
+            if self._at_line_start:
+                consumed = self._start_line(text, i, out, final)
+                if consumed is None:
+                    return text[i:]
+                i = consumed
+                continue
+
+            match = SPECIAL.search(text, i)
+            stop = match.start() if match else end
+            if stop > i:
+                out.append(text[i:stop].translate(ESCAPES))
+                i = stop
+                continue
+
+            char = text[i]
+            if char == '\r':
+                i += 1
+            elif char == '\n':
+                self._end_line(out)
+                i += 1
+            else:
+                run_end = i
+                while run_end < end and text[run_end] == '*':
+                    run_end += 1
+                # A run at the end of the input may still grow, or decide the next character
+                if run_end == end and not final:
+                    return text[i:]
+                self._emphasis(run_end - i, text[run_end] if run_end < end else '', out)
+                i = run_end
+        return ''
+
+    def _start_line(self, text, i, out, final):
+        """Classify a new line as a list item or text; None if more input is needed"""
+        newline = text.find('\n', i)
+        line_end = newline if newline != -1 else len(text)
+        line = text[i:line_end].rstrip('\r')
+
+        item = LIST_ITEM.match(line)
+        if newline == -1 and not final:
+            if item is None and (not line.strip() or LIST_PREFIX.fullmatch(line)):
+                return None
+            if item is not None and item.end() == len(line):
+                # The whitespace after the marker may go on in the next chunk
+                return None
+
+        if item is not None:
+            kind = 'ul' if item.group(1) else 'ol'
+            if self._list != kind:
+                self._close_list(out)
+                out.append(f'<{kind}>')
+                self._list = kind
+            self._breaks = 0
+            out.append('<li>')
+            self._in_item = True
+            self._at_line_start = False
+            return i + item.end()
+
+        if not line.strip():
+            # Blank lines keep a list open (loose lists) and count as breaks otherwise
+            if newline == -1:
+                return line_end
+            if self._list is None:
+                self._breaks += 1
+            return newline + 1
+
+        if self._list is not None:
+            self._close_list(out)
+            self._breaks = 0
+        out.append('<br>' * self._breaks)
+        self._breaks = 0
+        self._at_line_start = False
+        return i
+
+    def _emphasis(self, count, next_char, out):
+        if count % 2 and self._inline and self._inline[-1] == 'italic':
+            # "***" closing "***x": close the inner style first
+            self._toggle('italic', next_char, out, '*')
+            count -= 1
+        while count >= 2:
+            self._toggle('bold', next_char, out, '**')
+            count -= 2
+        if count % 2:
+            self._toggle('italic', next_char, out, '*')
+
+    def _toggle(self, style, next_char, out, marker):
+        if style in self._inline:
+            # Close anything opened inside this style, then reopen it, to keep tags nested
+            reopen = []
+            while self._inline:
+                inner = self._inline.pop()
+                out.append(f'</{TAGS[inner]}>')
+                if inner == style:
+                    break
+                reopen.append(inner)
+            for inner in reversed(reopen):
+                out.append(f'<{TAGS[inner]}>')
+                self._inline.append(inner)
+        elif next_char and not next_char.isspace():
+            out.append(f'<{TAGS[style]}>')
+            self._inline.append(style)
+        else:
+            # e.g. "2 * 3": not followed by text, so not an opening marker
+            out.append(marker)
+
+    def _end_line(self, out):
+        # Emphasis does not carry across lines, which keeps list markup well nested
+        while self._inline:
+            out.append(f'</{TAGS[self._inline.pop()]}>')
+        if self._in_item:
+            out.append('</li>')
+            self._in_item = False
+        elif not self._at_line_start and self._list is None:
+            self._breaks += 1
+        self._at_line_start = True
+
+    def _close_list(self, out):
+        if self._list is not None:
+            out.append(f'</{self._list}>')
+            self._list = None
+
+
+def format_markdown(text):
+    """Format a complete reply"""
+    formatter = MarkdownFormatter()
+    return formatter.feed(text) + formatter.finish()
+
+
+def to_markdown(text):
+    """Undo the formatter: markdown (and plain characters) for its HTML"""
+    if '<' not in text and '&' not in text:
+        return text
+    out = []
+    numbering = []  # next number of each open list, None for bullets
+    position = 0
+    for match in MARKUP.finditer(text):
+        out.append(text[position:match.start()])
+        position = match.end()
+        closing, tag = match.groups()
+        if tag in MARKERS:
+            out.append(MARKERS[tag])
+        elif tag == 'br':
+            out.append('\n')
+        elif tag in ('ul', 'ol'):
+            if closing:
+                if numbering:
+                    numbering.pop()
+            else:
+                if out and not ''.join(out).endswith('\n'):
+                    out.append('\n')
+                numbering.append(1 if tag == 'ol' else None)
+        elif closing:
+            out.append('\n')
+        elif numbering and numbering[-1] is not None:
+            out.append(f'{numbering[-1]}. ')
+            numbering[-1] += 1
+        else:
+            out.append('- ')
+    out.append(text[position:])
+    return html.unescape(''.join(out)).rstrip('\n')
@@ -0,0 +1,247 @@
+"""
+Two-tier cache of the conversation history the context window works from.
+
+Entries hold a session's messages that are not folded into its summary yet,
+keyed by session_key. Tier one is an in-process LRU bounded by size; tier two
+is the shared Django cache (Redis when USE_REDIS is on), so any node can warm
+up from a turn another node served. Entries are never trusted blindly: each
+lookup re-reads the session's message_count, and an entry that is behind is
+topped up with just the newer messages. That keeps nodes coherent at a cost
+of one or two small queries per turn, whatever the conversation length.
+"""
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .metrics import HISTORY_CACHE_LOOKUPS
+from .models import ChatSession
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_OVERHEAD = 100  # rough per-message bookkeeping cost, in bytes
+CONTEXT_TYPES = ('user', 'ai')
+
+LOOKUP_RESULTS = ('local_hits', 'shared_hits', 'partial_reloads', 'misses')
+
+CachedMessage = namedtuple('CachedMessage', ['id', 'message_type', 'content', 'token_count'])
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class HistoryEntry:
+    """Pending messages of one session as of a given message_count"""
+
+    def __init__(self, session_id, created_at, message_count, last_id, messages):
+        self.session_id = session_id
+        self.created_at = created_at
+        self.message_count = message_count
+        self.last_id = last_id  # newest message seen, of any type
+        self.messages = messages
+
+    @property
+    def size(self):
+        return sum(len(message.content) + MESSAGE_OVERHEAD for message in self.messages)
+
+    def belongs_to(self, session):
+        return self.session_id == session.pk and self.created_at == session.created_at
+
+
+class HistoryCache:
+    def __init__(self, max_bytes=None, shared_alias=None, shared_ttl=None):
+        self.max_bytes = max_bytes or getattr(settings, 'CHAT_HISTORY_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        self.shared = caches[shared_alias] if shared_alias else None
+        self.shared_ttl = shared_ttl or getattr(settings, 'CHAT_HISTORY_SHARED_CACHE_TTL', 3600)
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ['local_hits', 'shared_hits', 'misses', 'partial_reloads', 'appends', 'evictions'], 0
+        )
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+        if stat in LOOKUP_RESULTS:
+            HISTORY_CACHE_LOOKUPS.inc(result=stat)
+
+    def stats(self):
+        """Hit/miss counters and current size of the in-process tier"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['partial_reloads'] + stats['misses']
+        stats['hit_ratio'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 3) if lookups else None
+        return stats
+
+    def _shared_key(self, session_key):
+        return f'core:history:{session_key}'
+
+    def _get_local(self, session_key):
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry is not None:
+                self._entries.move_to_end(session_key)
+            return entry
+
+    def _put_local(self, session_key, entry):
+        size = entry.size
+        with self._lock:
+            self._bytes -= self._sizes.pop(session_key, 0)
+            self._entries.pop(session_key, None)
+            if size > self.max_bytes:
+                return
+            self._entries[session_key] = entry
+            self._sizes[session_key] = size
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted)
+                self._stats['evictions'] += 1
+
+    def _get_shared(self, session_key):
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.get(self._shared_key(session_key))
+        except Exception as e:
+            logger.warning(f"Shared history cache unavailable: {str(e)}")
+            return None
+
+    def _put_shared(self, session_key, entry):
+        if self.shared is None:
+            return
+        try:
+            self.shared.set(self._shared_key(session_key), entry, self.shared_ttl)
+        except Exception as e:
+            logger.warning(f"Shared history cache unavailable: {str(e)}")
+
+    def _store(self, session_key, entry):
+        self._put_local(session_key, entry)
+        self._put_shared(session_key, entry)
+
+    def _load(self, session, after_id=None):
+        """Fetch messages newer than after_id (or everything not yet summarised)"""
+        messages = session.messages.all()
+        if after_id is not None:
+            messages = messages.filter(id__gt=after_id)
+        elif session.summary_last_message_id:
+            messages = messages.filter(id__gt=session.summary_last_message_id)
+        return list(
+            messages.only('id', 'message_type', 'content', 'token_count').order_by('timestamp', 'id')
+        )
+
+    def _entry_from(self, session, rows, base=None):
+        cached = [CachedMessage(row.id, row.message_type, row.content, row.token_count)
+                  for row in rows if row.message_type in CONTEXT_TYPES]
+        last_id = rows[-1].id if rows else (base.last_id if base else session.summary_last_message_id)
+        return HistoryEntry(
+            session.pk,
+            session.created_at,
+            session.message_count,
+            last_id,
+            (base.messages if base else []) + cached,
+        )
+
+    def pending_messages(self, session):
+        """
+        Messages of a session not folded into its summary, oldest first.
+
+        Call while holding the session's turn lock: the session's counters
+        and summary are refreshed here, so the caller sees the latest state.
+        """
+        current = ChatSession.objects.filter(pk=session.pk).values(
+            'message_count', 'summary', 'summary_last_message_id'
+        ).get()
+        for field, value in current.items():
+            setattr(session, field, value)
+
+        entry = self._get_local(session.session_key)
+        tier = 'local_hits'
+        if entry is None or not entry.belongs_to(session) or entry.message_count != session.message_count:
+            shared = self._get_shared(session.session_key)
+            if shared is not None and shared.belongs_to(session) and (
+                    entry is None or not entry.belongs_to(session) or shared.message_count > entry.message_count):
+                entry, tier = shared, 'shared_hits'
+
+        if entry is None or not entry.belongs_to(session) or entry.message_count > session.message_count:
+            self._count('misses')
+            entry = self._entry_from(session, self._load(session))
+            self._store(session.session_key, entry)
+        elif entry.message_count < session.message_count:
+            # Another node or process added messages: fetch only those
+            rows = self._load(session, after_id=entry.last_id)
+            if entry.message_count + len(rows) == session.message_count:
+                self._count('partial_reloads')
+                entry = self._entry_from(session, rows, base=entry)
+            else:
+                # Rows were removed or inserted out of order; start over
+                self._count('misses')
+                entry = self._entry_from(session, self._load(session))
+            self._store(session.session_key, entry)
+        else:
+            self._count(tier)
+            if tier == 'shared_hits':
+                self._put_local(session.session_key, entry)
+
+        folded = session.summary_last_message_id
+        if folded and entry.messages and entry.messages[0].id <= folded:
+            entry.messages = [message for message in entry.messages if message.id > folded]
+            self._store(session.session_key, entry)
+        return list(entry.messages)
+
+    def append(self, session, messages):
+        """Add just-committed messages to a session's entry instead of invalidating it"""
+        entry = self._get_local(session.session_key)
+        if entry is None or not entry.belongs_to(session):
+            return
+        if any(message.pk is None for message in messages):
+            return
+        rows = [message for message in messages if message.pk > (entry.last_id or 0)]
+        updated = HistoryEntry(
+            entry.session_id,
+            entry.created_at,
+            entry.message_count + len(rows),
+            rows[-1].pk if rows else entry.last_id,
+            entry.messages + [CachedMessage(row.pk, row.message_type, row.content, row.token_count)
+                              for row in rows if row.message_type in CONTEXT_TYPES],
+        )
+        # A wrong count is caught on the next lookup, which re-reads message_count
+        self._count('appends')
+        self._store(session.session_key, updated)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+
+def get_history_cache():
+    """Get the process-wide history cache, or None when it is disabled"""
+    global _cache
+    if not getattr(settings, 'CHAT_HISTORY_CACHE', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                shared = getattr(settings, 'CHAT_HISTORY_SHARED_CACHE', False)
+                _cache = HistoryCache(shared_alias='default' if shared else None)
+    return _cache
+
+
+def reset_history_cache():
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('CHAT_HISTORY_'):
+        reset_history_cache()
@@ -0,0 +1,160 @@
+from datetime import timedelta
+from functools import wraps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from .identity import presented_client_id
+from .models import IdempotencyRecord
+from .ratelimit import client_ip
+import hashlib
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+POLL_INTERVAL = 0.2  # seconds between checks on an in-flight original
+RETRYABLE_STATUSES = {409, 429}  # "try again later" answers are never replayed
+
+
+def _owner_key(request, key):
+    """The key as stored: scoped to the caller, so clients cannot collide or replay each other's results"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        owner = f'user:{user.pk}'
+    else:
+        # A caller without a token gets a new client id on every request, so a
+        # retry of a request whose response (and token) was lost would never
+        # match: scope those keys by address instead
+        client_id = presented_client_id(request)
+        owner = f'client:{client_id}' if client_id else f'ip:{client_ip(request)}'
+    return hashlib.sha256(f'{owner}|{key}'.encode()).hexdigest()
+
+
+def _pending_lease():
+    """Seconds a pending claim holds its key; a retry after that runs the request again"""
+    lease = getattr(settings, 'IDEMPOTENCY_PENDING_LEASE', None)
+    return lease if lease is not None else 3 * getattr(settings, 'LLM_DEADLINE', 60)
+
+
+def _claim(scope, key, request_hash):
+    """Create a pending record for the key, or return the existing one"""
+    expires_at = timezone.now() + timedelta(seconds=_pending_lease())
+    try:
+        with transaction.atomic():
+            record = IdempotencyRecord.objects.create(
+                scope=scope,
+                key=key,
+                request_hash=request_hash,
+                expires_at=expires_at
+            )
+        return record, True
+    except IntegrityError:
+        pass
+    
+    record = IdempotencyRecord.objects.filter(scope=scope, key=key).first()
+    if record is None or record.expires_at <= timezone.now():
+        # Expired, or a pending claim whose lease ran out (its worker died or
+        # hung), or removed after a failed attempt: take the key over
+        IdempotencyRecord.objects.filter(scope=scope, key=key, expires_at__lte=timezone.now()).delete()
+        return _claim(scope, key, request_hash)
+    return record, False
+
+
+def _wait_for(record):
+    """Wait for an in-flight original to finish, up to IDEMPOTENCY_WAIT_TIMEOUT or the end of its lease"""
+    deadline = time.monotonic() + getattr(settings, 'IDEMPOTENCY_WAIT_TIMEOUT', 60)
+    while (record is not None and record.status == 'pending' and record.expires_at > timezone.now()
+           and time.monotonic() < deadline):
+        time.sleep(POLL_INTERVAL)
+        record = IdempotencyRecord.objects.filter(pk=record.pk).first()
+    return record
+
+
+def _replay(record):
+    response = Response(record.response_body, status=record.response_status)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(scope):
+    """
+    Make a POST view honour the Idempotency-Key header.
+
+    Keys are scoped to the caller (user, anonymous client id, or address for
+    callers without a client token). The first
+    request with a key runs normally and its response is stored for
+    IDEMPOTENCY_KEY_TTL seconds. Retries get the stored response back instead
+    of a second LLM call; a retry arriving while the original is still running
+    waits for it. Until it completes, the original only holds the key for
+    IDEMPOTENCY_PENDING_LEASE seconds, after which a retry takes it over.
+    Server errors, "try again" responses (409/429) and streamed responses are
+    not stored, so those can be retried for real.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if request.method != 'POST' or not key:
+                return view_func(request, *args, **kwargs)
+            
+            if len(key) > 255:
+                return Response({
+                    "error": f"{HEADER} must be at most 255 characters"
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            key = _owner_key(request, key)
+            request_hash = hashlib.sha256(request.body).hexdigest()
+            record, created = _claim(scope, key, request_hash)
+            
+            if not created:
+                if record.request_hash != request_hash:
+                    return Response({
+                        "error": f"{HEADER} was already used for a different request"
+                    }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+                
+                record = _wait_for(record)
+                if record is not None and record.status == 'completed':
+                    return _replay(record)
+                if record is None or record.expires_at <= timezone.now():
+                    # The original gave up or its lease ran out while we waited
+                    record, created = _claim(scope, key, request_hash)
+            
+            if not created:
+                response = Response({
+                    "error": "A request with this idempotency key is still in progress"
+                }, status=status.HTTP_409_CONFLICT)
+                response['Retry-After'] = '1'
+                return response
+            
+            try:
+                response = view_func(request, *args, **kwargs)
+            except Exception:
+                record.delete()
+                raise
+            
+            if (response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES
+                    or not hasattr(response, 'data')):
+                record.delete()
+                return response
+            
+            # Only now is the result kept for the full TTL
+            stored = IdempotencyRecord.objects.filter(pk=record.pk, status='pending').update(
+                status='completed',
+                response_status=response.status_code,
+                response_body=response.data,
+                expires_at=timezone.now() + timedelta(seconds=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 86400))
+            )
+            if not stored:
+                logger.warning(f"Idempotency claim on {scope} expired before the request finished, result not stored")
+            return response
+        return wrapper
+    return decorator
+
+
+def purge_expired_idempotency_keys():
+    """Delete stored idempotency results past their TTL"""
+    deleted, _ = IdempotencyRecord.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
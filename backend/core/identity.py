@@ -0,0 +1,86 @@
+"""
+Stateless identity for anonymous chat clients.
+
+Each browser gets a random client id in a signed, expiring token, sent back
+in a cookie (or the X-Chat-Client header for clients without cookies). Chat
+sessions record the client id that created them, so anonymous users can list
+their own chats without a django_session row being read or written.
+"""
+from django.conf import settings
+from django.core import signing
+from django.utils.deprecation import MiddlewareMixin
+import time
+import uuid
+
+HEADER = 'X-Chat-Client'
+SALT = 'core.identity.client'
+
+
+def _signer():
+    return signing.TimestampSigner(salt=SALT)
+
+
+def _max_age():
+    return getattr(settings, 'CHAT_CLIENT_TOKEN_MAX_AGE', 365 * 86400)
+
+
+def issue_client_token(client_id):
+    """Sign a client id into a token"""
+    return _signer().sign(client_id)
+
+
+def read_client_token(token):
+    """Return (client_id, issued_at) for a valid token, or (None, None)"""
+    if not token:
+        return None, None
+    signer = _signer()
+    try:
+        client_id = signer.unsign(token, max_age=_max_age())
+    except signing.BadSignature:  # Also raised for expired tokens
+        return None, None
+    issued_at = signing.b62_decode(token.rsplit(signer.sep, 2)[-2])
+    return client_id, issued_at
+
+
+def _presented_token(request):
+    return request.headers.get(HEADER) or request.COOKIES.get(settings.CHAT_CLIENT_COOKIE_NAME)
+
+
+def presented_client_id(request):
+    """Client id of a valid token the request carries, or None (unlike get_client_id, never mints one)"""
+    return read_client_token(_presented_token(getattr(request, '_request', request)))[0]
+
+
+def get_client_id(request):
+    """Anonymous identity of the requesting client, minting a new one if it has none"""
+    # State goes on the HttpRequest, where the middleware sees it, not on DRF's wrapper
+    request = getattr(request, '_request', request)
+    client_id = getattr(request, '_client_id', None)
+    if client_id is None:
+        client_id, issued_at = read_client_token(_presented_token(request))
+        if client_id is None:
+            client_id = uuid.uuid4().hex
+            request._client_token_refresh = True
+        elif time.time() - issued_at > _max_age() / 2:
+            # Sliding expiry: active clients never lose their chats
+            request._client_token_refresh = True
+        request._client_id = client_id
+    return client_id
+
+
+class ClientIdentityMiddleware(MiddlewareMixin):
+    """Sends a fresh token when a view minted or renewed the client's identity"""
+
+    def process_response(self, request, response):
+        if getattr(request, '_client_token_refresh', False):
+            token = issue_client_token(request._client_id)
+            response.set_cookie(
+                settings.CHAT_CLIENT_COOKIE_NAME,
+                token,
+                max_age=_max_age(),
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+            response[HEADER] = token
+        return response
@@ -0,0 +1,242 @@
+import google.generativeai as genai
+from google.generativeai import caching
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from .prompt import get_prompt, get_system_instruction
+from .resilience import Deadline, ResilientCaller
+from .tokens import estimate_tokens
+import datetime
+import hashlib
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+PROVIDERS = {
+    'gemini': 'core.llm.GeminiProvider',
+    'fake': 'core.fake_llm.FakeProvider',
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class CachedPrefix:
+    """Handle to a static prompt prefix registered with the provider's context cache"""
+
+    def __init__(self, name, model_name, expires_at):
+        self.name = name
+        self.model_name = model_name
+        self.expires_at = expires_at
+
+
+class GeminiProvider:
+    """Adapter over the google-generativeai SDK"""
+
+    def configure(self, api_key):
+        genai.configure(api_key=api_key)
+
+    def create_model(self, model_name, system_instruction=None, cached_prefix=None, generation_config=None):
+        if cached_prefix is not None:
+            return genai.GenerativeModel.from_cached_content(
+                cached_content=cached_prefix.name,
+                generation_config=generation_config
+            )
+        return genai.GenerativeModel(
+            model_name,
+            system_instruction=system_instruction,
+            generation_config=generation_config
+        )
+
+    def create_cached_prefix(self, model_name, system_instruction, ttl):
+        cached = caching.CachedContent.create(
+            model=model_name,
+            display_name='advisorop-system-prompt',
+            system_instruction=system_instruction,
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+        return CachedPrefix(cached.name, model_name, time.monotonic() + ttl)
+
+
+def get_provider():
+    """Instantiate the provider selected by settings.LLM_PROVIDER"""
+    name = getattr(settings, 'LLM_PROVIDER', 'gemini')
+    return import_string(PROVIDERS.get(name, name))()
+
+
+class PromptCache:
+    """
+    Registers the static system instruction with the provider's context cache
+    once and reuses the handle until the prompt or model changes or it expires.
+
+    Prompts below the provider's minimum cacheable size (min_tokens) are
+    never sent. Registration is a network call made outside the lock by one
+    request at a time; the others meanwhile use the previous handle while it
+    lives, or the uncached model.
+    """
+
+    def __init__(self, provider, ttl, retry_after, min_tokens=0):
+        self.provider = provider
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.min_tokens = min_tokens
+        self._entries = {}
+        self._failures = {}
+        self._registering = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(model_name, system_instruction):
+        return hashlib.sha256(f"{model_name}\0{system_instruction}".encode()).hexdigest()
+
+    def get(self, model_name, system_instruction):
+        """Get a live cache handle, or None when the prefix is not (yet) cached"""
+        if estimate_tokens(system_instruction) < self.min_tokens:
+            return None
+        key = self.fingerprint(model_name, system_instruction)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            # Refresh a little before expiry so in-flight requests never see a dead handle
+            if entry is not None and entry.expires_at - now > 60:
+                return entry
+            if now < self._failures.get(key, 0) or key in self._registering:
+                return entry if entry is not None and entry.expires_at > now else None
+            self._registering.add(key)
+        try:
+            entry = self.provider.create_cached_prefix(model_name, system_instruction, self.ttl)
+        except Exception as e:
+            # e.g. the prompt is below the provider's minimum cacheable size
+            logger.warning(f"Context cache unavailable for {model_name}: {str(e)}")
+            with self._lock:
+                self._failures[key] = time.monotonic() + self.retry_after
+                self._registering.discard(key)
+            return None
+        logger.info(f"Registered system prompt with context cache as {entry.name}")
+        with self._lock:
+            self._entries[key] = entry
+            self._registering.discard(key)
+        return entry
+
+
+class LLMClient:
+    """Configured connection to the LLM provider, shared by all requests in a process"""
+
+    def __init__(self, api_key, provider=None):
+        self.api_key = api_key
+        self.provider = provider or get_provider()
+        # genai.configure drops the SDK's cached transport clients, so it must
+        # only run once per process rather than once per request
+        self.provider.configure(api_key)
+        self.system_prompt = get_prompt()
+        self.system_instruction = get_system_instruction(self.system_prompt)
+        self.prompt_cache = None
+        if getattr(settings, 'LLM_CONTEXT_CACHE', False):
+            self.prompt_cache = PromptCache(
+                self.provider,
+                ttl=getattr(settings, 'LLM_CONTEXT_CACHE_TTL', 3600),
+                retry_after=getattr(settings, 'LLM_CONTEXT_CACHE_RETRY', 600),
+                min_tokens=getattr(settings, 'LLM_CONTEXT_CACHE_MIN_TOKENS', 4096),
+            )
+        # Circuit breakers and latency history outlive requests, like the client
+        self.resilience = ResilientCaller()
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _model(self, key, factory):
+        model = self._models.get(key)
+        if model is None:
+            with self._lock:
+                model = self._models.get(key)
+                if model is None:
+                    model = factory()
+                    self._models[key] = model
+        return model
+
+    def get_model(self, model_name=DEFAULT_MODEL, system_instruction=None, generation_config=None):
+        """Get a warm chat model carrying the system instruction, creating it on first use"""
+        system_instruction = system_instruction or self.system_instruction
+        generation_config = generation_config or None
+        generation_key = tuple(sorted((generation_config or {}).items()))
+        if self.prompt_cache is not None:
+            cached_prefix = self.prompt_cache.get(model_name, system_instruction)
+            if cached_prefix is not None:
+                # One entry per model, replaced when the prefix is refreshed under a new name
+                key = ('cached', model_name, generation_key)
+                current = self._models.get(key)
+                if current is None or current[0] != cached_prefix.name:
+                    with self._lock:
+                        current = self._models.get(key)
+                        if current is None or current[0] != cached_prefix.name:
+                            current = self._models[key] = (cached_prefix.name, self.provider.create_model(
+                                model_name, cached_prefix=cached_prefix, generation_config=generation_config
+                            ))
+                return current[1]
+        return self._model(
+            ('chat', model_name, system_instruction, generation_key),
+            lambda: self.provider.create_model(
+                model_name, system_instruction=system_instruction, generation_config=generation_config
+            )
+        )
+
+    def get_utility_model(self, model_name=DEFAULT_MODEL):
+        """Get a model without the chat persona, for internal tasks like summaries"""
+        return self._model(('utility', model_name), lambda: self.provider.create_model(model_name))
+
+    def summarize(self, prompt, model_name=None, deadline=None):
+        """
+        Generate a summary for the context window.
+
+        It runs on the chat turn's critical path, so it goes through the same
+        retries, breaker and deadline as the reply (not hedged: summaries would
+        skew the reply latency the hedge delay is taken from).
+        """
+        def attempt(name, timeout):
+            return self.get_utility_model(name).generate_content(prompt, request_options={'timeout': timeout})
+
+        deadline = deadline or Deadline(getattr(settings, 'LLM_DEADLINE', 60))
+        response = self.resilience.call(model_name or DEFAULT_MODEL, attempt, deadline, hedge=False)
+        return response.text.strip()
+
+    async def asummarize(self, prompt, model_name=None, deadline=None):
+        """Generate a summary for the context window (async)"""
+        async def attempt(name, timeout):
+            return await self.get_utility_model(name).generate_content_async(
+                prompt, request_options={'timeout': timeout}
+            )
+
+        deadline = deadline or Deadline(getattr(settings, 'LLM_DEADLINE', 60))
+        response = await self.resilience.acall(model_name or DEFAULT_MODEL, attempt, deadline, hedge=False)
+        return response.text.strip()
+
+
+def get_llm_client():
+    """Get the process-wide LLM client, building it lazily on first use"""
+    global _client
+    client = _client
+    if client is None:
+        with _client_lock:
+            if _client is None:
+                logger.info("Initialising LLM client")
+                _client = LLMClient(settings.GEMINI_API_KEY)
+            client = _client
+    return client
+
+
+def reset_llm_client():
+    """Discard the process-wide client so the next request rebuilds it"""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_changed(sender, setting, **kwargs):
+    """Rebuild the client when provider settings change (e.g. override_settings)"""
+    if setting == 'GEMINI_API_KEY' or setting.startswith('LLM_'):
+        reset_llm_client()
@@ -0,0 +1,98 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import ChatSession
+import asyncio
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05  # initial delay between attempts, doubled up to MAX_POLL_INTERVAL
+MAX_POLL_INTERVAL = 0.5
+
+
+class TurnLockTimeout(Exception):
+    """Raised when a session's in-flight turn did not finish within the wait budget"""
+
+
+class SessionTurnLock:
+    """
+    Serialises chat turns on one session across threads and worker processes.
+
+    The lock is a lease stored on the session row and taken with a single
+    conditional UPDATE, so it works on every database backend without holding
+    a transaction open for the length of the LLM call. A lease left behind by
+    a crashed worker expires after CHAT_TURN_LOCK_LEASE seconds. Later turns
+    poll for the lease for up to CHAT_TURN_LOCK_WAIT seconds.
+    """
+    
+    def __init__(self, session, wait_timeout=None, lease=None):
+        self.session = session
+        self.wait_timeout = wait_timeout if wait_timeout is not None else getattr(settings, 'CHAT_TURN_LOCK_WAIT', 30)
+        self.lease = lease or getattr(settings, 'CHAT_TURN_LOCK_LEASE', 180)
+        self.token = None
+    
+    def _claim_query(self):
+        now = timezone.now()
+        self.token = uuid.uuid4().hex
+        claimable = ChatSession.objects.filter(pk=self.session.pk).filter(
+            Q(turn_locked_until__isnull=True) | Q(turn_locked_until__lt=now)
+        )
+        return claimable, {'turn_lock_token': self.token, 'turn_locked_until': now + timedelta(seconds=self.lease)}
+    
+    def _release_query(self):
+        return ChatSession.objects.filter(pk=self.session.pk, turn_lock_token=self.token), {
+            'turn_lock_token': '',
+            'turn_locked_until': None,
+        }
+    
+    def _timeout(self):
+        logger.warning(f"Timed out waiting for turn lock on session {self.session.pk}")
+        return TurnLockTimeout("Another message in this chat is still being answered")
+    
+    def acquire(self):
+        deadline = time.monotonic() + self.wait_timeout
+        delay = POLL_INTERVAL
+        while True:
+            claimable, values = self._claim_query()
+            if claimable.update(**values):
+                return self
+            if time.monotonic() + delay > deadline:
+                raise self._timeout()
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+    
+    def release(self):
+        release, values = self._release_query()
+        release.update(**values)
+    
+    async def aacquire(self):
+        deadline = time.monotonic() + self.wait_timeout
+        delay = POLL_INTERVAL
+        while True:
+            claimable, values = self._claim_query()
+            if await claimable.aupdate(**values):
+                return self
+            if time.monotonic() + delay > deadline:
+                raise self._timeout()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+    
+    async def arelease(self):
+        release, values = self._release_query()
+        await release.aupdate(**values)
+    
+    def __enter__(self):
+        return self.acquire()
+    
+    def __exit__(self, *exc_info):
+        self.release()
+    
+    async def __aenter__(self):
+        return await self.aacquire()
+    
+    async def __aexit__(self, *exc_info):
+        await self.arelease()
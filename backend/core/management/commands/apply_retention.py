@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from core.idempotency import purge_expired_idempotency_keys
+from core.retention import RetentionPolicy, apply_retention, retention_stats
+
+
+class Command(BaseCommand):
+    help = 'Delete chat sessions that fall outside the retention policies (archived sessions are kept)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be deleted without deleting anything',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Number of sessions to delete per transaction',
+        )
+
+    def handle(self, *args, **options):
+        policy = RetentionPolicy.from_settings()
+        if options['chunk_size']:
+            policy.chunk_size = options['chunk_size']
+
+        if options['dry_run']:
+            stats = retention_stats(policy)
+            verb = 'would delete'
+        else:
+            stats = apply_retention(policy)
+            verb = 'deleted'
+            purged = purge_expired_idempotency_keys()
+            self.stdout.write(f'Purged {purged} expired idempotency keys')
+
+        if not stats:
+            self.stdout.write(self.style.WARNING('No retention policies are enabled'))
+            return
+
+        for name, counts in stats.items():
+            self.stdout.write(
+                f"{name}: {verb} {counts['sessions']} sessions, {counts['messages']} messages"
+            )
+        self.stdout.write(self.style.SUCCESS('Retention run completed'))
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from core.formatting import MarkdownFormatter, format_markdown
+import timeit
+
+PARAGRAPH = (
+    "It sounds like **a lot** is happening right now, and that's *completely* understandable. "
+    "Some people find it helpful to:\n"
+    "- **Name** the feeling as it comes up\n"
+    "- Notice what *usually* happens just before it\n"
+    "1. Write down one small step\n"
+    "2. Try it for a day & see how it feels\n\n"
+)
+
+
+def legacy_format(message):
+    """The replace-in-a-loop formatter this module replaced, kept for comparison"""
+    while "**" in message:
+        message = message.replace("**", "<strong>", 1)
+        if "**" in message:
+            message = message.replace("**", "</strong>", 1)
+    return message
+
+
+def format_streamed(text, chunk_size):
+    formatter = MarkdownFormatter()
+    parts = [formatter.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    parts.append(formatter.finish())
+    return ''.join(parts)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the response formatter on long replies'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[2000, 20000, 100000],
+            help='Reply lengths to benchmark, in characters',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs per measurement; the fastest is reported',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=8,
+            help='Characters per chunk when simulating a streamed reply',
+        )
+        parser.add_argument(
+            '--skip-legacy',
+            action='store_true',
+            help='Do not time the old formatter (slow on long replies)',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        self.stdout.write(f'{"chars":>8} {"markers":>8} {"format":>10} {"streamed":>10} {"legacy":>10}')
+
+        for size in options['sizes']:
+            text = (PARAGRAPH * (size // len(PARAGRAPH) + 1))[:size]
+            results = [
+                self.best(lambda: format_markdown(text), options['repeat']),
+                self.best(lambda: format_streamed(text, chunk_size), options['repeat']),
+            ]
+            if options['skip_legacy']:
+                results.append(None)
+            else:
+                results.append(self.best(lambda: legacy_format(text), options['repeat']))
+
+            timings = ' '.join(f'{self.ms(seconds):>10}' for seconds in results)
+            self.stdout.write(f'{size:>8} {text.count("*"):>8} {timings}')
+
+        self.stdout.write(self.style.SUCCESS('Times are milliseconds per reply (best run)'))
+
+    def best(self, func, repeat):
+        return min(timeit.repeat(func, number=1, repeat=repeat))
+
+    def ms(self, seconds):
+        return '-' if seconds is None else f'{seconds * 1000:.2f}'
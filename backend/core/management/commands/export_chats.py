@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
+from core.transfer import export_records, filter_sessions, gzip_stream
+import datetime
+import json
+import sys
+
+
+def parse_when(value):
+    """A date or datetime option as an aware datetime"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f'Invalid date: {value}')
+        parsed = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = 'Export chat sessions and their messages as gzip-compressed JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            help="File to write, or '-' for standard output",
+        )
+        parser.add_argument(
+            '--user',
+            help='Only sessions of this username',
+        )
+        parser.add_argument(
+            '--since',
+            help='Only sessions updated on or after this date (YYYY-MM-DD or ISO datetime)',
+        )
+        parser.add_argument(
+            '--until',
+            help='Only sessions updated before this date',
+        )
+        parser.add_argument(
+            '--archived',
+            choices=['only', 'exclude'],
+            help='Only archived sessions, or none of them',
+        )
+
+    def handle(self, *args, **options):
+        archived = {'only': True, 'exclude': False}.get(options['archived'])
+        sessions = filter_sessions(
+            username=options['user'],
+            since=parse_when(options['since']) if options['since'] else None,
+            until=parse_when(options['until']) if options['until'] else None,
+            archived=archived,
+        )
+
+        sessions_written = messages_written = 0
+
+        def lines():
+            nonlocal sessions_written, messages_written
+            for record in export_records(sessions):
+                if record['kind'] == 'session':
+                    sessions_written += 1
+                elif record['kind'] == 'message':
+                    messages_written += 1
+                yield json.dumps(record, ensure_ascii=False) + '\n'
+
+        if options['output'] == '-':
+            out = sys.stdout.buffer
+            for chunk in gzip_stream(lines()):
+                out.write(chunk)
+            out.flush()
+        else:
+            with open(options['output'], 'wb') as out:
+                for chunk in gzip_stream(lines()):
+                    out.write(chunk)
+            self.stdout.write(self.style.SUCCESS(
+                f'Exported {sessions_written} sessions, {messages_written} messages to {options["output"]}'
+            ))
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.transfer import ChatImporter, ImportFormatError
+import gzip
+import io
+import sys
+
+
+class Command(BaseCommand):
+    help = 'Import chat sessions from an export_chats file; sessions that already exist are skipped'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input',
+            help="gzip JSON Lines file written by export_chats, or '-' for standard input",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Messages inserted per bulk_create',
+        )
+        parser.add_argument(
+            '--create-users',
+            action='store_true',
+            help='Create missing users (inactive, without a password) instead of importing their sessions as anonymous',
+        )
+
+    def handle(self, *args, **options):
+        raw = sys.stdin.buffer if options['input'] == '-' else open(options['input'], 'rb')
+        importer = ChatImporter(batch_size=options['batch_size'], create_users=options['create_users'])
+        try:
+            with io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding='utf-8') as lines:
+                stats = importer.run(lines)
+        except (ImportFormatError, OSError, ValueError) as e:
+            stats = importer.stats
+            raise CommandError(
+                f"Import stopped after {stats['sessions']} sessions: {e}. "
+                f"Run it again to resume; imported sessions are skipped."
+            )
+        finally:
+            if raw is not sys.stdin.buffer:
+                raw.close()
+
+        self.stdout.write(
+            f"Imported {stats['sessions']} sessions, {stats['messages']} messages; "
+            f"skipped {stats['skipped']} existing sessions"
+        )
+        if stats['unknown_users']:
+            self.stdout.write(self.style.WARNING(
+                f"{stats['unknown_users']} sessions belonged to unknown users and were imported without one "
+                f"(use --create-users to create them)"
+            ))
+        self.stdout.write(self.style.SUCCESS('Import completed'))
@@ -0,0 +1,121 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand, CommandError
+from core.profiling import issue_profile_token, profile_dir, HEADER
+import json
+import os
+import pstats
+import tracemalloc
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = 'Aggregate sampled request profiles into hotspots per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dir',
+            help='Directory of samples (default: PROFILING_DIR)',
+        )
+        parser.add_argument(
+            '--view',
+            help='Only report this view name (e.g. core:chat-api)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=15,
+            help='Functions (and allocation sites) to list per endpoint',
+        )
+        parser.add_argument(
+            '--sort',
+            choices=['cumulative', 'tottime', 'ncalls'],
+            default='cumulative',
+            help='Order of the function listing',
+        )
+        parser.add_argument(
+            '--issue-token',
+            action='store_true',
+            help=f'Print a signed {HEADER} header value that profiles the requests sending it, and exit',
+        )
+        parser.add_argument(
+            '--memory',
+            action='store_true',
+            help='With --issue-token, also take tracemalloc snapshots',
+        )
+
+    def handle(self, *args, **options):
+        if options['issue_token']:
+            self.stdout.write(f'{HEADER}: {issue_profile_token(memory=options["memory"])}')
+            return
+
+        directory = options['dir'] or profile_dir()
+        if not os.path.isdir(directory):
+            raise CommandError(f'No profiles found in {directory}')
+
+        samples = defaultdict(list)
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            stem = os.path.join(directory, name[:-len('.json')])
+            try:
+                with open(f'{stem}.json') as summary:
+                    sample = json.load(summary)
+            except (OSError, ValueError):
+                continue  # Being rotated away or half-written
+            if options['view'] and sample['view'] != options['view']:
+                continue
+            sample['stem'] = stem
+            samples[sample['view']].append(sample)
+
+        if not samples:
+            self.stdout.write(self.style.WARNING(f'No profiles found in {directory}'))
+            return
+
+        # Endpoints that take the most time in total first
+        for view, group in sorted(samples.items(), key=lambda item: -sum(s['seconds'] for s in item[1])):
+            seconds = [sample['seconds'] for sample in group]
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'{view}: {len(group)} samples, mean {sum(seconds) / len(seconds) * 1000:.1f} ms, '
+                f'p95 {percentile(seconds, 0.95) * 1000:.1f} ms, max {max(seconds) * 1000:.1f} ms'
+            ))
+            self.report_cpu(group, options)
+            self.report_memory(group, options['limit'])
+
+    def report_cpu(self, group, options):
+        files = [f"{sample['stem']}.prof" for sample in group if os.path.exists(f"{sample['stem']}.prof")]
+        if not files:
+            return
+        stats = pstats.Stats(*files, stream=self.stdout)
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+
+    def report_memory(self, group, limit):
+        sizes = defaultdict(int)
+        counts = defaultdict(int)
+        snapshots = 0
+        for sample in group:
+            path = f"{sample['stem']}.snapshot"
+            if not os.path.exists(path):
+                continue
+            snapshots += 1
+            for statistic in tracemalloc.Snapshot.load(path).statistics('lineno'):
+                frame = statistic.traceback[0]
+                sizes[(frame.filename, frame.lineno)] += statistic.size
+                counts[(frame.filename, frame.lineno)] += statistic.count
+        if not snapshots:
+            return
+
+        peaks = [sample['peak_memory'] for sample in group if sample.get('peak_memory')]
+        self.stdout.write(
+            f'Memory held at the end of the request ({snapshots} snapshots, '
+            f'peak {max(peaks, default=0) / 1024:.1f} KiB):'
+        )
+        for (filename, lineno), size in sorted(sizes.items(), key=lambda item: -item[1])[:limit]:
+            self.stdout.write(
+                f'{size / snapshots / 1024:>10.1f} KiB {counts[(filename, lineno)] / snapshots:>8.0f} blocks  '
+                f'{filename}:{lineno}'
+            )
+        self.stdout.write('')
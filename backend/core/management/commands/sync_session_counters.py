@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from core.models import ChatSession, ChatMessage
+
+COUNTER_FIELDS = [
+    'message_count',
+    'user_message_count',
+    'ai_message_count',
+    'total_characters',
+    'last_message_at',
+    'last_message_preview',
+]
+
+
+class Command(BaseCommand):
+    help = 'Backfill or verify the denormalised message counters on chat sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report sessions whose counters are out of date',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of sessions to process per batch',
+        )
+
+    def handle(self, *args, **options):
+        check_only = options['check']
+        batch_size = options['batch_size']
+
+        last_message = ChatMessage.objects.filter(
+            session=OuterRef('pk')
+        ).order_by('-timestamp', '-id')
+        sessions = ChatSession.objects.annotate(
+            actual_message_count=Count('messages'),
+            actual_user_message_count=Count('messages', filter=Q(messages__message_type='user')),
+            actual_ai_message_count=Count('messages', filter=Q(messages__message_type='ai')),
+            actual_total_characters=Coalesce(Sum('messages__character_count'), Value(0)),
+            actual_last_message_at=Max('messages__timestamp'),
+            actual_last_content=Subquery(last_message.values('content')[:1]),
+        ).order_by('pk')
+
+        checked = 0
+        stale = []
+        fixed = 0
+        for session in sessions.iterator(chunk_size=batch_size):
+            checked += 1
+            expected = {
+                'message_count': session.actual_message_count,
+                'user_message_count': session.actual_user_message_count,
+                'ai_message_count': session.actual_ai_message_count,
+                'total_characters': session.actual_total_characters,
+                'last_message_at': session.actual_last_message_at,
+                'last_message_preview': ChatSession.make_preview(session.actual_last_content or ''),
+            }
+            mismatched = [field for field in COUNTER_FIELDS if getattr(session, field) != expected[field]]
+            if not mismatched:
+                continue
+
+            if check_only:
+                self.stdout.write(
+                    self.style.WARNING(f'{session.session_key}: stale {", ".join(mismatched)}')
+                )
+                stale.append(session)
+                continue
+
+            for field, value in expected.items():
+                setattr(session, field, value)
+            stale.append(session)
+            if len(stale) >= batch_size:
+                fixed += self.save_batch(stale, batch_size)
+                stale = []
+
+        if check_only:
+            style = self.style.WARNING if stale else self.style.SUCCESS
+            self.stdout.write(style(f'Checked {checked} sessions, {len(stale)} out of date'))
+            return
+
+        if stale:
+            fixed += self.save_batch(stale, batch_size)
+        self.stdout.write(
+            self.style.SUCCESS(f'Checked {checked} sessions, updated {fixed}')
+        )
+
+    def save_batch(self, sessions, batch_size):
+        """Write corrected counters without touching updated_at"""
+        ChatSession.objects.bulk_update(sessions, COUNTER_FIELDS, batch_size=batch_size)
+        return len(sessions)
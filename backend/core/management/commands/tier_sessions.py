@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.cold_storage import TieringPolicy, storage_report, thaw_session, tier_sessions
+from core.models import ChatSession
+
+
+def human(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GiB'
+
+
+class Command(BaseCommand):
+    help = 'Move idle chat sessions to compressed cold storage and report the space saved'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be moved without moving anything',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Maximum number of sessions to move in this run',
+        )
+        parser.add_argument(
+            '--report',
+            action='store_true',
+            help='Only print the size of the hot and cold tiers',
+        )
+        parser.add_argument(
+            '--thaw',
+            metavar='SESSION_KEY',
+            help='Restore one session from cold storage',
+        )
+
+    def handle(self, *args, **options):
+        if options['thaw']:
+            try:
+                session = ChatSession.objects.get(session_key=options['thaw'])
+            except ChatSession.DoesNotExist:
+                raise CommandError(f"Session {options['thaw']} not found")
+            thaw_session(session)
+            self.stdout.write(self.style.SUCCESS(f"Session {options['thaw']} is in the message table"))
+            return
+
+        policy = TieringPolicy.from_settings()
+        if not options['report'] and not options['dry_run']:
+            moved = tier_sessions(policy, limit=options['limit'])
+            self.stdout.write(
+                f"Moved {moved['sessions']} sessions ({moved['messages']} messages), "
+                f"{human(moved['raw_bytes'])} packed into {human(moved['compressed_bytes'])}; "
+                f"skipped {moved['skipped']} busy sessions"
+            )
+
+        report = storage_report(policy)
+        self.stdout.write(f"Hot: {report['hot_messages']} messages, {human(report['hot_characters'])} of text")
+        self.stdout.write(
+            f"Cold: {report['cold_sessions']} sessions, {report['cold_messages']} messages, "
+            f"{human(report['cold_raw_bytes'])} stored in {human(report['cold_compressed_bytes'])} "
+            f"(saved {human(report['saved_bytes'])}, ratio {report['ratio'] or '-'})"
+        )
+        verb = 'Would move' if options['dry_run'] or options['report'] else 'Still due'
+        self.stdout.write(
+            f"{verb}: {report['candidate_sessions']} sessions, {report['candidate_messages']} messages"
+        )
+        if not options['report']:
+            self.stdout.write(self.style.SUCCESS('Tiering run completed'))
@@ -0,0 +1,273 @@
+"""
+Request and chat-turn metrics.
+
+MetricsMiddleware times every request and counts its database queries; the
+chat services time each stage of a turn with stage(). The results go to
+in-process histograms exposed in the Prometheus text format at /api/metrics/,
+and, for non-streamed responses, to a Server-Timing header so a slow turn
+can be read straight from the browser's network panel.
+
+Metrics are per process: with several workers, scrape each one (or run one
+worker per container). Gauges for in-flight generations and the write-behind
+queue are read when the endpoint is scraped, for use by autoscalers.
+"""
+from asgiref.sync import iscoroutinefunction
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.decorators import sync_and_async_middleware
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_current = ContextVar('core_request_timings', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, labels, value) triples for the exposition"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [('', key, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """Gauge whose value is read from `function` at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not self.labelnames:
+            return [('', (), value)]
+        # Labelled gauges return {label value: value}
+        return [('', ((self.labelnames[0], label),), sample) for label, sample in sorted(value.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        samples = []
+        for key, values in sorted(series.items()):
+            for bound, count in zip(self.buckets, values):
+                samples.append(('_bucket', key + (('le', _format_value(float(bound))),), count))
+            samples.append(('_bucket', key + (('le', '+Inf'),), values[-1]))
+            samples.append(('_sum', key, values[-2]))
+            samples.append(('_count', key, values[-1]))
+        return samples
+
+
+REGISTRY = []
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Time to produce a response (streamed bodies excluded), by view',
+    ['view', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries',
+    'Database queries issued per request, by view',
+    ['view'],
+    buckets=QUERY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    'chat_stage_duration_seconds',
+    'Time spent in each stage of a chat turn',
+    ['stage'],
+)
+TURNS = Counter('chat_turns_total', 'Chat turns handled, by outcome', ['outcome'])
+LLM_CALLS = Counter('llm_calls_total', 'Model call outcomes (calls, retries, hedges, fallbacks...), by event', ['event'])
+HISTORY_CACHE_LOOKUPS = Counter('chat_history_cache_lookups_total', 'History cache lookups, by result', ['result'])
+
+
+def _inflight_generations():
+    from .ratelimit import inflight_generations
+    return inflight_generations()
+
+
+def _write_behind_depth():
+    from . import persistence
+    buffer = persistence._buffer
+    return buffer.depth() if buffer is not None else 0
+
+
+def _open_circuits():
+    from . import llm
+    client = llm._client
+    if client is None:
+        return 0
+    return sum(1 for breaker in client.resilience.breakers().values() if breaker.state != 'closed')
+
+
+Gauge('chat_inflight_generations', 'Replies being generated by this process', _inflight_generations)
+Gauge('chat_write_behind_queue_depth', 'Chat turns waiting to be written to the database', _write_behind_depth)
+Gauge('llm_open_circuits', 'Models whose circuit breaker is open or half-open', _open_circuits)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class RequestTimings:
+    """Stage durations and database queries of the request being served"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def server_timing(self):
+        entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        entries.append(f'db;dur={self.query_seconds * 1000:.1f};desc="{self.queries} queries"')
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def record_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of a chat turn (works around sync and async code alike)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def _count_query(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.queries += 1
+        timings.query_seconds += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def _install_query_counter(sender, connection, **kwargs):
+    # Every connection, including those of sync_to_async threads, which see
+    # the request's timings through the copied context
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def _start():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def _finish(request, response, timings, token):
+    _current.reset(token)
+    match = request.resolver_match
+    view = match.view_name if match is not None else 'unmatched'
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - timings.started,
+        view=view, method=request.method, status=response.status_code
+    )
+    REQUEST_QUERIES.observe(timings.queries, view=view)
+    if not response.streaming:
+        response['Server-Timing'] = timings.server_timing()
+    return response
+
+
+@sync_and_async_middleware
+def MetricsMiddleware(get_response):
+    """Times requests, counts their queries and adds a Server-Timing header"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings, token = _start()
+            response = await get_response(request)
+            return _finish(request, response, timings, token)
+    else:
+        def middleware(request):
+            timings, token = _start()
+            response = get_response(request)
+            return _finish(request, response, timings, token)
+    return middleware
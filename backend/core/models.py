@@ -1,47 +1,77 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.html import strip_tags
+from .formatting import to_markdown
+from .tokens import estimate_tokens
+
+PREVIEW_LENGTH = 100
 
 
 class ChatSession(models.Model):
     """Model to store chat sessions"""
-    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, db_index=False)  # Covered by Meta.indexes
     session_key = models.CharField(max_length=40, unique=True)
+    client_id = models.CharField(max_length=32, blank=True, default='')  # Anonymous owner, see core/identity.py
     title = models.CharField(max_length=200, blank=True, null=True)  # Session name from first message
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     is_archived = models.BooleanField(default=False)  # Archived sessions are kept forever
+    is_cold = models.BooleanField(default=False)  # Messages packed into a ColdTranscript, see core/cold_storage.py
+    summary = models.TextField(blank=True, default='')  # Rolling summary of turns outside the context window
+    summary_last_message_id = models.BigIntegerField(null=True, blank=True)  # Last message folded into summary
+    
+    # Denormalised counters, maintained by ChatMessage.save() so listings need no per-session queries
+    message_count = models.IntegerField(default=0)
+    user_message_count = models.IntegerField(default=0)
+    ai_message_count = models.IntegerField(default=0)
+    total_characters = models.IntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+    
+    # Lease that serialises concurrent turns on this session (see core/locks.py)
+    turn_lock_token = models.CharField(max_length=32, blank=True, default='')
+    turn_locked_until = models.DateTimeField(null=True, blank=True)
     
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Session lookup by key (get_or_create_session, history, archive)
+            models.Index(fields=['session_key', 'is_active'], name='chatsession_key_active_idx'),
+            # Sidebar listing of recent sessions
+            models.Index(fields=['is_active', '-updated_at'], name='chatsession_active_recent_idx'),
+            models.Index(fields=['-updated_at'], name='chatsession_recent_idx'),
+            # Per-user listings and the session limit
+            models.Index(fields=['user', '-updated_at'], name='chatsession_user_recent_idx'),
+            models.Index(fields=['user', 'is_archived', 'is_active', '-updated_at'], name='chatsession_user_arch_idx'),
+            # Sidebar listing for anonymous clients
+            models.Index(fields=['client_id', '-updated_at'], name='chatsession_client_recent_idx'),
+        ]
     
     def __str__(self):
         return f"Chat Session {self.id} - {self.title or 'Untitled'}"
     
-    def get_title(self):
-        """Get session title from first user message or return default"""
-        if self.title:
-            return self.title
-        
-        first_message = self.messages.filter(message_type='user').first()
-        if first_message:
-            # Use first 50 characters of first message as title
-            title = first_message.content[:50]
-            if len(first_message.content) > 50:
-                title += "..."
-            return title
-        
-        return "New Chat"
+    @staticmethod
+    def make_title(content):
+        """Use first 50 characters of a message as title"""
+        title = content[:50]
+        if len(content) > 50:
+            title += "..."
+        return title
     
-    def save(self, *args, **kwargs):
-        # Auto-generate title from first message if not set
-        if not self.title and self.pk:
-            first_message = self.messages.filter(message_type='user').first()
-            if first_message:
-                self.title = first_message.content[:50]
-                if len(first_message.content) > 50:
-                    self.title += "..."
-        super().save(*args, **kwargs)
+    @staticmethod
+    def make_preview(content):
+        """Plain-text preview of a message for session listings"""
+        text = ' '.join(strip_tags(content).split())
+        if len(text) > PREVIEW_LENGTH:
+            text = text[:PREVIEW_LENGTH - 3] + "..."
+        return text
+    
+    def get_title(self):
+        """Get session title (set from the first user message) or return default"""
+        return self.title or "New Chat"
 
 
 class ChatMessage(models.Model):
@@ -52,24 +82,113 @@ class ChatMessage(models.Model):
         ('system', 'System'),
     )
     
-    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
+    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages', db_index=False)  # Covered by Meta.indexes
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)  # Settable so buffered writes keep arrival time
     character_count = models.IntegerField(default=0)
+    token_count = models.IntegerField(default=0)  # Estimated model tokens
+    plain_content = models.TextField(blank=True, default='')  # What search indexes: replies without their HTML
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Transcript reads and keyset pagination within a session
+            models.Index(fields=['session', 'timestamp', 'id'], name='chatmessage_session_ts_idx'),
+        ]
     
-    def save(self, *args, **kwargs):
+    @staticmethod
+    def plain_text(message_type, content):
+        """Text of a message as search sees it: replies are stored as formatter HTML"""
+        return to_markdown(content) if message_type == 'ai' else content
+    
+    def fill_counts(self):
+        """Set the cached character and token counts and the plain text"""
         if not self.character_count:
             self.character_count = len(self.content)
-        super().save(*args, **kwargs)
+        if not self.token_count:
+            self.token_count = estimate_tokens(self.content)
+        self.plain_content = self.plain_text(self.message_type, self.content)
+    
+    def save(self, *args, **kwargs):
+        self.fill_counts()
+        
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            ChatMessage.update_session_counters([self])
+    
+    @staticmethod
+    def update_session_counters(messages):
+        """Atomically add newly inserted messages to their sessions' denormalised counters.
+        
+        Issues one UPDATE per session however many messages it received, and
+        must run in the transaction that inserted them.
+        """
+        by_session = {}
+        for message in messages:
+            by_session.setdefault(message.session_id, []).append(message)
+        
+        for session_id, added in by_session.items():
+            last = added[-1]
+            user_count = sum(1 for message in added if message.message_type == 'user')
+            ai_count = sum(1 for message in added if message.message_type == 'ai')
+            characters = sum(message.character_count for message in added)
+            preview = ChatSession.make_preview(last.content)
+            changes = {
+                'message_count': F('message_count') + len(added),
+                'user_message_count': F('user_message_count') + user_count,
+                'ai_message_count': F('ai_message_count') + ai_count,
+                'total_characters': F('total_characters') + characters,
+                'last_message_at': last.timestamp,
+                'last_message_preview': preview,
+                'updated_at': last.timestamp,
+            }
+            title = None
+            first_user = next((message for message in added if message.message_type == 'user'), None)
+            if first_user is not None:
+                # Name untitled sessions after their first user message, in the same UPDATE
+                title = ChatSession.make_title(first_user.content)
+                changes['title'] = Case(
+                    When(Q(title__isnull=True) | Q(title=''), then=Value(title)),
+                    default=F('title'),
+                )
+            ChatSession.objects.filter(pk=session_id).update(**changes)
+            
+            # Keep an already-loaded session object in step so later saves don't clobber the counters
+            if ChatMessage.session.is_cached(last):
+                session = last.session
+                session.message_count += len(added)
+                session.user_message_count += user_count
+                session.ai_message_count += ai_count
+                session.total_characters += characters
+                session.last_message_at = last.timestamp
+                session.last_message_preview = preview
+                session.updated_at = last.timestamp
+                if title and not session.title:
+                    session.title = title
     
     def __str__(self):
         return f"{self.message_type}: {self.content[:50]}..."
 
 
+class ColdTranscript(models.Model):
+    """All messages of an idle session, packed into one compressed blob"""
+    session = models.OneToOneField(ChatSession, on_delete=models.CASCADE, primary_key=True, related_name='cold_transcript')
+    codec = models.CharField(max_length=10)
+    data = models.BinaryField()
+    message_count = models.IntegerField()
+    raw_bytes = models.IntegerField()  # Size of the serialised messages before compression
+    compressed_bytes = models.IntegerField()
+    frozen_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"Cold transcript of session {self.session_id} ({self.message_count} messages)"
+
+
 class AIConfig(models.Model):
     """Model to store AI configuration settings"""
     name = models.CharField(max_length=100, unique=True)
@@ -86,3 +205,31 @@ class AIConfig(models.Model):
     
     def __str__(self):
         return f"AI Config: {self.name}"
+
+
+class IdempotencyRecord(models.Model):
+    """Stored outcome of a chat POST, replayed when a client retries with the same Idempotency-Key"""
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('completed', 'Completed'),
+    )
+    
+    scope = models.CharField(max_length=50)  # Endpoint the key was used on
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    response_status = models.IntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expires_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.scope}:{self.key} ({self.status})"
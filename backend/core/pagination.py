@@ -0,0 +1,103 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+import base64
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(message):
+    """Encode a message's (timestamp, id) position as an opaque cursor"""
+    raw = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (timestamp, id), raising ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, message_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError
+        return parsed, int(message_id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def parse_page_size(value):
+    """Parse a requested page size, clamped to MAX_PAGE_SIZE"""
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError("page_size must be positive")
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+def before_position(timestamp, message_id):
+    """Filter for messages strictly before a (timestamp, id) position"""
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+
+
+def after_position(timestamp, message_id):
+    """Filter for messages strictly after a (timestamp, id) position"""
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+
+
+def paginate_messages(queryset, before=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Keyset-paginate messages on (timestamp, id).
+
+    Without a cursor the newest page is returned. `before` pages towards
+    older messages and `after` towards newer ones. Messages are always
+    returned oldest first, together with cursors for the neighbouring pages.
+    """
+    if before and after:
+        raise ValueError("Use either before or after, not both")
+    
+    if after:
+        position = decode_cursor(after)
+        rows = list(queryset.filter(after_position(*position)).order_by('timestamp', 'id')[:page_size + 1])
+        has_newer = len(rows) > page_size
+        page = rows[:page_size]
+        has_older = True
+    else:
+        if before:
+            queryset = queryset.filter(before_position(*decode_cursor(before)))
+        rows = list(queryset.order_by('-timestamp', '-id')[:page_size + 1])
+        has_older = len(rows) > page_size
+        page = list(reversed(rows[:page_size]))
+        has_newer = bool(before)
+    
+    return _page(page, has_older, has_newer)
+
+
+def paginate_message_list(messages, before=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+    """paginate_messages over a list of messages, oldest first (e.g. a cold transcript)"""
+    if before and after:
+        raise ValueError("Use either before or after, not both")
+    
+    if after:
+        position = decode_cursor(after)
+        rows = [m for m in messages if (m.timestamp, m.id) > position]
+        page = rows[:page_size]
+        has_newer = len(rows) > page_size
+        has_older = True
+    else:
+        if before:
+            position = decode_cursor(before)
+            messages = [m for m in messages if (m.timestamp, m.id) < position]
+        page = messages[-page_size:]
+        has_older = len(messages) > page_size
+        has_newer = bool(before)
+    
+    return _page(page, has_older, has_newer)
+
+
+def _page(page, has_older, has_newer):
+    return {
+        'messages': page,
+        'previous_cursor': encode_cursor(page[0]) if page and has_older else None,
+        'next_cursor': encode_cursor(page[-1]) if page and has_newer else None,
+    }
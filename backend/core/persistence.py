@@ -0,0 +1,261 @@
+"""
+Persistence of chat turns.
+
+A turn (the user's message and the reply) is written once the reply is
+known: both messages and the session's counters go in one transaction, so a
+turn costs one commit instead of one per row. CHAT_PERSISTENCE_MODE picks the
+durability guarantee:
+
+- 'sync' (default): the turn is committed before the response is sent.
+- 'group': turns are queued and group-committed from many sessions at once
+  with bulk_create every CHAT_WRITE_BEHIND_INTERVAL seconds. The request still
+  waits for its commit, so a response is never sent for an unsaved turn, but
+  concurrent turns share one transaction and one write lock.
+- 'async': as 'group', but the request does not wait. Turns still queued when
+  the process dies are lost; a clean shutdown flushes them.
+
+In the buffered modes the session's turn lock (core/locks.py) is released only
+after the turn is committed, so the next turn on that session always sees it.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+from .history_cache import get_history_cache
+from .models import ChatMessage
+import atexit
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sync', 'group', 'async')
+COMMIT_TIMEOUT = 60  # seconds a 'group' request waits for its commit
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+class Turn:
+    """Messages of one chat turn, plus the turn lock to release once they are stored"""
+
+    def __init__(self, session, messages, lock=None):
+        self.session = session
+        self.messages = messages
+        self.lock = lock
+        self.error = None
+        self._done = threading.Event()
+
+    def complete(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Block until the turn is committed, re-raising the commit error if any"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Chat turn was not persisted in time")
+        if self.error is not None:
+            raise self.error
+
+
+def build_message(session, message_type, content, timestamp=None):
+    """Unsaved ChatMessage with its counts filled in, ready for bulk insertion"""
+    message = ChatMessage(
+        session=session,
+        message_type=message_type,
+        content=content,
+        timestamp=timestamp or timezone.now(),
+    )
+    message.fill_counts()
+    return message
+
+
+def insert_messages(messages):
+    """Insert messages with as few statements as the backend allows"""
+    if connection.features.can_return_rows_from_bulk_insert:
+        ChatMessage.objects.bulk_create(messages)
+    else:
+        # e.g. MySQL, where bulk_create would leave the primary keys unset
+        for message in messages:
+            message.save_base(force_insert=True)
+
+
+def commit_turns(turns):
+    """Store turns from any number of sessions in a single transaction"""
+    messages = [message for turn in turns for message in turn.messages]
+    with transaction.atomic():
+        insert_messages(messages)
+        ChatMessage.update_session_counters(messages)
+    cache = get_history_cache()
+    if cache is not None:
+        for turn in turns:
+            cache.append(turn.session, turn.messages)
+
+
+def release_locks(turns):
+    for turn in turns:
+        if turn.lock is not None:
+            try:
+                turn.lock.release()
+            except Exception as e:
+                # The lease expires on its own
+                logger.error(f"Error releasing turn lock on session {turn.session.pk}: {str(e)}")
+
+
+class WriteBehindBuffer:
+    """Queue of turns group-committed by a background thread"""
+
+    def __init__(self, interval=None, max_batch=None):
+        self.interval = interval if interval is not None else getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.05)
+        self.max_batch = max_batch or getattr(settings, 'CHAT_WRITE_BEHIND_MAX_BATCH', 500)
+        self._queue = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chat-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def submit(self, turn):
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Write-behind buffer is stopped")
+            self._queue.append(turn)
+            if len(self._queue) >= self.max_batch:
+                self._condition.notify()
+        return turn
+
+    def depth(self):
+        """Turns queued and not yet committed"""
+        with self._condition:
+            return len(self._queue)
+
+    def flush(self):
+        """Commit everything queued so far; returns the number of turns stored"""
+        with self._condition:
+            turns, self._queue = self._queue, []
+        stored = 0
+        for start in range(0, len(turns), self.max_batch):
+            stored += self._commit(turns[start:start + self.max_batch])
+        return stored
+
+    def _commit(self, turns):
+        try:
+            commit_turns(turns)
+        except Exception as e:
+            logger.error(f"Group commit of {len(turns)} turns failed, retrying individually: {str(e)}")
+            return self._commit_individually(turns)
+        release_locks(turns)
+        for turn in turns:
+            turn.complete()
+        return len(turns)
+
+    def _commit_individually(self, turns):
+        # One bad turn must not lose the rest of the batch
+        stored = 0
+        for turn in turns:
+            try:
+                commit_turns([turn])
+            except Exception as e:
+                logger.error(f"Dropped chat turn for session {turn.session.pk}: {str(e)}")
+                turn.complete(e)
+            else:
+                turn.complete()
+                stored += 1
+            release_locks([turn])
+        return stored
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopped and len(self._queue) < self.max_batch:
+                    self._condition.wait(self.interval)
+                stopped = self._stopped
+            close_old_connections()
+            self.flush()
+            if stopped:
+                break
+
+    def stop(self):
+        """Flush outstanding turns and stop the background thread"""
+        with self._condition:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            self.flush()
+
+
+def get_persistence_mode():
+    mode = getattr(settings, 'CHAT_PERSISTENCE_MODE', 'sync')
+    if mode not in MODES:
+        raise ValueError(f"CHAT_PERSISTENCE_MODE must be one of {', '.join(MODES)}")
+    return mode
+
+
+def get_write_behind_buffer():
+    """Get the process-wide write-behind buffer, starting it on first use"""
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer().start()
+    return _buffer
+
+
+def _turn(session, user_content, ai_content, received_at, lock):
+    return Turn(session, [
+        build_message(session, 'user', user_content, received_at),
+        build_message(session, 'ai', ai_content),
+    ], lock)
+
+
+def _submit(turn):
+    try:
+        get_write_behind_buffer().submit(turn)
+    except Exception:
+        release_locks([turn])
+        raise
+
+
+def record_turn(session, user_content, ai_content, received_at=None, lock=None):
+    """
+    Persist a user message and its reply according to CHAT_PERSISTENCE_MODE.
+
+    Takes ownership of the turn lock, if given, and releases it once the turn
+    is committed. Returns the user and AI ChatMessage; their primary keys are
+    unset in 'async' mode until the buffer flushes.
+    """
+    turn = _turn(session, user_content, ai_content, received_at, lock)
+    mode = get_persistence_mode()
+    if mode == 'sync':
+        try:
+            commit_turns([turn])
+        finally:
+            release_locks([turn])
+        return turn.messages
+
+    _submit(turn)
+    if mode == 'group':
+        turn.wait(COMMIT_TIMEOUT)
+    return turn.messages
+
+
+async def arecord_turn(session, user_content, ai_content, received_at=None, lock=None):
+    """Persist a user message and its reply (async)"""
+    mode = get_persistence_mode()
+    if mode == 'sync':
+        return await sync_to_async(record_turn)(session, user_content, ai_content, received_at, lock)
+
+    turn = _turn(session, user_content, ai_content, received_at, lock)
+    _submit(turn)
+    if mode == 'group':
+        # Wait off the thread that serialises the app's sync DB calls
+        await sync_to_async(turn.wait, thread_sensitive=False)(COMMIT_TIMEOUT)
+    return turn.messages
@@ -0,0 +1,207 @@
+"""
+Sampling request profiler.
+
+When PROFILING_ENABLED is on, ProfilingMiddleware runs cProfile over a
+fraction of requests (PROFILING_SAMPLE_RATE) and over any request carrying a
+signed X-Profile header, so a slow endpoint can be profiled on demand in
+production. Each sample is written to PROFILING_DIR as a pstats file plus a
+JSON summary and, with tracemalloc, a snapshot of the memory the request
+allocated and still held when it ended. The directory keeps the newest
+PROFILING_MAX_FILES samples; `manage.py profile_report` aggregates them into
+hotspots per endpoint.
+
+One request is profiled at a time per process, and only the thread serving
+it: for async views that includes the event loop but not work handed to
+sync_to_async threads. Streamed bodies are generated after the response is
+returned and are not covered.
+"""
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+from django.utils.decorators import sync_and_async_middleware
+import cProfile
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import tracemalloc
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Profile'
+SALT = 'core.profiling'
+MODES = ('cpu', 'memory')
+TRACEMALLOC_FRAMES = 10
+
+_busy = threading.Lock()
+_sequence = itertools.count()
+
+
+def issue_profile_token(memory=False):
+    """Sign a token that makes the middleware profile the request sending it"""
+    return signing.TimestampSigner(salt=SALT).sign('memory' if memory else 'cpu')
+
+
+def read_profile_token(token):
+    """Mode ('cpu' or 'memory') of a valid token, or None"""
+    if not token:
+        return None
+    try:
+        mode = signing.TimestampSigner(salt=SALT).unsign(
+            token, max_age=getattr(settings, 'PROFILING_TOKEN_MAX_AGE', 3600)
+        )
+    except signing.BadSignature:  # Also raised for expired tokens
+        return None
+    return mode if mode in MODES else None
+
+
+def profile_dir():
+    return str(getattr(settings, 'PROFILING_DIR', 'profiles'))
+
+
+def _requested_mode(request):
+    """How to profile a request, or None to leave it alone"""
+    if not getattr(settings, 'PROFILING_ENABLED', False):
+        return None
+    mode = read_profile_token(request.headers.get(HEADER))
+    if mode is None and random.random() < getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0):
+        mode = 'cpu'
+    if mode == 'cpu' and getattr(settings, 'PROFILING_TRACEMALLOC', False):
+        mode = 'memory'
+    return mode
+
+
+class RequestProfile:
+    """cProfile (and optionally tracemalloc) over one request"""
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.profiler = cProfile.Profile()
+        self._started_tracing = False
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracing = True
+        self.started = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+        self.snapshot = None
+        self.peak = None
+        if self.memory:
+            self.snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            self.peak = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+
+    def save(self, request, response, directory):
+        """Write the sample to directory; returns the path prefix of its files"""
+        os.makedirs(directory, exist_ok=True)
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        stem = '{}-{}-{}-{}'.format(
+            timezone.now().strftime('%Y%m%dT%H%M%S%f'),
+            os.getpid(),
+            next(_sequence),
+            re.sub(r'[^A-Za-z0-9_.-]', '_', view),
+        )
+        prefix = os.path.join(directory, stem)
+        self.profiler.dump_stats(f'{prefix}.prof')
+        if self.snapshot is not None:
+            self.snapshot.dump(f'{prefix}.snapshot')
+        with open(f'{prefix}.json', 'w') as summary:
+            json.dump({
+                'view': view,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'seconds': round(self.seconds, 6),
+                'peak_memory': self.peak,
+                'at': timezone.now().isoformat(),
+            }, summary)
+        return prefix
+
+
+def rotate(directory, max_samples):
+    """Delete the oldest samples beyond max_samples (file names sort by time)"""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    except FileNotFoundError:
+        return
+    for name in names[:max(0, len(names) - max_samples)]:
+        stem = os.path.join(directory, name[:-len('.json')])
+        for suffix in ('.json', '.prof', '.snapshot'):
+            try:
+                os.remove(stem + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def _begin(request):
+    mode = _requested_mode(request)
+    # cProfile can only run once at a time: skip requests that overlap a sample
+    if mode is None or not _busy.acquire(blocking=False):
+        return None
+    profile = RequestProfile(memory=mode == 'memory')
+    try:
+        profile.start()
+    except Exception:
+        _busy.release()
+        raise
+    return profile
+
+
+def _end(request, response, profile):
+    try:
+        profile.stop()
+        directory = profile_dir()
+        prefix = profile.save(request, response, directory)
+        rotate(directory, getattr(settings, 'PROFILING_MAX_FILES', 500))
+        logger.info(f"Profiled {request.method} {request.path} in {profile.seconds:.3f}s: {prefix}.prof")
+    except Exception as e:
+        # Profiling must never fail the request it observed
+        logger.error(f"Error saving request profile: {str(e)}")
+    finally:
+        _busy.release()
+    return response
+
+
+@sync_and_async_middleware
+def ProfilingMiddleware(get_response):
+    """Profiles sampled or explicitly requested requests (PROFILING_ENABLED)"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            profile = _begin(request)
+            if profile is None:
+                return await get_response(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                profile.stop()
+                _busy.release()
+                raise
+            return _end(request, response, profile)
+    else:
+        def middleware(request):
+            profile = _begin(request)
+            if profile is None:
+                return get_response(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                profile.stop()
+                _busy.release()
+                raise
+            return _end(request, response, profile)
+    return middleware
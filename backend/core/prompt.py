@@ -33,3 +33,34 @@ def get_prompt():
 **Initial Greeting (Example):**
 "Hello, I'm AdvisorOP. I'm here to help you explore your thoughts and feelings by thinking them through together in a supportive way. How are you feeling today, and what's on your mind?"
 """
+
+
+def get_greeting():
+    # Opening message the frontend shows before the first user turn
+    return "Hello, I'm AdvisorOP. I'm here to help you explore your thoughts and feelings by thinking them through together in a supportive way. How are you feeling today, and what's on your mind?"
+
+
+def get_system_instruction(prompt=None):
+    # Define the system instruction sent natively with every request
+    greeting = get_greeting()
+    return f"""{prompt or get_prompt()}
+
+You have already greeted the user with: "{greeting}"
+"""
+
+
+def get_summary_prompt(previous_summary, transcript, max_words):
+    # Define the prompt used to fold older turns into the rolling summary
+    return f"""You are maintaining a running summary of a supportive conversation between a user and 'AdvisorOP', an AI reasoning and therapy guide. The summary replaces older messages that no longer fit in the model's context, so it must preserve everything AdvisorOP needs to stay coherent.
+
+Keep: the user's main concerns and feelings, important facts about their situation, insights or patterns already identified, coping ideas already discussed, and any crisis indicators. Drop small talk and repetition.
+
+Write in the third person, in plain prose, using at most {max_words} words.
+
+**Current summary:**
+{previous_summary or "(none yet)"}
+
+**Older messages to fold into the summary:**
+{transcript}
+
+**Updated summary:**"""
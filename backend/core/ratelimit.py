@@ -0,0 +1,276 @@
+"""
+Rate limiting and admission control for the chat endpoints.
+
+Every chat turn pins a worker for a multi-second LLM call, so two guards sit
+in front of the views:
+
+- Token buckets per client and endpoint scope (RATE_LIMITS). A client is its
+  user account when logged in, otherwise its IP address; in 'session' mode,
+  its login session or anonymous client token (RATE_LIMIT_KEY). The
+  'local' backend keeps buckets in process memory; 'redis' keeps them in the
+  shared Redis so every node draws from the same bucket. Requests over the
+  limit get 429 with Retry-After.
+- An admission cap on generations in flight in this process
+  (CHAT_MAX_INFLIGHT). Requests beyond it get 503 straight away instead of
+  queueing for a worker until they time out.
+"""
+from collections import OrderedDict
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from .identity import presented_client_id
+import math
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# URL names (in the core namespace) and the bucket each one draws from
+SCOPES = {
+    'chat-api': 'chat',
+    'chat-stream': 'chat',
+    'chat-async': 'chat',
+    'talk': 'chat',
+    'new-chat-api': 'new_chat',
+    'new_chat': 'new_chat',
+}
+# Views that call the model, and so count against the admission cap
+GENERATION_VIEWS = {'chat-api', 'chat-stream', 'chat-async', 'talk'}
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+MAX_LOCAL_KEYS = 100000
+
+_limiter = None
+_limiter_lock = threading.Lock()
+_inflight = 0
+_inflight_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """
+    Parse '<count>/<period>[:<burst>]' into (capacity, tokens per second).
+
+    The period is s, sec, m, min, h, hour, d or day (a leading number such as
+    '10/5m' is allowed). The bucket holds `count` tokens unless a burst size
+    is given.
+    """
+    rate, _, burst = rate.partition(':')
+    count, _, period = rate.partition('/')
+    digits = period.rstrip('abcdefghijklmnopqrstuvwxyz')
+    unit = period[len(digits):][:1]
+    if unit not in PERIODS:
+        raise ValueError(f"Invalid rate {rate!r}: period must be s, m, h or d")
+    seconds = (int(digits) if digits else 1) * PERIODS[unit]
+    count = int(count)
+    capacity = int(burst) if burst else count
+    return capacity, count / seconds
+
+
+class LocalBuckets:
+    """Token buckets in process memory, for single-node deployments"""
+
+    def __init__(self, max_keys=MAX_LOCAL_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at), least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate):
+        """Take a token; returns (allowed, seconds until one is available)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                # Dropping a bucket refills it, so evict the idlest ones
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / refill_rate
+
+
+# Refill, take and store atomically on the Redis server, using its clock so
+# that nodes with skewed clocks agree
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBuckets:
+    """Token buckets in the shared Redis (the default cache), for multi-node deployments"""
+
+    def __init__(self, alias='default'):
+        from django_redis import get_redis_connection
+        self._script = get_redis_connection(alias).register_script(TAKE_SCRIPT)
+
+    def take(self, key, capacity, refill_rate):
+        try:
+            allowed, tokens = self._script(keys=[f'core:ratelimit:{key}'], args=[capacity, refill_rate])
+        except Exception as e:
+            # Fail open: an outage of the limiter must not take the chat down with it
+            logger.warning(f"Rate limiter unavailable, allowing request: {str(e)}")
+            return True, 0
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / refill_rate
+
+
+class RateLimiter:
+    BACKENDS = {'local': LocalBuckets, 'redis': RedisBuckets}
+
+    def __init__(self, rates=None, backend=None):
+        rates = rates if rates is not None else getattr(settings, 'RATE_LIMITS', {})
+        self.rates = {scope: parse_rate(rate) for scope, rate in rates.items() if rate}
+        backend = backend or getattr(settings, 'RATE_LIMIT_BACKEND', 'local')
+        if backend not in self.BACKENDS:
+            raise ValueError(f"RATE_LIMIT_BACKEND must be one of {', '.join(self.BACKENDS)}")
+        self.buckets = self.BACKENDS[backend]()
+
+    def check(self, scope, client):
+        """Returns (allowed, retry_after_seconds) for one request of a client"""
+        if scope not in self.rates:
+            return True, 0
+        capacity, refill_rate = self.rates[scope]
+        return self.buckets.take(f'{scope}:{client}', capacity, refill_rate)
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter()
+    return _limiter
+
+
+def reset_rate_limiter():
+    global _limiter
+    with _limiter_lock:
+        _limiter = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('RATE_LIMIT'):
+        reset_rate_limiter()
+
+
+def client_ip(request):
+    if getattr(settings, 'RATE_LIMIT_TRUST_FORWARDED', False):
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def rate_limit_key(ip, user=None, session_key=None, client_id=None):
+    """Who a caller is counted against, by RATE_LIMIT_KEY; shared by the HTTP and WebSocket transports"""
+    mode = getattr(settings, 'RATE_LIMIT_KEY', 'user')
+    authenticated = user is not None and user.is_authenticated
+    if mode == 'user' and authenticated:
+        return f'user:{user.pk}'
+    if mode == 'session':
+        if authenticated and session_key:
+            return f'session:{session_key}'
+        # Anonymous callers have no Django session: their signed client token
+        # stands in for it. Only a presented token counts, as a freshly minted
+        # id would give every tokenless request a bucket of its own.
+        if not authenticated and client_id:
+            return f'client:{client_id}'
+    return f'ip:{ip}'
+
+
+def client_key(request):
+    """Who a request is counted against"""
+    session = getattr(request, 'session', None)
+    return rate_limit_key(
+        client_ip(request),
+        user=getattr(request, 'user', None),
+        session_key=session.session_key if session is not None else None,
+        client_id=presented_client_id(request) if getattr(settings, 'RATE_LIMIT_KEY', 'user') == 'session' else None,
+    )
+
+
+def try_admit():
+    """Claim an in-flight generation slot; False when the process is at capacity"""
+    global _inflight
+    limit = getattr(settings, 'CHAT_MAX_INFLIGHT', 0)
+    with _inflight_lock:
+        if limit and _inflight >= limit:
+            return False
+        _inflight += 1
+        return True
+
+
+def release_admission():
+    global _inflight
+    with _inflight_lock:
+        _inflight -= 1
+
+
+def inflight_generations():
+    return _inflight
+
+
+def _reject(message, status, retry_after):
+    response = JsonResponse({"error": message, "success": False}, status=status)
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class RateLimitMiddleware(MiddlewareMixin):
+    """Applies the token buckets and the admission cap to the chat views"""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is None or match.namespace != 'core' or request.method in SAFE_METHODS:
+            return None
+
+        scope = SCOPES.get(match.url_name)
+        if scope is not None and getattr(settings, 'RATE_LIMIT_ENABLED', True):
+            allowed, retry_after = get_rate_limiter().check(scope, client_key(request))
+            if not allowed:
+                return _reject("Too many requests, please slow down", 429, retry_after)
+
+        if match.url_name in GENERATION_VIEWS:
+            if not try_admit():
+                logger.warning("Chat admission cap reached, rejecting request")
+                return _reject("The assistant is busy, please try again shortly", 503, 1)
+            request._admitted = True
+        return None
+
+    def process_response(self, request, response):
+        if getattr(request, '_admitted', False):
+            request._admitted = False
+            if response.streaming:
+                # The generation runs while the body streams: free the slot when it ends
+                released = threading.Event()
+
+                def release():
+                    if not released.is_set():
+                        released.set()
+                        release_admission()
+                response._resource_closers.append(release)
+            else:
+                release_admission()
+        return response
@@ -0,0 +1,423 @@
+"""
+Resilient calls to the LLM provider.
+
+Every model call of a chat turn goes through ResilientCaller, which adds:
+
+- A deadline for the whole turn (LLM_DEADLINE seconds, or less if the client
+  sends X-Request-Timeout). Each attempt gets only the time that is left.
+- Retries with full-jitter exponential backoff, only for errors worth
+  retrying (rate limits, 5xx, timeouts), and only while the deadline allows.
+- Optional hedging (LLM_HEDGE): if a reply takes longer than the model's
+  recent LLM_HEDGE_PERCENTILE latency, a second identical request is sent and
+  whichever answers first wins. Streams are not hedged.
+- A circuit breaker per model. After LLM_BREAKER_FAILURES consecutive
+  provider failures, calls fail fast for LLM_BREAKER_COOLDOWN seconds, or go
+  to LLM_FALLBACK_MODEL if one is configured; one trial call then decides
+  whether the breaker closes again. A trial that is cancelled (the client
+  went away) decides nothing and the next call gets a new one; a trial that
+  never ends is given up after LLM_BREAKER_TRIAL_TIMEOUT seconds.
+"""
+from collections import deque
+from concurrent import futures
+from django.conf import settings
+from .metrics import LLM_CALLS
+import asyncio
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-Request-Timeout'
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+LATENCY_WINDOW = 200  # recent successful calls kept per model
+MIN_HEDGE_SAMPLES = 20  # no hedging until the latency percentile means something
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class LLMUnavailable(Exception):
+    """The provider could not produce a reply in time"""
+
+
+class DeadlineExceeded(LLMUnavailable, TimeoutError):
+    pass
+
+
+class CircuitOpenError(LLMUnavailable):
+    pass
+
+
+def is_retryable(error):
+    """Whether an error from the provider is transient, so a retry may succeed"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # google.api_core exceptions carry the HTTP status as .code
+    return getattr(error, 'code', None) in RETRYABLE_CODES
+
+
+def is_unavailable(error):
+    """Whether a failed turn is down to the provider, so the client may retry it later"""
+    return isinstance(error, LLMUnavailable) or is_retryable(error)
+
+
+class Deadline:
+    """Point in time by which a reply is needed"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"No reply within {self.seconds:g} seconds")
+
+
+def request_deadline(request):
+    """Deadline for a chat request: X-Request-Timeout if sent, capped by LLM_MAX_DEADLINE"""
+    seconds = getattr(settings, 'LLM_DEADLINE', 60)
+    try:
+        requested = float(request.headers.get(HEADER, ''))
+    except ValueError:
+        requested = None
+    if requested is not None and requested > 0:
+        seconds = min(requested, getattr(settings, 'LLM_MAX_DEADLINE', 120))
+    return Deadline(seconds)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, cooldown, trial_timeout=None):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.trial_timeout = trial_timeout or 120
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        self._trial_started = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go ahead; in half-open state only one trial call does"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if (
+                (self.state == self.OPEN and now - self._opened_at >= self.cooldown)
+                # A trial that never reported back must not hold the circuit forever
+                or (self.state == self.HALF_OPEN and now - self._trial_started >= self.trial_timeout)
+            ):
+                self.state = self.HALF_OPEN
+                self._trial_started = now
+                return True
+            return False
+
+    def record_abandoned(self):
+        """The call ended without an outcome (cancelled): a half-open trial is handed out again"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # Still past its cooldown, so the next allow() starts a new trial
+                self.state = self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit breaker opened after {self.failures} failures")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, size=LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def percentile(self, percent):
+        """Latency below which `percent` of recent calls finished; None with too few samples"""
+        samples = sorted(self._samples)
+        if len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def _hedge_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = futures.ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'LLM_HEDGE_WORKERS', 16),
+                    thread_name_prefix='llm-hedge'
+                )
+    return _executor
+
+
+class ResilientCaller:
+    """Deadline, retry, hedging and circuit breaker policy, shared by all requests in a process"""
+
+    def __init__(self):
+        self.retries = getattr(settings, 'LLM_RETRIES', 2)
+        self.backoff = getattr(settings, 'LLM_RETRY_BACKOFF', 0.25)
+        self.max_backoff = getattr(settings, 'LLM_RETRY_MAX_BACKOFF', 4.0)
+        self.hedge = getattr(settings, 'LLM_HEDGE', False)
+        self.hedge_percentile = getattr(settings, 'LLM_HEDGE_PERCENTILE', 95)
+        self.hedge_min_delay = getattr(settings, 'LLM_HEDGE_MIN_DELAY', 1.0)
+        self.failure_threshold = getattr(settings, 'LLM_BREAKER_FAILURES', 5)
+        self.cooldown = getattr(settings, 'LLM_BREAKER_COOLDOWN', 30)
+        self.trial_timeout = getattr(settings, 'LLM_BREAKER_TRIAL_TIMEOUT', 120)
+        self.fallback_model = getattr(settings, 'LLM_FALLBACK_MODEL', '')
+        self.stats = dict.fromkeys(['calls', 'retries', 'hedges', 'hedge_wins', 'fallbacks', 'rejected'], 0)
+        self._breakers = {}
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model_name):
+        with self._lock:
+            if model_name not in self._breakers:
+                self._breakers[model_name] = CircuitBreaker(self.failure_threshold, self.cooldown, self.trial_timeout)
+            return self._breakers[model_name]
+
+    def breakers(self):
+        with self._lock:
+            return dict(self._breakers)
+
+    def latency(self, model_name):
+        with self._lock:
+            return self._latency.setdefault(model_name, LatencyTracker())
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+        LLM_CALLS.inc(event=stat)
+
+    def _candidates(self, model_name, deadline):
+        """Models to try in order, skipping those whose breaker is open"""
+        names = [model_name]
+        if self.fallback_model and self.fallback_model != model_name:
+            names.append(self.fallback_model)
+        for name in names:
+            deadline.check()
+            # Asked lazily: allow() may hand out the half-open trial call
+            if self.breaker(name).allow():
+                if name != model_name:
+                    self._count('fallbacks')
+                    logger.warning(f"{model_name} is unavailable, using fallback model {name}")
+                yield name
+
+    def _rejected(self, model_name):
+        self._count('rejected')
+        return CircuitOpenError(f"{model_name} is unavailable, please try again shortly")
+
+    def _hedge_delay(self, model_name, timeout, hedge):
+        if not (hedge and self.hedge):
+            return None
+        percentile = self.latency(model_name).percentile(self.hedge_percentile)
+        if percentile is None:
+            return None
+        delay = max(self.hedge_min_delay, percentile)
+        return delay if delay < timeout else None
+
+    def _backoff(self, attempt, deadline):
+        """Full-jitter backoff before retry number `attempt`; None when no time is left for it"""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return delay if delay < deadline.remaining() else None
+
+    def _failed(self, model_name, error):
+        if is_retryable(error):
+            self.breaker(model_name).record_failure()
+        else:
+            # e.g. a rejected prompt: the provider itself answered
+            self.breaker(model_name).record_success()
+
+    def _succeeded(self, model_name, started, hedge):
+        self.breaker(model_name).record_success()
+        if hedge:
+            self.latency(model_name).record(time.monotonic() - started)
+
+    def call(self, model_name, attempt, deadline, hedge=True):
+        """
+        Run attempt(model_name, timeout) under the policy and return its result.
+
+        The attempt must be safe to run twice at once (for hedging), so it
+        should start a fresh chat rather than reuse one.
+        """
+        self._count('calls')
+        error = None
+        for name in self._candidates(model_name, deadline):
+            for retry in range(self.retries + 1):
+                started = time.monotonic()
+                try:
+                    result = self._attempt(name, attempt, deadline, hedge)
+                except Exception as e:
+                    error = e
+                    self._failed(name, e)
+                    if not is_retryable(e):
+                        raise
+                    if self.breaker(name).state == CircuitBreaker.OPEN:
+                        break  # Straight to the fallback, if any
+                    delay = self._backoff(retry, deadline) if retry < self.retries else None
+                    if delay is None:
+                        break
+                    self._count('retries')
+                    logger.warning(f"Retrying {name} in {delay:.2f}s after: {str(e)}")
+                    time.sleep(delay)
+                except BaseException:
+                    self.breaker(name).record_abandoned()
+                    raise
+                else:
+                    self._succeeded(name, started, hedge)
+                    return result
+        raise error or self._rejected(model_name)
+
+    def _attempt(self, model_name, attempt, deadline, hedge):
+        timeout = deadline.remaining()
+        delay = self._hedge_delay(model_name, timeout, hedge)
+        if delay is None:
+            return attempt(model_name, timeout)
+
+        executor = _hedge_executor()
+        first = executor.submit(attempt, model_name, timeout)
+        done, _ = futures.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self._count('hedges')
+        second = executor.submit(attempt, model_name, deadline.remaining())
+        error = None
+        try:
+            for done in futures.as_completed([first, second], timeout=max(0, deadline.remaining())):
+                try:
+                    result = done.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if done is second:
+                    self._count('hedge_wins')
+                return result
+        except futures.TimeoutError:
+            raise DeadlineExceeded(f"No reply within {deadline.seconds:g} seconds")
+        raise error
+
+    async def acall(self, model_name, attempt, deadline, hedge=True):
+        """Run the coroutine attempt(model_name, timeout) under the policy"""
+        self._count('calls')
+        error = None
+        for name in self._candidates(model_name, deadline):
+            for retry in range(self.retries + 1):
+                started = time.monotonic()
+                try:
+                    result = await self._aattempt(name, attempt, deadline, hedge)
+                except Exception as e:
+                    error = e
+                    self._failed(name, e)
+                    if not is_retryable(e):
+                        raise
+                    if self.breaker(name).state == CircuitBreaker.OPEN:
+                        break  # Straight to the fallback, if any
+                    delay = self._backoff(retry, deadline) if retry < self.retries else None
+                    if delay is None:
+                        break
+                    self._count('retries')
+                    logger.warning(f"Retrying {name} in {delay:.2f}s after: {str(e)}")
+                    await asyncio.sleep(delay)
+                except BaseException:
+                    # Cancelled (e.g. the client disconnected): no verdict on the provider
+                    self.breaker(name).record_abandoned()
+                    raise
+                else:
+                    self._succeeded(name, started, hedge)
+                    return result
+        raise error or self._rejected(model_name)
+
+    async def _aattempt(self, model_name, attempt, deadline, hedge):
+        timeout = deadline.remaining()
+        delay = self._hedge_delay(model_name, timeout, hedge)
+        try:
+            if delay is None:
+                return await asyncio.wait_for(attempt(model_name, timeout), timeout)
+            return await self._ahedged(model_name, attempt, deadline, delay)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f"No reply within {deadline.seconds:g} seconds")
+
+    async def _ahedged(self, model_name, attempt, deadline, delay):
+        first = asyncio.ensure_future(attempt(model_name, deadline.remaining()))
+        tasks = {first}
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            self._count('hedges')
+            tasks.add(asyncio.ensure_future(attempt(model_name, deadline.remaining())))
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=max(0, deadline.remaining()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stream(self, model_name, open_stream, deadline):
+        """
+        Yield the chunks of open_stream(model_name, timeout).
+
+        Failures before the first chunk are retried (or sent to the fallback
+        model) like any call; once text has been sent they are not.
+        """
+        def first_chunk(name, timeout):
+            iterator = iter(open_stream(name, timeout))
+            return name, iterator, next(iterator, None)
+
+        name, iterator, chunk = self.call(model_name, first_chunk, deadline, hedge=False)
+        try:
+            while chunk is not None:
+                yield chunk
+                deadline.check()
+                chunk = next(iterator, None)
+        except Exception as e:
+            self._failed(name, e)
+            raise
+
+    async def astream(self, model_name, open_stream, deadline):
+        """Yield the chunks of the coroutine open_stream(model_name, timeout) (async)"""
+        async def first_chunk(name, timeout):
+            iterator = aiter(await open_stream(name, timeout))
+            return name, iterator, await anext(iterator, None)
+
+        name, iterator, chunk = await self.acall(model_name, first_chunk, deadline, hedge=False)
+        try:
+            while chunk is not None:
+                yield chunk
+                deadline.check()
+                chunk = await asyncio.wait_for(anext(iterator, None), max(0, deadline.remaining()))
+        except asyncio.TimeoutError:
+            self._failed(name, DeadlineExceeded())
+            raise DeadlineExceeded(f"No reply within {deadline.seconds:g} seconds")
+        except Exception as e:
+            self._failed(name, e)
+            raise
@@ -0,0 +1,106 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from .models import ChatSession, ChatMessage
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """
+    Retention rules for chat sessions. Archived sessions are always exempt.
+
+    - max_sessions_per_user: keep only the N most recently updated sessions per user
+    - inactive_ttl_days: delete cleared (is_active=False) sessions idle this long
+    - anonymous_ttl_days: delete sessions without a user idle this long
+    """
+
+    def __init__(self, max_sessions_per_user=None, inactive_ttl_days=None, anonymous_ttl_days=None,
+                 chunk_size=None):
+        self.max_sessions_per_user = max_sessions_per_user
+        self.inactive_ttl_days = inactive_ttl_days
+        self.anonymous_ttl_days = anonymous_ttl_days
+        self.chunk_size = chunk_size or 500
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_sessions_per_user=getattr(settings, 'CHAT_RETENTION_MAX_SESSIONS_PER_USER', 20),
+            inactive_ttl_days=getattr(settings, 'CHAT_RETENTION_INACTIVE_TTL_DAYS', 30),
+            anonymous_ttl_days=getattr(settings, 'CHAT_RETENTION_ANONYMOUS_TTL_DAYS', 90),
+            chunk_size=getattr(settings, 'CHAT_RETENTION_CHUNK_SIZE', 500),
+        )
+
+    def rules(self, now=None):
+        """Map of rule name to a queryset of sessions the rule would delete"""
+        now = now or timezone.now()
+        candidates = ChatSession.objects.filter(is_archived=False)
+        rules = {}
+
+        if self.max_sessions_per_user:
+            ranked = candidates.filter(user__isnull=False, is_active=True).annotate(
+                recency=Window(RowNumber(), partition_by=F('user_id'), order_by=F('updated_at').desc())
+            )
+            overflow = ranked.filter(recency__gt=self.max_sessions_per_user).values('id')
+            rules['per_user_cap'] = ChatSession.objects.filter(id__in=overflow)
+
+        if self.inactive_ttl_days:
+            rules['inactive_ttl'] = candidates.filter(
+                is_active=False,
+                updated_at__lt=now - timedelta(days=self.inactive_ttl_days)
+            )
+
+        if self.anonymous_ttl_days:
+            rules['anonymous_ttl'] = candidates.filter(
+                user__isnull=True,
+                updated_at__lt=now - timedelta(days=self.anonymous_ttl_days)
+            )
+
+        return rules
+
+
+def retention_stats(policy=None, now=None):
+    """Count what each rule would delete, without deleting anything"""
+    policy = policy or RetentionPolicy.from_settings()
+    stats = {}
+    for name, sessions in policy.rules(now).items():
+        totals = sessions.aggregate(messages=Sum('message_count'))
+        stats[name] = {
+            'sessions': sessions.count(),
+            'messages': totals['messages'] or 0,
+        }
+    return stats
+
+
+def delete_sessions(session_ids):
+    """Delete a batch of sessions and their messages with set-based DELETEs"""
+    with transaction.atomic():
+        # Messages have no signals or dependants, so Django removes them with a
+        # single DELETE ... WHERE session_id IN (...) instead of row by row
+        _, deleted = ChatSession.objects.filter(id__in=session_ids).delete()
+    return deleted.get(ChatSession._meta.label, 0), deleted.get(ChatMessage._meta.label, 0)
+
+
+def apply_retention(policy=None, now=None):
+    """Apply every retention rule in chunks, returning per-rule deletion counts"""
+    policy = policy or RetentionPolicy.from_settings()
+    now = now or timezone.now()
+    results = {}
+    for name, sessions in policy.rules(now).items():
+        deleted_sessions = deleted_messages = 0
+        while True:
+            # Re-evaluate the rule each round so chunks never overlap
+            chunk = list(sessions.order_by().values_list('id', flat=True)[:policy.chunk_size])
+            if not chunk:
+                break
+            chunk_sessions, chunk_messages = delete_sessions(chunk)
+            deleted_sessions += chunk_sessions
+            deleted_messages += chunk_messages
+        results[name] = {'sessions': deleted_sessions, 'messages': deleted_messages}
+        if deleted_sessions:
+            logger.info(f"Retention rule {name} deleted {deleted_sessions} sessions, {deleted_messages} messages")
+    return results
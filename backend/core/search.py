@@ -0,0 +1,479 @@
+"""
+Full-text search over chat messages.
+
+Messages are indexed by plain_content, their text without markup (replies
+are stored as formatter HTML, whose tags and entities would otherwise match
+searches for "strong" or "amp" and skew the ranking). It is filled on save
+and by the bulk insert paths (ChatMessage.fill_counts). The index depends on
+the database engine:
+
+- SQLite: an FTS5 table over core_chatmessage.plain_content (external
+  content, so the text is not stored twice), kept in step by triggers on
+  insert, update and delete, which also covers bulk_create and retention
+  deletes.
+- MySQL: a FULLTEXT index on core_chatmessage.plain_content.
+- PostgreSQL: a GIN index on to_tsvector('simple', plain_content).
+
+The index is created after `migrate` (post_migrate), as core has no
+migrations; messages stored before plain_content existed are filled in
+first, and on SQLite existing messages are indexed when the table is first
+created. Other engines, or SQLite builds without FTS5, fall back to an
+unindexed LIKE scan. Queries are split into words that must all match,
+ranked by relevance and paginated by page number up to MAX_RESULTS.
+
+Sessions in cold storage (core/cold_storage.py) have no message rows, so
+their transcripts are indexed one document per session: a contentless FTS5
+table on SQLite, a tsvector column on core_coldtranscript on PostgreSQL.
+A match only picks the session; its transcript is then decompressed to find
+the matching messages, which are listed after the indexed ones. Elsewhere
+the caller's most recent cold sessions are decompressed and scanned. The
+document is dropped whenever a transcript is deleted (thawed, or removed
+with its session by retention).
+"""
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import strip_tags
+from .models import ChatMessage, ChatSession, ColdTranscript
+import html
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_TERMS = 16
+MAX_RESULTS = 1000  # deepest result reachable by paging; ranking beyond it is not useful
+SNIPPET_CONTEXT = 60  # characters around the first match
+COLD_SESSIONS = 50  # cold transcripts decompressed per search, most recent first
+
+FTS_TABLE = 'core_chatmessage_fts'
+MYSQL_INDEX = 'chatmessage_plain_ft'
+POSTGRES_INDEX = 'chatmessage_plain_tsv_idx'
+# Indexes over the raw HTML content, replaced by the ones above
+OLD_MYSQL_INDEX = 'chatmessage_content_ft'
+OLD_POSTGRES_INDEX = 'chatmessage_content_tsv_idx'
+COLD_FTS_TABLE = 'core_coldtranscript_fts'
+POSTGRES_COLD_INDEX = 'coldtranscript_search_vector_idx'
+
+WORD = re.compile(r'\w+', re.UNICODE)
+BREAK_TAG = re.compile(r'</?(?:br|li|ul|ol)\b[^>]*>', re.IGNORECASE)  # tags that separate words
+
+
+def search_terms(query):
+    """Words of a search query, lowercased and de-duplicated, in order"""
+    terms = []
+    for word in WORD.findall(query.lower()):
+        if word not in terms:
+            terms.append(word)
+    return terms[:MAX_TERMS]
+
+
+def make_snippet(content, terms, context=SNIPPET_CONTEXT):
+    """Plain-text excerpt around the first matching term"""
+    text = ' '.join(html.unescape(strip_tags(BREAK_TAG.sub(' ', content))).split())
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - context) if positions else 0
+    end = min(len(text), start + 2 * context + (max(map(len, terms)) if terms else 0))
+    return ('...' if start else '') + text[start:end] + ('...' if end < len(text) else '')
+
+
+def cold_text(messages):
+    """The document a cold transcript is indexed under"""
+    return '\n'.join(ChatMessage.plain_text(message.message_type, message.content) for message in messages)
+
+
+def backfill_plain_content(using=DEFAULT_DB_ALIAS, batch_size=500):
+    """Fill plain_content of messages stored before the column existed; returns how many were filled"""
+    filled = 0
+    while True:
+        batch = list(ChatMessage.objects.using(using).filter(plain_content='').exclude(content='').only(
+            'id', 'message_type', 'content', 'plain_content'
+        )[:batch_size])
+        for message in batch:
+            # Never '' again, or the batch would come back
+            message.plain_content = ChatMessage.plain_text(message.message_type, message.content) or ' '
+        ChatMessage.objects.using(using).bulk_update(batch, ['plain_content'])
+        filled += len(batch)
+        if len(batch) < batch_size:
+            return filled
+
+
+def _owner_filter(owner):
+    """SQL condition (on core_chatsession as s) for the sessions of a (user, client_id) owner"""
+    user, client_id = owner
+    if user is not None and user.is_authenticated:
+        return 's.user_id = %s', [user.pk]
+    return 's.user_id IS NULL AND s.client_id = %s', [client_id]
+
+
+class SearchBackend:
+    """Unindexed fallback: every term as a case-insensitive substring"""
+    indexed = False
+
+    def setup(self, connection):
+        pass
+
+    def match(self, terms):
+        """Q matching messages that contain every term"""
+        condition = Q()
+        for term in terms:
+            condition &= Q(plain_content__icontains=term)
+        return condition
+
+    def ranked_ids(self, connection, terms, owner, limit, offset):
+        """(message id, score) pairs of the caller's best matches"""
+        ids = ChatMessage.objects.using(connection.alias).filter(
+            self.match(terms), session__in=self._sessions(owner).filter(is_active=True)
+        ).order_by('-timestamp', '-id').values_list('id', flat=True)
+        return [(message_id, None) for message_id in ids[offset:offset + limit]]
+
+    def index_cold(self, connection, session_id, text):
+        """Index the text of a session frozen into a cold transcript"""
+
+    def unindex_cold(self, connection, transcript):
+        """Drop a cold transcript that is being deleted from the index"""
+
+    def cold_session_ids(self, connection, terms, owner, limit):
+        """Ids of the caller's cold sessions that may match, most recently updated first"""
+        return list(self._sessions(owner).using(connection.alias).filter(
+            is_active=True, is_cold=True
+        ).order_by('-updated_at').values_list('id', flat=True)[:limit])
+
+    def _sessions(self, owner):
+        user, client_id = owner
+        if user is not None and user.is_authenticated:
+            return ChatSession.objects.filter(user=user)
+        return ChatSession.objects.filter(user__isnull=True, client_id=client_id)
+
+    def _index_transcripts(self, connection, session_ids):
+        """Index existing cold transcripts, e.g. when the index is first created"""
+        from .cold_storage import unpack_messages
+        transcripts = ColdTranscript.objects.using(connection.alias).filter(session_id__in=session_ids)
+        for transcript in transcripts.iterator(chunk_size=100):
+            self.index_cold(connection, transcript.session_id, cold_text(unpack_messages(transcript)))
+
+    def _query(self, connection, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(row[0], row[1]) for row in cursor.fetchall()]
+
+
+class SQLiteSearch(SearchBackend):
+    indexed = True
+
+    def setup(self, connection):
+        messages = ChatMessage._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            row = cursor.fetchone()
+            if row is not None and 'plain_content' not in row[0]:
+                # Built over the raw HTML: start again
+                for trigger in ('insert', 'delete', 'update'):
+                    cursor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}")
+                cursor.execute(f"DROP TABLE {FTS_TABLE}")
+                row = None
+            created = row is None
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(plain_content, "
+                f"content='{messages}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {messages} BEGIN "
+                f"INSERT INTO {FTS_TABLE}(rowid, plain_content) VALUES (new.id, new.plain_content); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {messages} BEGIN "
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, plain_content) "
+                f"VALUES ('delete', old.id, old.plain_content); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF plain_content ON {messages} BEGIN "
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, plain_content) "
+                f"VALUES ('delete', old.id, old.plain_content); "
+                f"INSERT INTO {FTS_TABLE}(rowid, plain_content) VALUES (new.id, new.plain_content); END"
+            )
+            if created:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+            # Contentless: the transcript text stays compressed, only the index is stored
+            cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = %s", [COLD_FTS_TABLE])
+            row = cursor.fetchone()
+            if row is not None and created:
+                # Rebuilt with the message index: the documents were raw HTML too
+                cursor.execute(f"DROP TABLE {COLD_FTS_TABLE}")
+                row = None
+            cold_created = row is None
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {COLD_FTS_TABLE} USING fts5("
+                f"content, content='', tokenize='unicode61 remove_diacritics 2')"
+            )
+        if cold_created:
+            self._index_transcripts(connection, ColdTranscript.objects.using(connection.alias).values('session_id'))
+        return created or cold_created
+
+    def index_cold(self, connection, session_id, text):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {COLD_FTS_TABLE}(rowid, content) VALUES (%s, %s)", [session_id, text])
+
+    def unindex_cold(self, connection, transcript):
+        # A contentless table is told the indexed text to remove it
+        from .cold_storage import unpack_messages
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {COLD_FTS_TABLE}({COLD_FTS_TABLE}, rowid, content) VALUES ('delete', %s, %s)",
+                [transcript.session_id, cold_text(unpack_messages(transcript))]
+            )
+
+    def cold_session_ids(self, connection, terms, owner, limit):
+        owner_sql, owner_params = _owner_filter(owner)
+        with connection.cursor() as cursor:
+            cursor.execute((
+                f"SELECT s.id FROM {COLD_FTS_TABLE} "
+                f"JOIN {ChatSession._meta.db_table} s ON s.id = {COLD_FTS_TABLE}.rowid "
+                f"WHERE {COLD_FTS_TABLE} MATCH %s AND s.is_active AND s.is_cold AND {owner_sql} "
+                f"ORDER BY s.updated_at DESC LIMIT %s"
+            ), [self.fts_query(terms), *owner_params, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def fts_query(self, terms):
+        # Quote every term so user input is never read as FTS5 syntax
+        return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+    def match(self, terms):
+        return Q(id__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [self.fts_query(terms)]))
+
+    def ranked_ids(self, connection, terms, owner, limit, offset):
+        owner_sql, owner_params = _owner_filter(owner)
+        return self._query(connection, (
+            f"SELECT m.id, bm25({FTS_TABLE}) AS score FROM {FTS_TABLE} "
+            f"JOIN {ChatMessage._meta.db_table} m ON m.id = {FTS_TABLE}.rowid "
+            f"JOIN {ChatSession._meta.db_table} s ON s.id = m.session_id "
+            f"WHERE {FTS_TABLE} MATCH %s AND s.is_active AND {owner_sql} "
+            f"ORDER BY score, m.id DESC LIMIT %s OFFSET %s"
+        ), [self.fts_query(terms), *owner_params, limit, offset])
+
+
+class MySQLSearch(SearchBackend):
+    indexed = True
+
+    def setup(self, connection):
+        messages = ChatMessage._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT index_name FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = %s AND index_name IN (%s, %s)",
+                [messages, MYSQL_INDEX, OLD_MYSQL_INDEX]
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+            if OLD_MYSQL_INDEX in existing:
+                cursor.execute(f"DROP INDEX {OLD_MYSQL_INDEX} ON {messages}")
+            if MYSQL_INDEX in existing:
+                return False
+            cursor.execute(f"CREATE FULLTEXT INDEX {MYSQL_INDEX} ON {messages} (plain_content)")
+        return True
+
+    def boolean_query(self, terms):
+        # Every term required; the operators MySQL would read are stripped by search_terms
+        return ' '.join(f'+{term}' for term in terms)
+
+    def match(self, terms):
+        return Q(id__in=RawSQL(
+            f"SELECT id FROM {ChatMessage._meta.db_table} WHERE MATCH(plain_content) AGAINST (%s IN BOOLEAN MODE)",
+            [self.boolean_query(terms)]
+        ))
+
+    def ranked_ids(self, connection, terms, owner, limit, offset):
+        owner_sql, owner_params = _owner_filter(owner)
+        query = self.boolean_query(terms)
+        return self._query(connection, (
+            f"SELECT m.id, MATCH(m.plain_content) AGAINST (%s IN BOOLEAN MODE) AS score "
+            f"FROM {ChatMessage._meta.db_table} m JOIN {ChatSession._meta.db_table} s ON s.id = m.session_id "
+            f"WHERE MATCH(m.plain_content) AGAINST (%s IN BOOLEAN MODE) AND s.is_active AND {owner_sql} "
+            f"ORDER BY score DESC, m.id DESC LIMIT %s OFFSET %s"
+        ), [query, query, *owner_params, limit, offset])
+
+
+class PostgresSearch(SearchBackend):
+    indexed = True
+    VECTOR = "to_tsvector('simple', {}plain_content)"
+
+    def setup(self, connection):
+        transcripts = ColdTranscript._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP INDEX IF EXISTS {OLD_POSTGRES_INDEX}")
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {POSTGRES_INDEX} ON {ChatMessage._meta.db_table} "
+                f"USING GIN ({self.VECTOR.format('')})"
+            )
+            # Not a model field: the ORM never loads it
+            cursor.execute(f"ALTER TABLE {transcripts} ADD COLUMN IF NOT EXISTS search_vector tsvector")
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {POSTGRES_COLD_INDEX} ON {transcripts} USING GIN (search_vector)"
+            )
+            cursor.execute(f"SELECT session_id FROM {transcripts} WHERE search_vector IS NULL")
+            missing = [row[0] for row in cursor.fetchall()]
+        self._index_transcripts(connection, missing)
+        return False
+
+    def index_cold(self, connection, session_id, text):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {ColdTranscript._meta.db_table} SET search_vector = to_tsvector('simple', %s) "
+                f"WHERE session_id = %s",
+                [text, session_id]
+            )
+
+    def cold_session_ids(self, connection, terms, owner, limit):
+        owner_sql, owner_params = _owner_filter(owner)
+        with connection.cursor() as cursor:
+            cursor.execute((
+                f"SELECT s.id FROM {ColdTranscript._meta.db_table} c "
+                f"JOIN {ChatSession._meta.db_table} s ON s.id = c.session_id "
+                f"WHERE c.search_vector @@ plainto_tsquery('simple', %s) AND s.is_active AND {owner_sql} "
+                f"ORDER BY s.updated_at DESC LIMIT %s"
+            ), [' '.join(terms), *owner_params, limit])
+            return [row[0] for row in cursor.fetchall()]
+
+    def match(self, terms):
+        return Q(id__in=RawSQL(
+            f"SELECT id FROM {ChatMessage._meta.db_table} "
+            f"WHERE {self.VECTOR.format('')} @@ plainto_tsquery('simple', %s)",
+            [' '.join(terms)]
+        ))
+
+    def ranked_ids(self, connection, terms, owner, limit, offset):
+        owner_sql, owner_params = _owner_filter(owner)
+        vector = self.VECTOR.format('m.')
+        return self._query(connection, (
+            f"SELECT m.id, ts_rank({vector}, q) AS score "
+            f"FROM {ChatMessage._meta.db_table} m JOIN {ChatSession._meta.db_table} s ON s.id = m.session_id, "
+            f"plainto_tsquery('simple', %s) q "
+            f"WHERE {vector} @@ q AND s.is_active AND {owner_sql} "
+            f"ORDER BY score DESC, m.id DESC LIMIT %s OFFSET %s"
+        ), [' '.join(terms), *owner_params, limit, offset])
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearch,
+    'mysql': MySQLSearch,
+    'postgresql': PostgresSearch,
+}
+
+_backends = {}
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS):
+    """Search backend for a database alias, chosen by its engine"""
+    backend = _backends.get(using)
+    if backend is None:
+        vendor = connections[using].vendor
+        backend = _backends[using] = BACKENDS.get(vendor, SearchBackend)()
+    return backend
+
+
+def ensure_search_index(using=DEFAULT_DB_ALIAS, **kwargs):
+    """Create the full-text index if it is missing (a post_migrate receiver)"""
+    backend = get_search_backend(using)
+    filled = backfill_plain_content(using)
+    if filled:
+        logger.info(f"Filled plain_content of {filled} messages on database {using}")
+    try:
+        if backend.setup(connections[using]):
+            logger.info(f"Created full-text search index on database {using}")
+    except Exception as e:
+        # e.g. SQLite built without FTS5: search still works, unindexed
+        logger.warning(f"Full-text search index unavailable on database {using}, using LIKE: {str(e)}")
+        _backends[using] = SearchBackend()
+
+
+def index_cold_transcript(session_id, messages, using=DEFAULT_DB_ALIAS):
+    """Index the messages of a session being frozen (core/cold_storage.py)"""
+    get_search_backend(using).index_cold(connections[using], session_id, cold_text(messages))
+
+
+def unindex_cold_transcript(transcript, using=DEFAULT_DB_ALIAS):
+    """Drop a transcript that is being deleted from the index"""
+    get_search_backend(using).unindex_cold(connections[using], transcript)
+
+
+def matching_messages(query, using=DEFAULT_DB_ALIAS):
+    """Q for messages matching a query (all owners), e.g. for the admin"""
+    terms = search_terms(query)
+    if not terms:
+        return Q(pk__in=[])
+    return get_search_backend(using).match(terms)
+
+
+def search_messages(query, user=None, client_id='', page=1, page_size=20, using=DEFAULT_DB_ALIAS):
+    """
+    Search the caller's active sessions, best matches first.
+
+    Returns {'results': [...], 'page': page, 'next_page': page + 1 or None}.
+    """
+    terms = search_terms(query)
+    offset = (page - 1) * page_size
+    if not terms or offset >= MAX_RESULTS:
+        return {'results': [], 'page': page, 'next_page': None}
+
+    limit = min(page_size, MAX_RESULTS - offset)
+    backend = get_search_backend(using)
+    connection = connections[using]
+    owner = (user, client_id)
+    # One extra row tells whether there is a next page
+    rows = backend.ranked_ids(connection, terms, owner, limit + 1, offset)
+    cold = []
+    if len(rows) <= limit:
+        # Past the last hot match: cold sessions' matches follow
+        if rows or not offset:
+            hot_total = offset + len(rows)
+        else:
+            hot_total = len(backend.ranked_ids(connection, terms, owner, offset, 0))
+        skip = max(0, offset - hot_total)
+        cold = _cold_results(backend, connection, terms, owner)[skip:skip + limit + 1 - len(rows)]
+    has_next = len(rows) + len(cold) > limit and offset + limit < MAX_RESULTS
+    rows = rows[:limit]
+    cold = cold[:limit - len(rows)]
+
+    messages = ChatMessage.objects.using(using).select_related('session').only(
+        'id', 'message_type', 'content', 'timestamp', 'session__session_key', 'session__title'
+    ).in_bulk([message_id for message_id, _ in rows])
+    results = []
+    for message_id, score in rows:
+        message = messages.get(message_id)
+        if message is None:  # Deleted since the search ran
+            continue
+        results.append(_result(message, message.session, terms, score))
+    results.extend(cold)
+    return {'results': results, 'page': page, 'next_page': page + 1 if has_next else None}
+
+
+def _result(message, session, terms, score):
+    return {
+        'message_id': message.id,
+        'session_key': session.session_key,
+        'session_title': session.get_title(),
+        'message_type': message.message_type,
+        'snippet': make_snippet(message.content, terms),
+        'timestamp': message.timestamp.isoformat(),
+        'score': score,
+    }
+
+
+def _cold_results(backend, connection, terms, owner):
+    """Matches in the caller's cold sessions, newest session and message first"""
+    from .cold_storage import unpack_messages
+    session_ids = backend.cold_session_ids(connection, terms, owner, COLD_SESSIONS)
+    if not session_ids:
+        return []
+    transcripts = ColdTranscript.objects.using(connection.alias).select_related('session').in_bulk(session_ids)
+    results = []
+    for session_id in session_ids:
+        transcript = transcripts.get(session_id)
+        if transcript is None:  # Thawed since the search ran: its rows are in the main index
+            continue
+        for message in reversed(unpack_messages(transcript)):
+            if set(terms) <= set(WORD.findall(message.plain_content.lower())):
+                results.append(_result(message, transcript.session, terms, None))
+    return results
@@ -5,26 +5,18 @@ from .models import ChatSession, ChatMessage, AIConfig
 class ChatMessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatMessage
-        fields = ['id', 'message_type', 'content', 'timestamp', 'character_count']
-        read_only_fields = ['id', 'timestamp', 'character_count']
+        fields = ['id', 'message_type', 'content', 'timestamp', 'character_count', 'token_count']
+        read_only_fields = ['id', 'timestamp', 'character_count', 'token_count']
 
 
 class ChatSessionSerializer(serializers.ModelSerializer):
     messages = ChatMessageSerializer(many=True, read_only=True)
-    message_count = serializers.SerializerMethodField()
-    total_characters = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatSession
         fields = ['id', 'session_key', 'created_at', 'updated_at', 'is_active', 
                  'messages', 'message_count', 'total_characters']
-        read_only_fields = ['id', 'created_at', 'updated_at']
-
-    def get_message_count(self, obj):
-        return obj.messages.count()
-
-    def get_total_characters(self, obj):
-        return sum(msg.character_count for msg in obj.messages.all())
+        read_only_fields = ['id', 'created_at', 'updated_at', 'message_count', 'total_characters']
 
 
 class AIConfigSerializer(serializers.ModelSerializer):
@@ -1,8 +1,21 @@
-import google.generativeai as genai
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 from .models import ChatSession, ChatMessage, AIConfig
-from .prompt import get_prompt
+from .llm import get_llm_client
+from .ai_config import get_active_config, aget_active_config
+from .context import ContextWindow
+from .history_cache import get_history_cache
+from .formatting import MarkdownFormatter, format_markdown
+from .locks import SessionTurnLock, TurnLockTimeout
+from .resilience import Deadline, is_unavailable
+from .persistence import record_turn, arecord_turn
+from .cold_storage import session_messages, thaw_session
+from .pagination import DEFAULT_PAGE_SIZE, paginate_messages, paginate_message_list, after_position, decode_cursor, encode_cursor
+from .metrics import stage, record_stage, TURNS
+import asyncio
+import time
 import logging
 
 logger = logging.getLogger(__name__)
@@ -11,101 +24,242 @@ logger = logging.getLogger(__name__)
 class AIService:
     """Service class for handling AI interactions"""
     
-    def __init__(self):
-        self.api_key = settings.GEMINI_API_KEY
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel("gemini-2.0-flash")
-        self.system_prompt = get_prompt()
+    def __init__(self, client=None, config=None):
+        # The LLM client and the active AIConfig are shared process-wide and
+        # only resolved when a method actually talks to the model, so DB-only
+        # calls stay cheap
+        self._client = client
+        self._config = config
     
-    def get_or_create_session(self, session_key, user=None):
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_llm_client()
+        return self._client
+    
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = get_active_config()
+        return self._config
+    
+    async def aload_config(self):
+        """Resolve the active AIConfig without a sync DB call on the event loop"""
+        if self._config is None:
+            self._config = await aget_active_config()
+        return self._config
+    
+    @property
+    def model(self):
+        return self.get_model(self.config.model_name)
+    
+    def get_model(self, model_name):
+        """The chat model called model_name, set up with the active config"""
+        config = self.config
+        return self.client.get_model(
+            model_name,
+            system_instruction=config.system_instruction,
+            generation_config=config.generation_config
+        )
+    
+    def _reply_attempt(self, history, user_message, stream=False):
+        """One try at the reply, on a fresh chat so that hedged tries can run side by side"""
+        def attempt(model_name, timeout):
+            chat = self.get_model(model_name).start_chat(history=history)
+            return chat.send_message(user_message, stream=stream, request_options={'timeout': timeout})
+        return attempt
+    
+    def _areply_attempt(self, history, user_message, stream=False):
+        """One try at the reply (async)"""
+        async def attempt(model_name, timeout):
+            chat = self.get_model(model_name).start_chat(history=history)
+            return await chat.send_message_async(user_message, stream=stream, request_options={'timeout': timeout})
+        return attempt
+    
+    @property
+    def system_prompt(self):
+        return self.config.system_prompt
+    
+    def get_or_create_session(self, session_key, user=None, client_id=''):
         """Get or create a chat session"""
         try:
             session = ChatSession.objects.get(session_key=session_key, is_active=True)
         except ChatSession.DoesNotExist:
-            session = ChatSession.objects.create(
-                session_key=session_key,
-                user=user
-            )
+            session = self._create_session(session_key, user, client_id)
         return session
     
-    def build_chat_history(self, session):
-        """Build chat history for the AI model"""
-        history = [
-            {
-                "role": "user",
-                "parts": [{"text": self.system_prompt}],
-            },
-            {
-                "role": "model",
-                "parts": [{"text": "Hello, I'm AdvisorOP. I'm here to help you explore your thoughts and feelings by thinking them through together in a supportive way. How are you feeling today, and what's on your mind?"}]
-            }
-        ]
-        
-        # Add previous messages from this session
-        messages = session.messages.all().order_by('timestamp')
-        for message in messages:
-            if message.message_type == 'user':
-                history.append({
-                    "role": "user",
-                    "parts": [{"text": message.content}]
-                })
-            elif message.message_type == 'ai':
-                history.append({
-                    "role": "model",
-                    "parts": [{"text": message.content}]
-                })
+    def _create_session(self, session_key, user=None, client_id=''):
+        """Create a session, or return the one a concurrent request created first"""
+        try:
+            with transaction.atomic():
+                return ChatSession.objects.create(session_key=session_key, user=user, client_id=client_id)
+        except IntegrityError:
+            return ChatSession.objects.get(session_key=session_key, is_active=True)
+    
+    async def aget_or_create_session(self, session_key, user=None, client_id=''):
+        """Get or create a chat session (async)"""
+        try:
+            session = await ChatSession.objects.aget(session_key=session_key, is_active=True)
+        except ChatSession.DoesNotExist:
+            session = await sync_to_async(self._create_session)(session_key, user, client_id)
+        return session
+    
+    def build_chat_history(self, session, exclude=None, deadline=None):
+        """Build chat history for the AI model, bounded by the context window.
         
-        return history
+        The system prompt is not part of the history: it is sent as the
+        model's native system instruction (see core/llm.py). Folding old
+        turns into the summary is a model call that counts against the
+        turn's deadline.
+        """
+        if session.is_cold:
+            thaw_session(session)
+        messages = None
+        cache = get_history_cache()
+        if cache is not None and exclude is None:
+            messages = cache.pending_messages(session)
+        window = ContextWindow(self.client, model_name=self.config.model_name, deadline=deadline)
+        return window.build(session, exclude=exclude, messages=messages)
     
-    def send_message(self, user_message, session_key, user=None):
+    async def abuild_chat_history(self, session, exclude=None, deadline=None):
+        """Build chat history for the AI model (async)"""
+        if session.is_cold:
+            await sync_to_async(thaw_session)(session)
+        messages = None
+        cache = get_history_cache()
+        if cache is not None and exclude is None:
+            messages = await sync_to_async(cache.pending_messages)(session)
+        config = await self.aload_config()
+        window = ContextWindow(self.client, model_name=config.model_name, deadline=deadline)
+        return await window.abuild(session, exclude=exclude, messages=messages)
+    
+    def send_message(self, user_message, session_key, user=None, client_id='', deadline=None):
         """Send a message to the AI and get a response"""
+        deadline = deadline or Deadline(getattr(settings, 'LLM_DEADLINE', 60))
+        received_at = None
+        lock = None
         try:
             # Get or create session
-            session = self.get_or_create_session(session_key, user)
+            with stage('session'):
+                session = self.get_or_create_session(session_key, user, client_id)
             
-            # Save user message
-            user_msg = ChatMessage.objects.create(
-                session=session,
-                message_type='user',
-                content=user_message
-            )
+            # Wait for any turn already in flight on this session
+            with stage('lock_wait'):
+                lock = SessionTurnLock(session).acquire()
+            received_at = timezone.now()  # Turns are ordered by when they got the lock
             
-            # Update session title from first message if not set
-            if not session.title:
-                session.title = user_message[:50]
-                if len(user_message) > 50:
-                    session.title += "..."
-                session.save()
+            # Build chat history (the new message is stored together with its reply)
+            with stage('history'):
+                history = self.build_chat_history(session, deadline=deadline)
             
-            # Manage session limit (keep only 20 non-archived sessions per user)
-            if user:
-                self._manage_session_limit(user)
+            # Send message to AI, with retries and fallbacks within the deadline
+            with stage('llm'):
+                response = self.client.resilience.call(
+                    self.config.model_name,
+                    self._reply_attempt(history, user_message),
+                    deadline
+                )
             
-            # Build chat history
-            history = self.build_chat_history(session)
+            # Format markdown as safe HTML
+            with stage('format'):
+                ai_message = format_markdown(response.text)
             
-            # Create chat with history
-            chat = self.model.start_chat(history=history)
+            # Save the turn in one transaction; the lock is released once it is stored
+            held, lock = lock, None
+            with stage('persist'):
+                _, ai_msg = record_turn(session, user_message, ai_message, received_at, held)
             
-            # Send message to AI
-            response = chat.send_message(user_message)
-            ai_message = response.text
+            TURNS.inc(outcome='success')
+            return {
+                'response': ai_message,
+                'timestamp': ai_msg.timestamp.strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': ai_msg.id,
+                'success': True
+            }
             
-            # Process bold text formatting
-            ai_message = self._format_response(ai_message)
+        except TurnLockTimeout:
+            # Nothing was saved for this turn; the caller reports the session as busy
+            TURNS.inc(outcome='busy')
+            raise
             
-            # Save AI response
-            ai_msg = ChatMessage.objects.create(
-                session=session,
-                message_type='ai',
-                content=ai_message
-            )
+        except Exception as e:
+            logger.error(f"Error in AI service: {str(e)}")
+            TURNS.inc(outcome='error')
             
-            # Update session timestamp
-            session.updated_at = timezone.now()
-            session.save()
+            # Save error message
+            error_message = f"Error: {str(e)} - Could not get response from AI."
+            if 'session' in locals():
+                held, lock = lock, None
+                record_turn(session, user_message, error_message, received_at, held)
             
             return {
+                'response': error_message,
+                'timestamp': timezone.now().strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': None,
+                'success': False,
+                'unavailable': is_unavailable(e),
+                'error': str(e)
+            }
+        finally:
+            if lock is not None:
+                lock.release()
+    
+    def stream_message(self, user_message, session_key, user=None, client_id='', deadline=None):
+        """Send a message to the AI and yield the response as it is generated"""
+        deadline = deadline or Deadline(getattr(settings, 'LLM_DEADLINE', 60))
+        received_at = None
+        lock = None
+        try:
+            # Get or create session
+            with stage('session'):
+                session = self.get_or_create_session(session_key, user, client_id)
+            
+            # Wait for any turn already in flight on this session
+            with stage('lock_wait'):
+                lock = SessionTurnLock(session).acquire()
+            received_at = timezone.now()  # Turns are ordered by when they got the lock
+            
+            # Build chat history and stream the reply chunk by chunk
+            with stage('history'):
+                history = self.build_chat_history(session, deadline=deadline)
+            response = self.client.resilience.stream(
+                self.config.model_name,
+                self._reply_attempt(history, user_message, stream=True),
+                deadline
+            )
+            
+            # Format as the tokens arrive so clients can render HTML straight away
+            formatter = MarkdownFormatter()
+            formatted = []
+            llm_started = time.perf_counter()
+            first_token = True
+            for chunk in response:
+                text = chunk.text
+                if text:
+                    if first_token:
+                        first_token = False
+                        record_stage('first_token', time.perf_counter() - llm_started)
+                    html = formatter.feed(text)
+                    formatted.append(html)
+                    yield {'event': 'token', 'text': text, 'html': html}
+            tail = formatter.finish()
+            if tail:
+                formatted.append(tail)
+                yield {'event': 'token', 'text': '', 'html': tail}
+            # Includes the time the client took to read the stream
+            record_stage('llm', time.perf_counter() - llm_started)
+            
+            # Save the turn in one transaction; the lock is released once it is stored
+            ai_message = ''.join(formatted)
+            held, lock = lock, None
+            with stage('persist'):
+                _, ai_msg = record_turn(session, user_message, ai_message, received_at, held)
+            
+            TURNS.inc(outcome='success')
+            yield {
+                'event': 'done',
                 'response': ai_message,
                 'timestamp': ai_msg.timestamp.strftime("%H:%M"),
                 'session_key': session_key,
@@ -113,17 +267,101 @@ class AIService:
                 'success': True
             }
             
+        except TurnLockTimeout as e:
+            # Nothing was saved for this turn, so the client can simply retry it
+            TURNS.inc(outcome='busy')
+            yield {
+                'event': 'error',
+                'response': str(e),
+                'timestamp': timezone.now().strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': None,
+                'success': False,
+                'busy': True,
+                'error': str(e)
+            }
+            
         except Exception as e:
-            logger.error(f"Error in AI service: {str(e)}")
+            logger.error(f"Error in AI stream: {str(e)}")
+            TURNS.inc(outcome='error')
             
             # Save error message
             error_message = f"Error: {str(e)} - Could not get response from AI."
             if 'session' in locals():
-                ChatMessage.objects.create(
-                    session=session,
-                    message_type='ai',
-                    content=error_message
+                held, lock = lock, None
+                record_turn(session, user_message, error_message, received_at, held)
+            
+            yield {
+                'event': 'error',
+                'response': error_message,
+                'timestamp': timezone.now().strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': None,
+                'success': False,
+                'unavailable': is_unavailable(e),
+                'error': str(e)
+            }
+        finally:
+            if lock is not None:
+                lock.release()
+    
+    async def asend_message(self, user_message, session_key, user=None, client_id='', deadline=None):
+        """Send a message to the AI and get a response without blocking a worker thread"""
+        deadline = deadline or Deadline(getattr(settings, 'LLM_DEADLINE', 60))
+        received_at = None
+        lock = None
+        try:
+            await self.aload_config()
+            
+            # Get or create session
+            with stage('session'):
+                session = await self.aget_or_create_session(session_key, user, client_id)
+            
+            # Wait for any turn already in flight on this session
+            with stage('lock_wait'):
+                lock = await SessionTurnLock(session).aacquire()
+            received_at = timezone.now()  # Turns are ordered by when they got the lock
+            
+            # Build chat history and await the reply on the event loop
+            with stage('history'):
+                history = await self.abuild_chat_history(session, deadline=deadline)
+            with stage('llm'):
+                response = await self.client.resilience.acall(
+                    self.config.model_name,
+                    self._areply_attempt(history, user_message),
+                    deadline
                 )
+            with stage('format'):
+                ai_message = format_markdown(response.text)
+            
+            # Save the turn in one transaction; the lock is released once it is stored
+            held, lock = lock, None
+            with stage('persist'):
+                _, ai_msg = await arecord_turn(session, user_message, ai_message, received_at, held)
+            
+            TURNS.inc(outcome='success')
+            return {
+                'response': ai_message,
+                'timestamp': ai_msg.timestamp.strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': ai_msg.id,
+                'success': True
+            }
+            
+        except TurnLockTimeout:
+            # Nothing was saved for this turn; the caller reports the session as busy
+            TURNS.inc(outcome='busy')
+            raise
+            
+        except Exception as e:
+            logger.error(f"Error in async AI service: {str(e)}")
+            TURNS.inc(outcome='error')
+            
+            # Save error message
+            error_message = f"Error: {str(e)} - Could not get response from AI."
+            if 'session' in locals():
+                held, lock = lock, None
+                await arecord_turn(session, user_message, error_message, received_at, held)
             
             return {
                 'response': error_message,
@@ -131,22 +369,126 @@ class AIService:
                 'session_key': session_key,
                 'message_id': None,
                 'success': False,
+                'unavailable': is_unavailable(e),
                 'error': str(e)
             }
+        finally:
+            if lock is not None:
+                await lock.arelease()
     
-    def _manage_session_limit(self, user):
-        """Keep only 20 non-archived sessions per user, delete oldest ones"""
-        non_archived_sessions = ChatSession.objects.filter(
-            user=user,
-            is_archived=False,
-            is_active=True
-        ).order_by('-updated_at')
-        
-        if non_archived_sessions.count() > 20:
-            # Delete sessions beyond the 20 limit
-            sessions_to_delete = non_archived_sessions[20:]
-            for session in sessions_to_delete:
-                session.delete()
+    async def astream_message(self, user_message, session_key, user=None, client_id='', deadline=None):
+        """Send a message to the AI and asynchronously yield the response as it is generated"""
+        deadline = deadline or Deadline(getattr(settings, 'LLM_DEADLINE', 60))
+        received_at = None
+        lock = None
+        formatted = None  # The reply so far, while it is being generated
+        try:
+            await self.aload_config()
+            
+            # Get or create session
+            with stage('session'):
+                session = await self.aget_or_create_session(session_key, user, client_id)
+            
+            # Wait for any turn already in flight on this session
+            with stage('lock_wait'):
+                lock = await SessionTurnLock(session).aacquire()
+            received_at = timezone.now()  # Turns are ordered by when they got the lock
+            
+            # Build chat history and stream the reply chunk by chunk
+            with stage('history'):
+                history = await self.abuild_chat_history(session, deadline=deadline)
+            response = self.client.resilience.astream(
+                self.config.model_name,
+                self._areply_attempt(history, user_message, stream=True),
+                deadline
+            )
+            
+            # Format as the tokens arrive so clients can render HTML straight away
+            formatter = MarkdownFormatter()
+            formatted = []
+            llm_started = time.perf_counter()
+            first_token = True
+            async for chunk in response:
+                text = chunk.text
+                if text:
+                    if first_token:
+                        first_token = False
+                        record_stage('first_token', time.perf_counter() - llm_started)
+                    html = formatter.feed(text)
+                    formatted.append(html)
+                    yield {'event': 'token', 'text': text, 'html': html}
+            tail = formatter.finish()
+            if tail:
+                formatted.append(tail)
+                yield {'event': 'token', 'text': '', 'html': tail}
+            # Includes the time the client took to read the stream
+            record_stage('llm', time.perf_counter() - llm_started)
+            
+            # Save the turn in one transaction; the lock is released once it is stored
+            ai_message = ''.join(formatted)
+            formatted = None
+            held, lock = lock, None
+            with stage('persist'):
+                _, ai_msg = await arecord_turn(session, user_message, ai_message, received_at, held)
+            
+            TURNS.inc(outcome='success')
+            yield {
+                'event': 'done',
+                'response': ai_message,
+                'timestamp': ai_msg.timestamp.strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': ai_msg.id,
+                'success': True
+            }
+            
+        except (asyncio.CancelledError, GeneratorExit):
+            # Cancelled, or the client went away: the upstream call is abandoned
+            # and the part of the reply generated so far is kept
+            TURNS.inc(outcome='cancelled')
+            if formatted:
+                partial = ''.join(formatted) + formatter.finish()
+                held, lock = lock, None
+                await asyncio.shield(arecord_turn(session, user_message, partial, received_at, held))
+                logger.info(f"Saved partial reply of a cancelled turn in session {session_key}")
+            raise
+            
+        except TurnLockTimeout as e:
+            # Nothing was saved for this turn, so the client can simply retry it
+            TURNS.inc(outcome='busy')
+            yield {
+                'event': 'error',
+                'response': str(e),
+                'timestamp': timezone.now().strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': None,
+                'success': False,
+                'busy': True,
+                'error': str(e)
+            }
+            
+        except Exception as e:
+            logger.error(f"Error in async AI stream: {str(e)}")
+            TURNS.inc(outcome='error')
+            
+            # Save error message
+            error_message = f"Error: {str(e)} - Could not get response from AI."
+            if 'session' in locals():
+                held, lock = lock, None
+                await arecord_turn(session, user_message, error_message, received_at, held)
+            
+            yield {
+                'event': 'error',
+                'response': error_message,
+                'timestamp': timezone.now().strftime("%H:%M"),
+                'session_key': session_key,
+                'message_id': None,
+                'success': False,
+                'unavailable': is_unavailable(e),
+                'error': str(e)
+            }
+        finally:
+            if lock is not None:
+                await lock.arelease()
     
     def archive_session(self, session_key, user=None):
         """Archive a session to keep it forever"""
@@ -154,7 +496,7 @@ class AIService:
             session = ChatSession.objects.get(session_key=session_key, is_active=True)
             if user is None or session.user == user:
                 session.is_archived = True
-                session.save()
+                session.save(update_fields=['is_archived', 'updated_at'])
                 return True
             return False
         except ChatSession.DoesNotExist:
@@ -166,63 +508,132 @@ class AIService:
             session = ChatSession.objects.get(session_key=session_key, is_active=True)
             if user is None or session.user == user:
                 session.is_archived = False
-                session.save()
-                # Check if we need to manage session limit
-                if user:
-                    self._manage_session_limit(user)
+                session.save(update_fields=['is_archived', 'updated_at'])
                 return True
             return False
         except ChatSession.DoesNotExist:
             return False
     
-    def get_user_sessions(self, user, include_archived=True):
+    def get_user_sessions(self, user, include_archived=True, limit=None):
         """Get all sessions for a user"""
         query = ChatSession.objects.filter(user=user, is_active=True)
         if not include_archived:
             query = query.filter(is_archived=False)
-        
+        return self._list_sessions(query, limit)
+    
+    def get_client_sessions(self, client_id, limit=None):
+        """Get the sessions an anonymous client created"""
+        query = ChatSession.objects.filter(client_id=client_id, user__isnull=True, is_active=True)
+        return self._list_sessions(query, limit)
+    
+    def _list_sessions(self, query, limit=None):
         sessions = query.order_by('-updated_at')
+        if limit:
+            sessions = sessions[:limit]
+        
+        return [self._serialize_session(session) for session in sessions]
+    
+    def get_session_changes(self, sessions, since, limit=None):
+        """
+        Sessions of a queryset updated since a time, newest first.
         
-        return [{
+        Returns {'sessions': [...], 'removed': [keys of cleared sessions]},
+        or None if more than limit changed and a full listing is cheaper.
+        """
+        changed = sessions.filter(updated_at__gt=since).order_by('-updated_at')
+        changed = list(changed[:limit + 1] if limit else changed)
+        if limit and len(changed) > limit:
+            return None
+        return {
+            'sessions': [self._serialize_session(session) for session in changed if session.is_active],
+            'removed': [session.session_key for session in changed if not session.is_active],
+        }
+    
+    def _serialize_session(self, session):
+        return {
             'session_key': session.session_key,
             'title': session.get_title(),
             'created_at': session.created_at.isoformat(),
             'updated_at': session.updated_at.isoformat(),
             'is_archived': session.is_archived,
-            'message_count': session.messages.count()
-        } for session in sessions]
-    
-    def _format_response(self, message):
-        """Format AI response text"""
-        # Process bold text formatting
-        while "**" in message:
-            message = message.replace("**", "<strong>", 1)
-            if "**" in message:
-                message = message.replace("**", "</strong>", 1)
-        return message
+            'message_count': session.message_count
+        }
     
     def clear_session(self, session_key):
         """Clear a chat session"""
         try:
             session = ChatSession.objects.get(session_key=session_key, is_active=True)
             session.is_active = False
-            session.save()
+            session.save(update_fields=['is_active', 'updated_at'])
             return True
         except ChatSession.DoesNotExist:
             return False
     
+    def _serialize_message(self, msg):
+        return {
+            'id': msg.id,
+            'text': msg.content,
+            'is_user': msg.message_type == 'user',
+            'timestamp': msg.timestamp.strftime("%H:%M")
+        }
+    
     def get_session_history(self, session_key):
         """Get chat history for a session"""
         try:
             session = ChatSession.objects.get(session_key=session_key, is_active=True)
-            messages = session.messages.all().order_by('timestamp')
-            return [{
-                'text': msg.content,
-                'is_user': msg.message_type == 'user',
-                'timestamp': msg.timestamp.strftime("%H:%M")
-            } for msg in messages]
+            return [self._serialize_message(msg) for msg in session_messages(session)]
         except ChatSession.DoesNotExist:
             return []
+    
+    def get_session_history_page(self, session_key, before=None, after=None, page_size=DEFAULT_PAGE_SIZE):
+        """Get one keyset-paginated page of chat history for a session"""
+        try:
+            session = ChatSession.objects.get(session_key=session_key, is_active=True)
+        except ChatSession.DoesNotExist:
+            return {'messages': [], 'previous_cursor': None, 'next_cursor': None}
+        
+        # Cold sessions are paged from the transcript; only a new turn thaws them
+        if session.is_cold:
+            page = paginate_message_list(session_messages(session), before=before, after=after, page_size=page_size)
+        else:
+            page = paginate_messages(session.messages.all(), before=before, after=after, page_size=page_size)
+        page['messages'] = [self._serialize_message(msg) for msg in page['messages']]
+        return page
+    
+    def get_session_history_since(self, session_key, since, page_size=DEFAULT_PAGE_SIZE):
+        """Messages of a session after a cursor, with the cursor to continue from"""
+        position = decode_cursor(since)
+        try:
+            session = ChatSession.objects.get(session_key=session_key, is_active=True)
+        except ChatSession.DoesNotExist:
+            return {'messages': [], 'cursor': since, 'has_more': False}
+        
+        if session.is_cold:
+            rows = [msg for msg in session_messages(session) if (msg.timestamp, msg.id) > position][:page_size + 1]
+        else:
+            rows = list(session.messages.filter(after_position(*position)).order_by('timestamp', 'id')[:page_size + 1])
+        page = rows[:page_size]
+        return {
+            'messages': [self._serialize_message(msg) for msg in page],
+            'cursor': encode_cursor(page[-1]) if page else since,
+            'has_more': len(rows) > page_size,
+        }
+    
+    def iter_session_history(self, session_key, chunk_size=500):
+        """Iterate over a session's full history, fetching rows in chunks"""
+        try:
+            session = ChatSession.objects.only('id', 'is_cold').get(session_key=session_key, is_active=True)
+        except ChatSession.DoesNotExist:
+            return
+        
+        if session.is_cold:
+            for msg in session_messages(session):
+                yield self._serialize_message(msg)
+            return
+        
+        messages = session.messages.only('id', 'message_type', 'content', 'timestamp').order_by('timestamp', 'id')
+        for msg in messages.iterator(chunk_size=chunk_size):
+            yield self._serialize_message(msg)
 
 
 class SessionManager:
@@ -239,13 +650,12 @@ class SessionManager:
         """Get statistics for a session"""
         try:
             session = ChatSession.objects.get(session_key=session_key)
-            messages = session.messages.all()
             
             return {
-                'total_messages': messages.count(),
-                'user_messages': messages.filter(message_type='user').count(),
-                'ai_messages': messages.filter(message_type='ai').count(),
-                'total_characters': sum(msg.character_count for msg in messages),
+                'total_messages': session.message_count,
+                'user_messages': session.user_message_count,
+                'ai_messages': session.ai_message_count,
+                'total_characters': session.total_characters,
                 'session_duration': (timezone.now() - session.created_at).total_seconds(),
                 'last_activity': session.updated_at
             }
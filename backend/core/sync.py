@@ -0,0 +1,101 @@
+"""
+Conditional GETs and delta sync for the session list and chat history.
+
+Both endpoints derive a version from a single cheap query before building
+their body: for the session list, the newest updated_at and the number of
+the caller's sessions (cleared ones included, so clearing a chat changes
+it); for a history, the session's updated_at, message_count and newest
+message id (read from the cold transcript for a frozen session). The version becomes a weak ETag and Last-Modified, and a
+request whose If-None-Match (or If-Modified-Since) still matches gets a 304
+without anything else being read.
+
+`since=<cursor>` asks for changes only. Every response carries a `cursor`
+to send next time: for the session list it returns the sessions updated
+since (and the keys of cleared ones under `removed`); for a history, the
+messages after the cursor. Sessions deleted by retention are not reported,
+so clients should still reload the full list now and then (e.g. on start).
+"""
+from datetime import timedelta
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
+from .cold_storage import last_cold_message
+from .identity import HEADER as CLIENT_HEADER
+from .models import ChatSession, ChatMessage
+from .pagination import encode_cursor
+import base64
+import hashlib
+
+# Cursors lag the clock by this much, so a turn that was still committing
+# when a cursor was issued is not missed (recent sessions are sent twice)
+SINCE_OVERLAP = timedelta(seconds=5)
+
+
+def make_etag(*parts):
+    """Weak ETag over the parts of a version"""
+    digest = hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def encode_since(last_modified):
+    """Opaque session list cursor for a list last modified at a time"""
+    timestamp = min(last_modified, timezone.now() - SINCE_OVERLAP)
+    return base64.urlsafe_b64encode(timestamp.isoformat().encode()).decode().rstrip('=')
+
+
+def decode_since(cursor):
+    """Decode a session list cursor, raising ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        parsed = parse_datetime(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if parsed is None:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return parsed
+
+
+def owner_sessions(user=None, client_id=''):
+    """Every session of a user or anonymous client, cleared ones included"""
+    if user is not None and user.is_authenticated:
+        return ChatSession.objects.filter(user=user)
+    return ChatSession.objects.filter(user__isnull=True, client_id=client_id)
+
+
+def session_list_version(user=None, client_id=''):
+    """(etag, last_modified) of a caller's session list, in one aggregate query"""
+    version = owner_sessions(user, client_id).aggregate(updated=Max('updated_at'), count=Count('id'))
+    owner = f'user:{user.pk}' if user is not None and user.is_authenticated else f'client:{client_id}'
+    return make_etag('sessions', owner, version['count'], version['updated']), version['updated']
+
+
+def session_version(session):
+    """(etag, last_modified, cursor of the newest message) of one session's history"""
+    # Not session.messages: the related manager would load each row's session_id
+    last = ChatMessage.objects.filter(session=session).only('id', 'timestamp').order_by('-timestamp', '-id').first()
+    if last is None and session.is_cold:
+        # Rows left in the table are newer than the transcript, so only read it when there are none
+        last = last_cold_message(session)
+    etag = make_etag('history', session.pk, session.updated_at, session.message_count, last.id if last else None)
+    return etag, session.updated_at, encode_cursor(last) if last else None
+
+
+def not_modified(request, etag, last_modified):
+    """A 304 response if the client's copy is current, else None"""
+    return get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+
+
+def add_validators(response, etag, last_modified):
+    """Set the validators and make clients revalidate instead of reusing the response"""
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Cookie', CLIENT_HEADER])
+    return response
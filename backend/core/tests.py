@@ -1,12 +1,61 @@
-from django.test import TestCase, Client
+from django.test import TestCase, TransactionTestCase, Client, AsyncClient, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
-from rest_framework.test import APITestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import asyncio
+import datetime
+import gzip
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from rest_framework.test import APIClient, APITestCase
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from backend.asgi import application as asgi_application
+from io import StringIO
 from rest_framework import status
+from unittest import mock
+from google.api_core import exceptions as api_exceptions
 import json
 
-from .models import ChatSession, ChatMessage, AIConfig
+from .models import ChatSession, ChatMessage, ColdTranscript, AIConfig, IdempotencyRecord
 from .services import AIService, SessionManager
+from .llm import get_llm_client, reset_llm_client
+from .context import ContextWindow
+from .formatting import MarkdownFormatter, format_markdown, to_markdown
+from .ai_config import aget_active_config, get_active_config, invalidate_ai_config
+from .retention import RetentionPolicy, apply_retention, retention_stats
+from .locks import SessionTurnLock, TurnLockTimeout
+from .persistence import WriteBehindBuffer, record_turn
+from .identity import issue_client_token
+from .history_cache import HistoryCache, get_history_cache, reset_history_cache
+from .resilience import CircuitBreaker, Deadline, ResilientCaller
+from .cold_storage import TieringPolicy, freeze_session, storage_report, thaw_session, tier_sessions
+from .transfer import ChatImporter, export_lines, filter_sessions
+from .tokens import estimate_tokens
+from .search import COLD_FTS_TABLE, get_search_backend, search_messages, search_terms
+from .pagination import encode_cursor
+from .profiling import HEADER as PROFILE_HEADER, issue_profile_token, rotate
+from .ratelimit import LocalBuckets, parse_rate, try_admit, release_admission, inflight_generations
+from .consumers import ChatConsumer
+
+# All test clients share one address: keep the process-wide rate limits out of
+# tests that are not about them (RateLimitTest turns them back on)
+_rate_limits_off = override_settings(RATE_LIMIT_ENABLED=False)
+
+
+def setUpModule():
+    _rate_limits_off.enable()
+
+
+def tearDownModule():
+    _rate_limits_off.disable()
 
 
 class ChatSessionModelTest(TestCase):
@@ -45,6 +94,1068 @@ class ChatMessageModelTest(TestCase):
         self.assertIn('user:', str(self.message))
 
 
+class SessionCountersTest(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create(session_key='counter-session')
+
+    def test_counters_maintained_on_write(self):
+        ChatMessage.objects.create(session=self.session, message_type='user', content='How do I relax?')
+        ai_msg = ChatMessage.objects.create(session=self.session, message_type='ai', content='Try <strong>breathing</strong> slowly.')
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 2)
+        self.assertEqual(self.session.user_message_count, 1)
+        self.assertEqual(self.session.ai_message_count, 1)
+        self.assertEqual(self.session.total_characters, len('How do I relax?') + ai_msg.character_count)
+        self.assertEqual(self.session.last_message_at, ai_msg.timestamp)
+        self.assertEqual(self.session.last_message_preview, 'Try breathing slowly.')
+        self.assertEqual(self.session.title, 'How do I relax?')
+
+    def test_title_set_once_from_first_user_message(self):
+        ChatMessage.objects.create(session=self.session, message_type='user', content='x' * 60)
+        ChatMessage.objects.create(session=self.session, message_type='user', content='Second')
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.title, 'x' * 50 + '...')
+
+    def test_loaded_session_kept_in_step(self):
+        ChatMessage.objects.create(session=self.session, message_type='user', content='Hello')
+        self.assertEqual(self.session.message_count, 1)
+        self.session.save()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 1)
+
+    def test_session_listing_is_one_query(self):
+        user = User.objects.create_user(username='lister', password='testpass123')
+        for i in range(5):
+            session = ChatSession.objects.create(session_key=f'listing-{i}', user=user)
+            ChatMessage.objects.create(session=session, message_type='user', content='Hi')
+        with self.assertNumQueries(1):
+            sessions = AIService().get_user_sessions(user)
+        self.assertEqual(len(sessions), 5)
+        self.assertEqual(sessions[0]['message_count'], 1)
+        self.assertEqual(sessions[0]['title'], 'Hi')
+
+    def test_sync_command_checks_and_backfills(self):
+        ChatMessage.objects.create(session=self.session, message_type='user', content='Hello')
+        ChatSession.objects.filter(pk=self.session.pk).update(message_count=0, last_message_preview='')
+
+        out = StringIO()
+        call_command('sync_session_counters', '--check', stdout=out)
+        self.assertIn('1 out of date', out.getvalue())
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 0)
+
+        call_command('sync_session_counters', stdout=StringIO())
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 1)
+        self.assertEqual(self.session.last_message_preview, 'Hello')
+
+        out = StringIO()
+        call_command('sync_session_counters', '--check', stdout=out)
+        self.assertIn('0 out of date', out.getvalue())
+
+
+class ContextWindowTest(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create(session_key='context-session')
+        self.llm = mock.Mock()
+        self.llm.summarize.return_value = 'User talked about work stress.'
+
+    def _add_turns(self, count, start=0, words=40):
+        for i in range(start, start + count):
+            ChatMessage.objects.create(session=self.session, message_type='user', content=f'question {i} ' + 'word ' * words)
+            ChatMessage.objects.create(session=self.session, message_type='ai', content=f'answer {i} ' + 'word ' * words)
+
+    def test_token_count_recorded(self):
+        message = ChatMessage.objects.create(session=self.session, message_type='user', content='x' * 40)
+        self.assertEqual(message.token_count, 10)
+
+    def test_short_session_sent_in_full(self):
+        self._add_turns(2)
+        history = ContextWindow(self.llm, token_budget=1000).build(self.session)
+        self.assertEqual(len(history), 4)
+        self.llm.summarize.assert_not_called()
+
+    def test_old_turns_folded_into_summary(self):
+        self._add_turns(10)
+        history = ContextWindow(self.llm, token_budget=300).build(self.session)
+
+        self.llm.summarize.assert_called_once()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, 'User talked about work stress.')
+        self.assertIsNotNone(self.session.summary_last_message_id)
+
+        # Summary pair first, then the newest turns starting on a user turn
+        self.assertIn('work stress', history[0]['parts'][0]['text'])
+        self.assertEqual(history[2]['role'], 'user')
+        self.assertTrue(history[-1]['parts'][0]['text'].startswith('answer 9'))
+        kept_tokens = sum(len(entry['parts'][0]['text']) // 4 for entry in history[2:])
+        self.assertLessEqual(kept_tokens, 300)
+
+    def test_summary_updated_incrementally(self):
+        self._add_turns(10)
+        window = ContextWindow(self.llm, token_budget=300)
+        window.build(self.session)
+        first_cut = self.session.summary_last_message_id
+
+        # Nothing new aged out: no further summarisation
+        window.build(self.session)
+        self.assertEqual(self.llm.summarize.call_count, 1)
+
+        self._add_turns(5, start=10)
+        window.build(self.session)
+        self.assertEqual(self.llm.summarize.call_count, 2)
+        prompt = self.llm.summarize.call_args[0][0]
+        self.assertIn('User talked about work stress.', prompt)
+        self.assertNotIn('question 0 ', prompt)
+        self.assertGreater(self.session.summary_last_message_id, first_cut)
+
+    def test_summarisation_failure_keeps_window_bounded(self):
+        self._add_turns(10)
+        self.llm.summarize.side_effect = RuntimeError('provider down')
+        history = ContextWindow(self.llm, token_budget=300).build(self.session)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, '')
+        self.assertLess(len(history), 20)
+
+    @override_settings(LLM_PROVIDER='fake', LLM_RETRY_BACKOFF=0.001)
+    def test_summary_is_bounded_by_the_turn_deadline(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        client = get_llm_client()
+        client.provider.inject(latency=30)  # A hung summary call
+        self._add_turns(10)
+
+        started = time.monotonic()
+        window = ContextWindow(client, token_budget=300, model_name='gemini-test', deadline=Deadline(0.2))
+        history = window.build(self.session)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.session.summary, '')
+        self.assertLess(len(history), 20)
+        # Same policy, counters and model as the reply
+        self.assertEqual(client.resilience.stats['calls'], 1)
+        self.assertEqual(client.provider.requests[0]['model'].model_name, 'gemini-test')
+        self.assertIsNone(client.provider.requests[0]['model'].system_instruction)
+
+
+@override_settings(LLM_PROVIDER='fake')
+class HistoryCacheTest(TestCase):
+    def setUp(self):
+        reset_llm_client()
+        reset_history_cache()
+        self.addCleanup(reset_llm_client)
+        self.addCleanup(reset_history_cache)
+        self.service = AIService()
+        self.session = ChatSession.objects.create(session_key='cached-history')
+
+    def test_turns_are_appended_not_reloaded(self):
+        self.service.send_message('First', 'cached-history')
+        self.service.send_message('Second', 'cached-history')
+
+        # Only the session's counters are re-read; the messages come from the cache
+        with self.assertNumQueries(1):
+            history = self.service.build_chat_history(self.session)
+        self.assertEqual([entry['parts'][0]['text'] for entry in history[::2]], ['First', 'Second'])
+        stats = get_history_cache().stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 2)
+        self.assertEqual(stats['appends'], 2)
+
+    def test_messages_written_elsewhere_are_picked_up(self):
+        self.service.send_message('First', 'cached-history')
+        # e.g. a turn served by another node, which this process never saw
+        ChatMessage.objects.create(session=self.session, message_type='user', content='Elsewhere')
+        ChatMessage.objects.create(session=self.session, message_type='ai', content='Reply')
+
+        history = self.service.build_chat_history(self.session)
+        self.assertEqual(history[-2]['parts'][0]['text'], 'Elsewhere')
+        self.assertEqual(get_history_cache().stats()['partial_reloads'], 1)
+
+    @override_settings(CHAT_HISTORY_SHARED_CACHE=True)
+    def test_shared_tier_warms_other_processes(self):
+        self.service.send_message('First', 'cached-history')
+        # A fresh in-process tier, as in another worker
+        other = HistoryCache(shared_alias='default')
+        with self.assertNumQueries(1):
+            messages = other.pending_messages(self.session)
+        self.assertEqual([message.content for message in messages][0], 'First')
+        self.assertEqual(other.stats()['shared_hits'], 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = HistoryCache(max_bytes=1000)
+        for n in range(3):
+            session = ChatSession.objects.create(session_key=f'evict-{n}')
+            ChatMessage.objects.create(session=session, message_type='user', content='x' * 300)
+            cache.pending_messages(session)
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertLessEqual(stats['bytes'], 1000)
+
+
+class QueryPlanTest(TestCase):
+    """
+    Seeds a realistic amount of data, captures the SQL issued by the hot service
+    paths and fails if the database plans any of it as a full scan or filesort.
+    """
+    SESSIONS = 300
+    MESSAGES_PER_SESSION = 20
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='planner', password='testpass123')
+        now = timezone.now()
+        ChatSession.objects.bulk_create([
+            ChatSession(
+                session_key=f'plan-{i}',
+                user=cls.user if i % 3 == 0 else None,
+                client_id='' if i % 3 == 0 else f'client-{i % 10}',
+                is_archived=i % 10 == 0,
+                is_active=i % 7 != 0,
+            )
+            for i in range(cls.SESSIONS)
+        ])
+        sessions = list(ChatSession.objects.all())
+        ChatMessage.objects.bulk_create([
+            ChatMessage(
+                session=session,
+                message_type='user' if j % 2 == 0 else 'ai',
+                content=f'message {j}',
+                character_count=10,
+                token_count=3,
+                timestamp=now + datetime.timedelta(seconds=j),
+            )
+            for session in sessions
+            for j in range(cls.MESSAGES_PER_SESSION)
+        ], batch_size=1000)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute(f'EXPLAIN {sql}')
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def plan_problems(self, plan):
+        """Return the plan steps that scan a whole table or sort without an index"""
+        problems = []
+        derived = set()
+        for step in plan:
+            if connection.vendor == 'sqlite':
+                # Scanning a subquery's own result set is fine; scanning a table is not
+                derived.update(re.findall(r'^(?:CO-ROUTINE|MATERIALIZE) (\S+)', step))
+                scan = re.match(r'SCAN (\S+)$', step)
+                if (scan and scan.group(1) not in derived) or 'USE TEMP B-TREE FOR ORDER BY' in step:
+                    problems.append(step)
+            elif connection.vendor == 'mysql':
+                if step.get('type') == 'ALL' or 'Using filesort' in (step.get('Extra') or ''):
+                    problems.append(step)
+        return problems
+
+    def assertIndexedQueries(self, func):
+        if connection.vendor not in ('sqlite', 'mysql'):
+            self.skipTest(f'No plan checks for {connection.vendor}')
+        with CaptureQueriesContext(connection) as captured:
+            func()
+        selects = [query['sql'] for query in captured.captured_queries if query['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        for sql in selects:
+            plan = self.explain(sql)
+            problems = self.plan_problems(plan)
+            self.assertFalse(problems, f'Unindexed plan for:\n{sql}\n{plan}')
+
+    def test_session_lookup(self):
+        self.assertIndexedQueries(lambda: AIService().get_or_create_session('plan-1'))
+
+    def test_full_history(self):
+        self.assertIndexedQueries(lambda: AIService().get_session_history('plan-1'))
+
+    def test_history_pages(self):
+        service = AIService()
+        page = service.get_session_history_page('plan-1', page_size=5)
+        self.assertIndexedQueries(lambda: service.get_session_history_page('plan-1', page_size=5))
+        self.assertIndexedQueries(
+            lambda: service.get_session_history_page('plan-1', before=page['previous_cursor'], page_size=5)
+        )
+        self.assertIndexedQueries(
+            lambda: service.get_session_history_page('plan-1', after=page['previous_cursor'], page_size=5)
+        )
+
+    def test_transcript_iterator(self):
+        self.assertIndexedQueries(lambda: list(AIService().iter_session_history('plan-1')))
+
+    def test_context_window(self):
+        session = ChatSession.objects.get(session_key='plan-1')
+        llm = mock.Mock()
+        llm.summarize.return_value = 'summary'
+        self.assertIndexedQueries(lambda: ContextWindow(llm, token_budget=20).build(session))
+
+    def test_user_sessions(self):
+        service = AIService()
+        self.assertIndexedQueries(lambda: service.get_user_sessions(self.user))
+        self.assertIndexedQueries(lambda: service.get_user_sessions(self.user, include_archived=False))
+
+    def test_retention_selection(self):
+        policy = RetentionPolicy(max_sessions_per_user=20, inactive_ttl_days=30, anonymous_ttl_days=90)
+        self.assertIndexedQueries(lambda: retention_stats(policy))
+
+    def test_sidebar_listing(self):
+        self.assertIndexedQueries(lambda: AIService().get_client_sessions('client-1', limit=50))
+
+    def test_session_stats(self):
+        self.assertIndexedQueries(lambda: SessionManager.get_session_stats('plan-1'))
+
+
+class SearchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', password='testpass123')
+        self.mine = ChatSession.objects.create(session_key='mine', user=self.user, title='Sleep')
+        self.other = ChatSession.objects.create(session_key='other', client_id='someone-else')
+        ChatMessage.objects.create(session=self.mine, message_type='user', content='I cannot sleep at night')
+        ChatMessage.objects.create(session=self.mine, message_type='ai',
+                                   content='<strong>Sleep</strong> hygiene helps: keep a regular sleep schedule')
+        ChatMessage.objects.create(session=self.mine, message_type='user', content='Work has been stressful')
+        ChatMessage.objects.create(session=self.other, message_type='user', content='I sleep too much')
+
+    def test_search_terms(self):
+        self.assertEqual(search_terms('Sleep "sleep" AND (night*)'), ['sleep', 'and', 'night'])
+
+    def test_search_is_ranked_and_scoped_to_the_owner(self):
+        found = search_messages('sleep', user=self.user)
+        self.assertEqual([result['session_key'] for result in found['results']], ['mine', 'mine'])
+        if get_search_backend().indexed:
+            # The reply that mentions sleep twice ranks first
+            self.assertEqual(found['results'][0]['message_type'], 'ai')
+        self.assertIn('Sleep hygiene', found['results'][0]['snippet'] + found['results'][1]['snippet'])
+        self.assertEqual(search_messages('sleep night', user=self.user)['results'][0]['snippet'],
+                         'I cannot sleep at night')
+        self.assertEqual(len(search_messages('sleep', client_id='someone-else')['results']), 1)
+        self.assertEqual(search_messages('sleep', client_id='nobody')['results'], [])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = ChatMessage.objects.create(session=self.mine, message_type='user', content='insomnia again')
+        self.assertEqual(len(search_messages('insomnia', user=self.user)['results']), 1)
+        message.content = 'restless again'
+        message.save()
+        self.assertEqual(search_messages('insomnia', user=self.user)['results'], [])
+        self.assertEqual(len(search_messages('restless', user=self.user)['results']), 1)
+        ChatMessage.objects.filter(pk=message.pk).delete()
+        self.assertEqual(search_messages('restless', user=self.user)['results'], [])
+
+    def test_markup_is_not_indexed(self):
+        ChatMessage.objects.create(session=self.mine, message_type='ai',
+                                   content=format_markdown("It's **late**:\n- rest & *unwind*\n- lights off"))
+        for markup in ('strong', 'em', 'li', 'ul', 'br', 'amp', 'x27'):
+            self.assertEqual(search_messages(markup, user=self.user)['results'], [], markup)
+        found = search_messages("it's late unwind", user=self.user)['results']
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0]['snippet'], "It's late: rest & unwind lights off")
+        self.assertEqual(ChatMessage.objects.filter(message_type='ai', plain_content__contains='<').count(), 0)
+
+    def test_search_endpoint_pages(self):
+        for i in range(3):
+            ChatMessage.objects.create(session=self.other, message_type='user', content=f'anxious thought {i}')
+        url = reverse('core:chat-search')
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'q': 'anxious', 'page': 0}).status_code, 400)
+
+        token = issue_client_token('someone-else')
+        first = self.client.get(url, {'q': 'anxious', 'page_size': 2}, HTTP_X_CHAT_CLIENT=token).json()
+        self.assertEqual(len(first['results']), 2)
+        self.assertEqual(first['next_page'], 2)
+        second = self.client.get(url, {'q': 'anxious', 'page_size': 2, 'page': 2}, HTTP_X_CHAT_CLIENT=token).json()
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next_page'])
+
+        # Query syntax is treated as plain words
+        response = self.client.get(url, {'q': '"anxious* OR (NEAR'}, HTTP_X_CHAT_CLIENT=token)
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_search(self):
+        User.objects.create_superuser(username='admin', password='testpass123', email='admin@example.com')
+        self.client.login(username='admin', password='testpass123')
+        response = self.client.get(reverse('admin:core_chatmessage_changelist'), {'q': 'stressful'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Work has been stressful')
+        self.assertNotContains(response, 'I cannot sleep')
+
+    def test_search_uses_the_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Plan check is for SQLite FTS5')
+        with CaptureQueriesContext(connection) as captured:
+            search_messages('sleep', user=self.user)
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {captured.captured_queries[0]['sql']}")
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue(any('VIRTUAL TABLE' in step for step in plan), plan)
+        self.assertFalse([step for step in plan if re.match(r'SCAN (m|s|core_chatmessage)\b', step)], plan)
+
+
+class RetentionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='keeper', password='testpass123')
+        self.now = timezone.now()
+
+    def _session(self, key, days_old=0, **fields):
+        session = ChatSession.objects.create(session_key=key, **fields)
+        ChatMessage.objects.create(session=session, message_type='user', content='Hello')
+        ChatSession.objects.filter(pk=session.pk).update(updated_at=self.now - datetime.timedelta(days=days_old))
+        return session
+
+    def test_per_user_cap_keeps_newest_and_archived(self):
+        for i in range(5):
+            self._session(f'user-{i}', days_old=i, user=self.user)
+        self._session('user-archived', days_old=30, user=self.user, is_archived=True)
+
+        policy = RetentionPolicy(max_sessions_per_user=3)
+        results = apply_retention(policy, now=self.now)
+
+        self.assertEqual(results['per_user_cap'], {'sessions': 2, 'messages': 2})
+        remaining = set(ChatSession.objects.values_list('session_key', flat=True))
+        self.assertEqual(remaining, {'user-0', 'user-1', 'user-2', 'user-archived'})
+
+    def test_ttl_rules(self):
+        self._session('cleared-old', days_old=40, user=self.user, is_active=False)
+        self._session('cleared-recent', days_old=5, user=self.user, is_active=False)
+        self._session('anon-old', days_old=100)
+        self._session('anon-recent', days_old=10)
+        self._session('anon-archived', days_old=100, is_archived=True)
+
+        policy = RetentionPolicy(inactive_ttl_days=30, anonymous_ttl_days=90)
+        apply_retention(policy, now=self.now)
+
+        remaining = set(ChatSession.objects.values_list('session_key', flat=True))
+        self.assertEqual(remaining, {'cleared-recent', 'anon-recent', 'anon-archived'})
+        self.assertFalse(ChatMessage.objects.filter(session__session_key='anon-old').exists())
+
+    def test_deletes_in_chunks(self):
+        for i in range(7):
+            self._session(f'anon-{i}', days_old=100)
+        policy = RetentionPolicy(anonymous_ttl_days=90, chunk_size=3)
+        results = apply_retention(policy, now=self.now)
+        self.assertEqual(results['anonymous_ttl'], {'sessions': 7, 'messages': 7})
+        self.assertFalse(ChatSession.objects.exists())
+
+    def test_dry_run_stats(self):
+        self._session('anon-old', days_old=100)
+        stats = retention_stats(RetentionPolicy(anonymous_ttl_days=90), now=self.now)
+        self.assertEqual(stats['anonymous_ttl'], {'sessions': 1, 'messages': 1})
+        self.assertTrue(ChatSession.objects.exists())
+
+    def test_command_dry_run(self):
+        self._session('anon-old', days_old=100)
+        out = StringIO()
+        with self.settings(CHAT_RETENTION_ANONYMOUS_TTL_DAYS=90):
+            call_command('apply_retention', '--dry-run', stdout=out)
+        self.assertIn('anonymous_ttl: would delete 1 sessions, 1 messages', out.getvalue())
+        self.assertTrue(ChatSession.objects.exists())
+
+
+@override_settings(LLM_PROVIDER='fake')
+class ColdStorageTest(TestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.session = ChatSession.objects.create(session_key='cold', is_archived=True)
+        for i in range(6):
+            ChatMessage.objects.create(session=self.session, message_type='user' if i % 2 == 0 else 'ai',
+                                       content=f'Message number {i} ' * 20)
+        # Idle for 40 days: due as an archived session, not as an ordinary one
+        ChatSession.objects.filter(pk=self.session.pk).update(updated_at=timezone.now() - datetime.timedelta(days=40))
+        self.fresh = ChatSession.objects.create(session_key='fresh')
+        for i in range(6):
+            ChatMessage.objects.create(session=self.fresh, message_type='user', content='hello')
+        self.service = AIService()
+        self.history = self.service.get_session_history('cold')
+
+    def test_tiering_packs_idle_sessions(self):
+        moved = tier_sessions(TieringPolicy(idle_days=90, archived_idle_days=30, min_messages=4))
+        self.assertEqual((moved['sessions'], moved['messages']), (1, 6))
+        self.assertLess(moved['compressed_bytes'], moved['raw_bytes'] / 5)
+        self.assertFalse(ChatMessage.objects.filter(session=self.session).exists())
+        self.assertEqual(ChatMessage.objects.filter(session=self.fresh).count(), 6)
+
+        # Reads are served from the blob without thawing; counters are untouched
+        self.assertEqual(self.service.get_session_history('cold'), self.history)
+        self.assertEqual(list(self.service.iter_session_history('cold')), self.history)
+        self.assertEqual(SessionManager.get_session_stats('cold')['total_messages'], 6)
+        self.assertTrue(ChatSession.objects.get(pk=self.session.pk).is_cold)
+
+        report = storage_report(TieringPolicy(idle_days=90, archived_idle_days=30, min_messages=4))
+        self.assertEqual((report['cold_sessions'], report['cold_messages'], report['candidate_sessions']), (1, 6, 0))
+        self.assertGreater(report['saved_bytes'], 0)
+
+    def test_pages_and_deltas_do_not_thaw(self):
+        messages = list(ChatMessage.objects.filter(session=self.session).order_by('timestamp', 'id'))
+        hot_first = self.service.get_session_history_page('cold', page_size=4)
+        hot_older = self.service.get_session_history_page('cold', before=hot_first['previous_cursor'], page_size=4)
+        freeze_session(self.session)
+
+        first = self.service.get_session_history_page('cold', page_size=4)
+        self.assertEqual(first, hot_first)
+        self.assertEqual(self.service.get_session_history_page('cold', before=first['previous_cursor'], page_size=4),
+                         hot_older)
+        self.assertEqual(self.service.get_session_history_page('cold', after=encode_cursor(messages[0]),
+                                                               page_size=50)['messages'], self.history[1:])
+        since = self.service.get_session_history_since('cold', encode_cursor(messages[3]), page_size=1)
+        self.assertEqual(since['messages'], self.history[4:5])
+        self.assertTrue(since['has_more'])
+        self.assertEqual(since['cursor'], encode_cursor(messages[4]))
+
+        self.assertFalse(ChatMessage.objects.filter(session=self.session).exists())
+        self.assertTrue(ColdTranscript.objects.exists())
+        self.assertTrue(ChatSession.objects.get(pk=self.session.pk).is_cold)
+
+    def test_cold_sessions_stay_searchable(self):
+        ChatSession.objects.filter(pk=self.session.pk).update(client_id='archivist')
+        ChatMessage.objects.create(session=self.session, message_type='user', content='A note about gardening')
+        hot = ChatSession.objects.create(session_key='hot', client_id='archivist')
+        ChatMessage.objects.create(session=hot, message_type='user', content='More gardening today')
+        freeze_session(ChatSession.objects.get(pk=self.session.pk))
+
+        found = search_messages('gardening', client_id='archivist')
+        self.assertEqual([(r['session_key'], r['snippet']) for r in found['results']],
+                         [('hot', 'More gardening today'), ('cold', 'A note about gardening')])
+        self.assertEqual(len(search_messages('number 3', client_id='archivist')['results']), 1)
+        self.assertEqual(search_messages('gardening', client_id='someone-else')['results'], [])
+        # Paging runs on past the hot matches into the cold ones
+        second = search_messages('gardening', client_id='archivist', page=2, page_size=1)
+        self.assertEqual([r['session_key'] for r in second['results']], ['cold'])
+        self.assertIsNone(second['next_page'])
+
+        # Thawing moves the messages back to the message index, without duplicates
+        thaw_session(ChatSession.objects.get(pk=self.session.pk))
+        self.assertEqual([r['session_key'] for r in search_messages('gardening', client_id='archivist')['results']],
+                         ['hot', 'cold'])
+        freeze_session(ChatSession.objects.get(pk=self.session.pk))
+        self.assertEqual(len(search_messages('gardening', client_id='archivist')['results']), 2)
+
+    def test_cold_search_ignores_markup_and_forgets_deleted_sessions(self):
+        ChatSession.objects.filter(pk=self.session.pk).update(client_id='archivist')
+        ChatMessage.objects.create(session=self.session, message_type='ai',
+                                   content=format_markdown('Try **pruning** & weeding'))
+        freeze_session(ChatSession.objects.get(pk=self.session.pk))
+        self.assertEqual(len(search_messages('pruning weeding', client_id='archivist')['results']), 1)
+        self.assertEqual(search_messages('strong', client_id='archivist')['results'], [])
+        self.assertEqual(search_messages('amp', client_id='archivist')['results'], [])
+
+        # Retention deletes the session, and its transcript with it
+        ChatSession.objects.filter(pk=self.session.pk).delete()
+        if connection.vendor == 'sqlite' and get_search_backend().indexed:
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT rowid FROM {COLD_FTS_TABLE} WHERE {COLD_FTS_TABLE} MATCH 'pruning'")
+                self.assertEqual(cursor.fetchall(), [])
+
+    def test_new_turn_thaws_and_keeps_context(self):
+        freeze_session(self.session)
+        result = self.service.send_message('And now?', 'cold')
+        self.assertTrue(result['success'])
+        session = ChatSession.objects.get(pk=self.session.pk)
+        self.assertFalse(session.is_cold)
+        self.assertEqual(session.message_count, 8)
+        self.assertEqual(self.service.get_session_history('cold')[:6], self.history)
+
+    def test_busy_session_is_skipped(self):
+        lock = SessionTurnLock(self.session).acquire()
+        try:
+            self.assertIsNone(freeze_session(self.session))
+        finally:
+            lock.release()
+        self.assertEqual(ChatMessage.objects.filter(session=self.session).count(), 6)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('tier_sessions', stdout=out)
+        self.assertIn('Moved 1 sessions (6 messages)', out.getvalue())
+        call_command('tier_sessions', thaw='cold', stdout=out)
+        self.assertEqual(ChatMessage.objects.filter(session=self.session).count(), 6)
+
+
+class TransferTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='exporter', password='testpass123')
+        self.kept = ChatSession.objects.create(session_key='kept', user=self.user, is_archived=True)
+        for i in range(7):
+            ChatMessage.objects.create(session=self.kept, message_type='user' if i % 2 == 0 else 'ai',
+                                       content=f'Turn {i} ✓')
+        folded = self.kept.messages.order_by('timestamp', 'id')[2]
+        ChatSession.objects.filter(pk=self.kept.pk).update(summary='Earlier turns', summary_last_message_id=folded.id)
+        self.anonymous = ChatSession.objects.create(session_key='anon', client_id='c1')
+        ChatMessage.objects.create(session=self.anonymous, message_type='user', content='Hi')
+        ChatSession.objects.create(session_key='empty', client_id='c1')
+        freeze_session(self.anonymous)  # Cold sessions are exported too
+        self.service = AIService()
+        self.histories = {key: self.service.get_session_history(key) for key in ('kept', 'anon', 'empty')}
+
+    def export(self, sessions=None):
+        return list(export_lines(sessions if sessions is not None else ChatSession.objects.all()))
+
+    def test_round_trip(self):
+        lines = self.export()
+        self.assertEqual([json.loads(line)['kind'] for line in lines].count('message'), 8)
+        ChatSession.objects.all().delete()
+
+        # Per session: a fixed few queries plus one INSERT and one counter UPDATE per batch
+        with self.assertNumQueries(25):
+            stats = ChatImporter(batch_size=3).run(lines)
+        self.assertEqual((stats['sessions'], stats['messages'], stats['skipped']), (3, 8, 0))
+
+        session = ChatSession.objects.get(session_key='kept')
+        self.assertEqual(session.user, self.user)
+        self.assertTrue(session.is_archived)
+        self.assertEqual((session.message_count, session.user_message_count), (7, 4))
+        self.assertEqual(session.title, 'Turn 0 ✓')
+        # The summary still covers the first three messages
+        self.assertEqual(session.messages.filter(id__lte=session.summary_last_message_id).count(), 3)
+        for key, history in self.histories.items():
+            imported = self.service.get_session_history(key)
+            self.assertEqual([(m['text'], m['is_user']) for m in imported], [(m['text'], m['is_user']) for m in history])
+        self.assertEqual(ChatMessage.objects.get(content='Hi').token_count, estimate_tokens('Hi'))
+
+        # Running it again resumes: everything already imported is skipped
+        self.assertEqual(ChatImporter().run(lines)['skipped'], 3)
+
+    def test_filters(self):
+        self.assertEqual(filter_sessions(username='exporter').count(), 1)
+        self.assertEqual(filter_sessions(archived=False).count(), 2)
+        self.assertEqual(filter_sessions(since=timezone.now() + datetime.timedelta(days=1)).count(), 0)
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'chats.jsonl.gz')
+            out = StringIO()
+            call_command('export_chats', path, archived='only', stdout=out)
+            self.assertIn('Exported 1 sessions, 7 messages', out.getvalue())
+
+            ChatSession.objects.filter(session_key='kept').delete()
+            User.objects.all().delete()
+            call_command('import_chats', path, stdout=out)
+            self.assertIn('imported without one', out.getvalue())
+            self.assertIsNone(ChatSession.objects.get(session_key='kept').user)
+
+    def test_admin_export_streams(self):
+        User.objects.create_superuser(username='admin', password='testpass123', email='admin@example.com')
+        self.client.login(username='admin', password='testpass123')
+        response = self.client.post(reverse('admin:core_chatsession_changelist'), {
+            'action': 'export_jsonl',
+            '_selected_action': [self.kept.pk, self.anonymous.pk],
+        })
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(lines[1:], [line.rstrip('\n') for line in self.export(
+            ChatSession.objects.filter(pk__in=[self.kept.pk, self.anonymous.pk])
+        )][1:])
+
+
+@override_settings(LLM_PROVIDER='fake')
+class TurnLockTest(TestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+        self.provider.reply = lambda message, history: f"Reply to {message}"
+
+    async def test_concurrent_turns_on_one_session_do_not_interleave(self):
+        # Turns interleave at every await, so without the lock user messages
+        # would all land before any reply
+        service = AIService()
+        results = await asyncio.gather(*[
+            service.asend_message(f"Message {n}", 'race-session') for n in range(4)
+        ])
+        self.assertTrue(all(result['success'] for result in results))
+
+        # Exactly one session was created despite the racing first requests
+        session = await ChatSession.objects.aget(session_key='race-session')
+        messages = [msg async for msg in session.messages.order_by('timestamp', 'id')]
+        self.assertEqual(len(messages), 8)
+        for user_msg, ai_msg in zip(messages[::2], messages[1::2]):
+            self.assertEqual(user_msg.message_type, 'user')
+            self.assertEqual(ai_msg.content, f"Reply to {user_msg.content}")
+        self.assertIsNone(session.turn_locked_until)
+
+    def test_busy_session_returns_conflict(self):
+        session = ChatSession.objects.create(session_key='busy-session')
+        with SessionTurnLock(session):
+            with override_settings(CHAT_TURN_LOCK_WAIT=0):
+                response = Client().post(
+                    reverse('core:chat-api'),
+                    json.dumps({'message': 'Hi', 'session_key': 'busy-session'}),
+                    content_type='application/json'
+                )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(session.messages.exists())
+
+    def test_expired_lease_is_taken_over(self):
+        session = ChatSession.objects.create(session_key='stale-lock')
+        SessionTurnLock(session, lease=1).acquire()
+        with self.assertRaises(TurnLockTimeout):
+            SessionTurnLock(session, wait_timeout=0).acquire()
+
+        ChatSession.objects.filter(pk=session.pk).update(
+            turn_locked_until=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        with SessionTurnLock(session, wait_timeout=0):
+            pass
+
+
+@override_settings(LLM_PROVIDER='fake')
+class TurnLockThreadTest(TransactionTestCase):
+    """Turns racing on real threads, each with its own database connection"""
+    THREADS = 6
+
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+        self.provider.reply = lambda message, history: f"Reply to {message}"
+        self.provider.latency = 0.02  # Keeps each turn in flight long enough to overlap
+
+    def test_threaded_turns_on_one_session_do_not_interleave(self):
+        barrier = threading.Barrier(self.THREADS)
+        results = [None] * self.THREADS
+
+        def turn(n):
+            try:
+                barrier.wait()
+                # The first requests also race to create the session
+                results[n] = AIService().send_message(f"Message {n}", 'thread-race')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=turn, args=(n,)) for n in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+
+        self.assertTrue(all(result and result['success'] for result in results), results)
+        session = ChatSession.objects.get(session_key='thread-race')
+        messages = list(session.messages.order_by('timestamp', 'id'))
+        self.assertEqual(len(messages), 2 * self.THREADS)
+        self.assertEqual([m.message_type for m in messages], ['user', 'ai'] * self.THREADS)
+        for user_msg, ai_msg in zip(messages[::2], messages[1::2]):
+            self.assertEqual(ai_msg.content, f"Reply to {user_msg.content}")
+        self.assertEqual(session.message_count, 2 * self.THREADS)
+        self.assertIsNone(session.turn_locked_until)
+
+
+class FormattingTest(TestCase):
+    def test_bold_and_italics(self):
+        self.assertEqual(format_markdown('A **bold** and *soft* step'),
+                         'A <strong>bold</strong> and <em>soft</em> step')
+        self.assertEqual(format_markdown('***both***'), '<strong><em>both</em></strong>')
+        self.assertEqual(format_markdown('2 * 3 = 6'), '2 * 3 = 6')
+
+    def test_to_markdown_undoes_formatting(self):
+        for text in ["It's **bold** & <b>\n- one\n- *two*\nBye", 'Steps:\n1. a\n2. b\nDone', 'x\n\ny']:
+            self.assertEqual(to_markdown(format_markdown(text)), text)
+
+    @override_settings(LLM_PROVIDER='fake')
+    def test_model_sees_its_replies_without_html(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        provider = get_llm_client().provider
+        provider.reply = lambda message, history: "It's **done**:\n- one\n- two & three"
+        AIService().send_message('First', 'markdown-history')
+        AIService().send_message('Second', 'markdown-history')
+
+        reply = provider.requests[-1]['history'][-1]
+        self.assertEqual(reply['role'], 'model')
+        self.assertEqual(reply['parts'][0]['text'], "It's **done**:\n- one\n- two & three")
+        self.assertNotRegex(reply['parts'][0]['text'], r'<[a-z/]|&\w+;|&#')
+
+    def test_html_is_escaped(self):
+        self.assertEqual(format_markdown('<img src=x onerror="alert(1)"> & **<b>**'),
+                         '&lt;img src=x onerror=&quot;alert(1)&quot;&gt; &amp; <strong>&lt;b&gt;</strong>')
+
+    def test_lists_and_line_breaks(self):
+        text = 'Try this:\n- **Breathe**\n- Walk\n\n1. One\n2. Two\nThen rest.\nOk\n'
+        self.assertEqual(
+            format_markdown(text),
+            'Try this:<ul><li><strong>Breathe</strong></li><li>Walk</li></ul>'
+            '<ol><li>One</li><li>Two</li></ol>Then rest.<br>Ok'
+        )
+
+    def test_unclosed_markers_are_closed(self):
+        self.assertEqual(format_markdown('**open\nnext'), '<strong>open</strong><br>next')
+
+    def test_streamed_output_matches_whole_reply(self):
+        text = 'Hi **there**, *friend*.\n\n- item **one**\n12. twelve\n***x*** 2 * 3\r\ndone'
+        expected = format_markdown(text)
+        for chunk_size in (1, 2, 3, 5, 8):
+            formatter = MarkdownFormatter()
+            parts = [formatter.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+            self.assertEqual(''.join(parts) + formatter.finish(), expected, chunk_size)
+
+    def test_list_marker_split_across_chunks(self):
+        for chunks in (['-', '  item'], ['- ', ' item'], ['1.', ' \titem'], ['* ', '\t', ' item\n- ', 'next']):
+            formatter = MarkdownFormatter()
+            streamed = ''.join(formatter.feed(chunk) for chunk in chunks) + formatter.finish()
+            self.assertEqual(streamed, format_markdown(''.join(chunks)), chunks)
+
+    def test_long_reply_is_linear(self):
+        # The old replace loop took seconds here
+        text = '**a** ' * 50000
+        self.assertEqual(format_markdown(text).count('<strong>'), 50000)
+
+
+class TurnPersistenceTest(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create(session_key='persist-session')
+
+    def statements(self, queries, verb):
+        return [query['sql'] for query in queries if query['sql'].startswith(verb)]
+
+    def test_turn_is_written_in_one_transaction(self):
+        with CaptureQueriesContext(connection) as queries:
+            user_msg, ai_msg = record_turn(self.session, 'Hello there', 'Hi!')
+
+        self.assertEqual(len(self.statements(queries, 'INSERT')), 1)
+        self.assertEqual(len(self.statements(queries, 'UPDATE')), 1)
+        self.assertEqual(self.statements(queries, 'SELECT'), [])
+        self.assertLess(user_msg.id, ai_msg.id)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.title, 'Hello there')
+        self.assertEqual(self.session.message_count, 2)
+        self.assertEqual(self.session.user_message_count, 1)
+        self.assertEqual(self.session.last_message_preview, 'Hi!')
+
+    def test_session_save_does_not_query_messages(self):
+        self.session.is_archived = True
+        with self.assertNumQueries(1):
+            self.session.save(update_fields=['is_archived', 'updated_at'])
+
+    @override_settings(CHAT_PERSISTENCE_MODE='async')
+    def test_write_behind_group_commits_many_sessions(self):
+        other = ChatSession.objects.create(session_key='persist-other')
+        lock = SessionTurnLock(self.session).acquire()
+        buffer = WriteBehindBuffer(max_batch=10)
+        with mock.patch('core.persistence._buffer', buffer):
+            record_turn(self.session, 'First', 'Reply one', lock=lock)
+            record_turn(other, 'Second', 'Reply two')
+
+        # Nothing is written, and the session stays locked, until the flush
+        self.assertFalse(ChatMessage.objects.exists())
+        with self.assertRaises(TurnLockTimeout):
+            SessionTurnLock(self.session, wait_timeout=0).acquire()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(len(self.statements(queries, 'INSERT')), 1)
+
+        self.assertEqual(ChatMessage.objects.count(), 4)
+        other.refresh_from_db()
+        self.assertEqual(other.message_count, 2)
+        self.assertEqual(other.title, 'Second')
+        with SessionTurnLock(self.session, wait_timeout=0):
+            pass
+
+
+@override_settings(LLM_PROVIDER='fake', RATE_LIMIT_ENABLED=True, RATE_LIMIT_BACKEND='local',
+                   RATE_LIMITS={'chat': '2/min'})
+class RateLimitTest(APITestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+
+    def _post(self, url='core:chat-api', address='10.0.0.1'):
+        return self.client.post(reverse(url), {'message': 'Hi', 'session_key': 'limited'},
+                                format='json', REMOTE_ADDR=address)
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('20/min'), (20, 20 / 60))
+        self.assertEqual(parse_rate('10/5s:3'), (3, 2.0))
+        with self.assertRaises(ValueError):
+            parse_rate('10/fortnight')
+
+    def test_bucket_refills_over_time(self):
+        buckets = LocalBuckets()
+        with mock.patch('core.ratelimit.time.monotonic', return_value=100.0):
+            self.assertEqual(buckets.take('k', 1, 0.5), (True, 0))
+            self.assertEqual(buckets.take('k', 1, 0.5), (False, 2.0))
+        with mock.patch('core.ratelimit.time.monotonic', return_value=102.0):
+            self.assertEqual(buckets.take('k', 1, 0.5), (True, 0))
+
+    def test_client_over_its_rate_gets_429(self):
+        self.assertEqual(self._post().status_code, 200)
+        self.assertEqual(self._post(url='core:talk').status_code, 200)
+
+        response = self._post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertFalse(response.json()['success'])
+
+        # Other clients and read-only requests are unaffected
+        self.assertEqual(self._post(address='10.0.0.2').status_code, 200)
+        response = self.client.get(reverse('core:chat-api'), {'session_key': 'limited'}, REMOTE_ADDR='10.0.0.1')
+        self.assertNotEqual(response.status_code, 429)
+
+    @override_settings(RATE_LIMIT_KEY='session')
+    def test_session_mode_counts_anonymous_clients_by_token(self):
+        first, second = issue_client_token('client-a'), issue_client_token('client-b')
+        for expected in (200, 200, 429):
+            response = self.client.post(reverse('core:chat-api'), {'message': 'Hi'}, format='json',
+                                        REMOTE_ADDR='10.0.0.1', HTTP_X_CHAT_CLIENT=first)
+            self.assertEqual(response.status_code, expected)
+        # Same address, another client: its own bucket
+        response = self.client.post(reverse('core:chat-api'), {'message': 'Hi'}, format='json',
+                                    REMOTE_ADDR='10.0.0.1', HTTP_X_CHAT_CLIENT=second)
+        self.assertEqual(response.status_code, 200)
+
+        # WebSocket chats draw from the same bucket
+        consumer = ChatConsumer()
+        consumer.scope = {'client': ('10.0.0.1', 1234)}
+        consumer.user, consumer.client_id, consumer.presented_client = None, 'client-a', True
+        self.assertEqual(consumer.rate_limit_key(), 'client:client-a')
+        consumer.presented_client = False  # A token minted on connect does not count
+        self.assertEqual(consumer.rate_limit_key(), 'ip:10.0.0.1')
+
+    @override_settings(RATE_LIMIT_ENABLED=False, CHAT_MAX_INFLIGHT=1)
+    def test_admission_cap_fails_fast(self):
+        self.assertTrue(try_admit())
+        try:
+            response = self._post()
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response)
+        finally:
+            release_admission()
+
+        self.assertEqual(self._post().status_code, 200)
+        response = self._post(url='core:chat-stream')
+        b''.join(response.streaming_content)
+        self.assertEqual(inflight_generations(), 0)
+
+
+@override_settings(LLM_PROVIDER='fake', LLM_RETRY_BACKOFF=0.001, LLM_FALLBACK_MODEL='')
+class ResilienceTest(APITestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+
+    @property
+    def provider(self):
+        # Tests that change LLM_ settings get a new client
+        return get_llm_client().provider
+
+    def _post(self, **headers):
+        return self.client.post(reverse('core:chat-api'), {'message': 'Hi', 'session_key': 'resilient'},
+                                format='json', **headers)
+
+    def test_transient_errors_are_retried(self):
+        self.provider.inject(api_exceptions.ServiceUnavailable('overloaded'), times=2)
+        response = self._post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.provider.requests), 3)
+
+    def test_other_errors_are_not_retried(self):
+        self.provider.inject(api_exceptions.InvalidArgument('bad prompt'))
+        response = self._post()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(self.provider.requests), 1)
+
+    def test_client_deadline_bounds_the_turn(self):
+        self.provider.inject(latency=5, times=5)
+        started = time.monotonic()
+        response = self._post(HTTP_X_REQUEST_TIMEOUT='0.2')
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertTrue(response.json()['unavailable'])
+
+    @override_settings(LLM_RETRIES=0, LLM_BREAKER_FAILURES=2, LLM_FALLBACK_MODEL='backup-model')
+    def test_open_circuit_switches_to_fallback_model(self):
+        self.provider.inject(api_exceptions.InternalServerError('down'), times=10, model_name='gemini-2.0-flash')
+        for _ in range(3):
+            self.assertEqual(self._post().status_code, 200)
+
+        models = [request['model'].model_name for request in self.provider.requests]
+        # Two failures open the circuit; the third turn skips the primary model
+        self.assertEqual(models, ['gemini-2.0-flash', 'backup-model'] * 2 + ['backup-model'])
+        self.assertEqual(get_llm_client().resilience.breaker('gemini-2.0-flash').state, 'open')
+
+    @override_settings(LLM_RETRIES=0, LLM_BREAKER_FAILURES=1, LLM_BREAKER_COOLDOWN=60)
+    def test_open_circuit_fails_fast(self):
+        self.provider.inject(api_exceptions.ServiceUnavailable('down'))
+        self.assertEqual(self._post().status_code, 503)
+
+        response = self._post()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('unavailable', response.json()['error'])
+        self.assertEqual(len(self.provider.requests), 1)
+
+    @override_settings(LLM_RETRIES=0, LLM_BREAKER_FAILURES=1, LLM_BREAKER_COOLDOWN=0)
+    async def test_cancelled_half_open_trial_does_not_stick(self):
+        caller = ResilientCaller()
+        caller.breaker('model').record_failure()
+
+        async def hang(model_name, timeout):
+            await asyncio.sleep(10)
+
+        trial = asyncio.ensure_future(caller.acall('model', hang, Deadline(20)))
+        await asyncio.sleep(0.01)
+        self.assertEqual(caller.breaker('model').state, 'half_open')
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+
+        async def answer(model_name, timeout):
+            return 'ok'
+
+        # The next call becomes the trial, and closes the circuit
+        self.assertEqual(await caller.acall('model', answer, Deadline(5)), 'ok')
+        self.assertEqual(caller.breaker('model').state, 'closed')
+
+    def test_stuck_half_open_trial_times_out(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=0, trial_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())  # The trial, which never reports back
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+
+    @override_settings(LLM_HEDGE=True, LLM_HEDGE_MIN_DELAY=0.05)
+    def test_slow_call_is_hedged(self):
+        caller = ResilientCaller()
+        for _ in range(20):
+            caller.latency('model').record(0.01)
+        calls = []
+
+        def attempt(model_name, timeout):
+            calls.append(model_name)
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'fast'
+
+        started = time.monotonic()
+        self.assertEqual(caller.call('model', attempt, Deadline(5)), 'fast')
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(caller.stats['hedge_wins'], 1)
+
+    @override_settings(LLM_HEDGE=True, LLM_HEDGE_MIN_DELAY=0.05)
+    async def test_slow_async_call_is_hedged(self):
+        caller = ResilientCaller()
+        for _ in range(20):
+            caller.latency('model').record(0.01)
+        calls = []
+
+        async def attempt(model_name, timeout):
+            calls.append(model_name)
+            await asyncio.sleep(1 if len(calls) == 1 else 0)
+            return len(calls)
+
+        self.assertEqual(await caller.acall('model', attempt, Deadline(5)), 2)
+        self.assertEqual(caller.stats['hedges'], 1)
+
+
 class SessionManagerTest(TestCase):
     def test_generate_session_key(self):
         session_key = SessionManager.generate_session_key()
@@ -117,6 +1228,684 @@ class ChatAPIViewTest(APITestCase):
         self.assertIn('error', data)
 
 
+@override_settings(LLM_PROVIDER='gemini', LLM_CONTEXT_CACHE=False)
+class LLMClientRegistryTest(TestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+
+    @mock.patch('core.llm.genai')
+    def test_client_is_shared_and_configured_once(self, genai):
+        client = get_llm_client()
+        self.assertIs(get_llm_client(), client)
+        self.assertIs(AIService().client, client)
+        genai.configure.assert_called_once()
+
+    @mock.patch('core.llm.genai')
+    def test_models_are_reused(self, genai):
+        client = get_llm_client()
+        self.assertIs(client.get_model(), client.get_model())
+        genai.GenerativeModel.assert_called_once()
+
+    @mock.patch('core.llm.genai')
+    def test_db_only_service_calls_skip_client_setup(self, genai):
+        AIService().get_session_history('missing')
+        genai.configure.assert_not_called()
+
+    @mock.patch('core.llm.genai')
+    def test_client_rebuilt_when_settings_change(self, genai):
+        client = get_llm_client()
+        with self.settings(GEMINI_API_KEY='rotated'):
+            rebuilt = get_llm_client()
+            self.assertIsNot(rebuilt, client)
+            self.assertEqual(rebuilt.api_key, 'rotated')
+
+    @mock.patch('core.llm.genai')
+    def test_system_prompt_sent_as_system_instruction(self, genai):
+        get_llm_client().get_model()
+        kwargs = genai.GenerativeModel.call_args.kwargs
+        self.assertIn("You are 'AdvisorOP'", kwargs['system_instruction'])
+
+
+@override_settings(LLM_PROVIDER='fake', LLM_CONTEXT_CACHE=True, LLM_CONTEXT_CACHE_MIN_TOKENS=0)
+class PromptCacheTest(TestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+
+    def test_history_has_no_prompt_turns(self):
+        session = ChatSession.objects.create(session_key='prompt-session')
+        ChatMessage.objects.create(session=session, message_type='user', content='Hi')
+        history = AIService().build_chat_history(session)
+        self.assertEqual(history, [{"role": "user", "parts": [{"text": "Hi"}]}])
+
+    def test_prefix_registered_once_and_reused(self):
+        client = get_llm_client()
+        model = client.get_model()
+        self.assertIs(client.get_model(), model)
+        self.assertEqual(len(self.provider.cached_prefixes), 1)
+        self.assertEqual(model.cached_prefix.system_instruction, client.system_instruction)
+
+    def test_prompt_change_registers_new_prefix(self):
+        client = get_llm_client()
+        first = client.get_model()
+        client.system_instruction = 'A different prompt'
+        second = client.get_model()
+        self.assertIsNot(first, second)
+        self.assertEqual(len(self.provider.cached_prefixes), 2)
+
+    def test_expired_prefix_is_refreshed(self):
+        client = get_llm_client()
+        client.get_model()
+        self.provider.cached_prefixes[0].expires_at = 0
+        model = client.get_model()
+        self.assertEqual(len(self.provider.cached_prefixes), 2)
+        self.assertIs(model.cached_prefix, self.provider.cached_prefixes[1])
+        self.assertEqual(len(client._models), 1)  # The old prefix's model is replaced, not kept
+
+    @override_settings(LLM_CONTEXT_CACHE_MIN_TOKENS=4096)
+    def test_short_prompt_is_not_registered(self):
+        model = get_llm_client().get_model()
+        self.assertIsNone(model.cached_prefix)
+        self.assertEqual(get_llm_client().provider.cached_prefixes, [])
+
+    def test_registration_does_not_block_other_requests(self):
+        client = get_llm_client()
+        started, release = threading.Event(), threading.Event()
+        create = self.provider.create_cached_prefix
+
+        def slow_create(*args):
+            started.set()
+            release.wait(5)
+            return create(*args)
+
+        with mock.patch.object(self.provider, 'create_cached_prefix', side_effect=slow_create) as registering:
+            worker = threading.Thread(target=client.get_model)
+            worker.start()
+            started.wait(5)
+            # Another request meanwhile gets the uncached model straight away
+            self.assertIsNone(client.get_model().cached_prefix)
+            release.set()
+            worker.join(5)
+        registering.assert_called_once()
+        self.assertIsNotNone(client.get_model().cached_prefix)
+
+    def test_falls_back_to_system_instruction_when_cache_rejected(self):
+        client = get_llm_client()
+        with mock.patch.object(self.provider, 'create_cached_prefix', side_effect=ValueError('too small')) as create:
+            model = client.get_model()
+            client.get_model()
+        self.assertIsNone(model.cached_prefix)
+        self.assertEqual(model.system_instruction, client.system_instruction)
+        create.assert_called_once()  # Failure is remembered, not retried every request
+
+
+@override_settings(LLM_PROVIDER='fake')
+class AIConfigCacheTest(TestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        invalidate_ai_config()
+        self.addCleanup(invalidate_ai_config)
+        self.provider = get_llm_client().provider
+
+    def create_config(self, **fields):
+        defaults = {'name': 'Default', 'system_prompt': 'Be brief.', 'max_tokens': 64, 'temperature': 0.2}
+        defaults.update(fields)
+        with self.captureOnCommitCallbacks(execute=True):
+            return AIConfig.objects.create(**defaults)
+
+    def test_defaults_without_config(self):
+        config = get_active_config()
+        self.assertEqual(config.model_name, 'gemini-2.0-flash')
+        self.assertIn("You are 'AdvisorOP'", config.system_prompt)
+        self.assertEqual(config.generation_config, {})
+
+    def test_config_is_read_once_per_process(self):
+        self.create_config()
+        with self.assertNumQueries(2):  # version stamp, then the row
+            get_active_config()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_active_config().max_tokens, 64)
+
+    def test_change_from_another_process_is_seen_after_the_check_interval(self):
+        config = self.create_config()
+        self.assertEqual(get_active_config().max_tokens, 64)
+        # No signal fires here, as if another worker had saved the row
+        AIConfig.objects.filter(pk=config.pk).update(max_tokens=128, updated_at=timezone.now())
+        self.assertEqual(get_active_config().max_tokens, 64)
+        with mock.patch('core.ai_config.time.monotonic', return_value=time.monotonic() + 60):
+            self.assertEqual(get_active_config().max_tokens, 128)
+            AIConfig.objects.filter(pk=config.pk).update(is_active=False)
+        with mock.patch('core.ai_config.time.monotonic', return_value=time.monotonic() + 120):
+            self.assertEqual(get_active_config().generation_config, {})
+            self.assertEqual(async_to_sync(aget_active_config)().generation_config, {})
+
+    def test_saving_config_reloads_it(self):
+        config = self.create_config()
+        self.assertEqual(get_active_config().max_tokens, 64)
+
+        config.max_tokens = 256
+        with self.captureOnCommitCallbacks(execute=True):
+            config.save()
+        self.assertEqual(get_active_config().max_tokens, 256)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            config.delete()
+        self.assertEqual(get_active_config().generation_config, {})
+
+    def test_config_drives_model(self):
+        self.create_config(model_name='gemini-test', system_prompt='Answer in one word.')
+        AIService().send_message('Hi', 'config-session')
+
+        model = self.provider.requests[-1]['model']
+        self.assertEqual(model.model_name, 'gemini-test')
+        self.assertEqual(model.generation_config, {'max_output_tokens': 64, 'temperature': 0.2})
+        self.assertIn('Answer in one word.', model.system_instruction)
+
+
+@override_settings(LLM_PROVIDER='fake')
+class ChatStreamAPIViewTest(APITestCase):
+    def setUp(self):
+        self.client = Client()
+        self.stream_url = reverse('core:chat-stream')
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+        self.provider.reply = lambda message, history: 'Hello **there**'
+        self.provider.chunk_size = 6
+
+    def test_stream_sends_tokens_then_done(self):
+        response = self.client.post(
+            self.stream_url,
+            json.dumps({'message': 'Hi', 'session_key': 'stream-session'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode()
+
+        self.assertIn('event: token\ndata: {"text": "Hello ", "html": "Hello "}', body)
+        self.assertIn('data: {"text": "**ther", "html": "<strong>ther"}', body)
+        self.assertIn('data: {"text": "", "html": "</strong>"}', body)
+        self.assertIn('event: done', body)
+        self.assertEqual(self.provider.requests[0]['message'], 'Hi')
+
+        # The formatted reply is persisted once the stream completes
+        ai_msg = ChatMessage.objects.get(session__session_key='stream-session', message_type='ai')
+        self.assertEqual(ai_msg.content, 'Hello <strong>there</strong>')
+
+    def test_stream_query_parameter_on_chat_api(self):
+        response = self.client.post(
+            reverse('core:chat-api') + '?stream=1',
+            json.dumps({'message': 'Hello'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        response.close()
+
+    def test_stream_empty_message(self):
+        response = self.client.post(
+            self.stream_url,
+            json.dumps({'message': ''}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(LLM_PROVIDER='fake')
+class AsyncChatViewTest(TestCase):
+    def setUp(self):
+        self.async_client = AsyncClient()
+        self.async_url = reverse('core:chat-async')
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+
+    async def test_async_post_message(self):
+        self.provider.reply = lambda message, history: 'Hi **you**'
+
+        response = await self.async_client.post(
+            self.async_url,
+            json.dumps({'message': 'Hello', 'session_key': 'async-session'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['response'], 'Hi <strong>you</strong>')
+        self.assertEqual(
+            await ChatMessage.objects.filter(session__session_key='async-session').acount(), 2
+        )
+
+    async def test_async_stream(self):
+        self.provider.reply = lambda message, history: 'One two'
+        self.provider.chunk_size = 4
+
+        response = await self.async_client.post(
+            self.async_url + '?stream=1',
+            json.dumps({'message': 'Count'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        body = ''.join([chunk.decode() async for chunk in response.streaming_content])
+        self.assertIn('event: token', body)
+        self.assertIn('"response": "One two"', body)
+
+    async def test_async_invalid_json(self):
+        response = await self.async_client.post(
+            self.async_url, '{not json', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(LLM_PROVIDER='fake')
+class ChatWebSocketTest(TransactionTestCase):
+    ORIGIN = (b'origin', b'http://localhost:5173')
+
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+        self.provider.reply = lambda message, history: 'One two three four five six seven eight'
+        self.provider.chunk_size = 4
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(asgi_application, '/ws/chat/', headers=[self.ORIGIN])
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        ready = await communicator.receive_json_from()
+        self.assertEqual(ready['type'], 'ready')
+        return communicator
+
+    async def receive_until(self, communicator, kind):
+        messages = []
+        while not messages or messages[-1]['type'] != kind:
+            messages.append(await communicator.receive_json_from(timeout=5))
+        return messages
+
+    async def test_stream_and_send(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'stream', 'session_key': 'ws-chat', 'message': 'Hi'})
+        messages = await self.receive_until(communicator, 'done')
+        self.assertEqual(''.join(m['text'] for m in messages if m['type'] == 'token'), self.provider.reply('', []))
+        self.assertTrue(messages[-1]['success'])
+
+        await communicator.send_json_to({'type': 'send', 'session_key': 'ws-chat', 'message': 'Again'})
+        self.assertEqual([m['type'] for m in await self.receive_until(communicator, 'done')], ['done'])
+        await communicator.disconnect()
+        self.assertEqual(await ChatMessage.objects.filter(session__session_key='ws-chat').acount(), 4)
+
+    async def test_cancel_saves_partial_reply(self):
+        self.provider.chunk_latency = 0.2
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'stream', 'session_key': 'ws-cancel', 'message': 'Hi'})
+        await self.receive_until(communicator, 'token')
+        await communicator.send_json_to({'type': 'cancel', 'session_key': 'ws-cancel'})
+        cancelled = (await self.receive_until(communicator, 'cancelled'))[-1]
+        await communicator.disconnect()
+
+        reply = await ChatMessage.objects.filter(session__session_key='ws-cancel', message_type='ai').aget()
+        self.assertEqual(reply.content, cancelled['response'])
+        self.assertTrue(self.provider.reply('', []).startswith(reply.content))
+        self.assertLess(len(reply.content), len(self.provider.reply('', [])))
+        self.assertEqual(inflight_generations(), 0)
+
+    async def test_disconnect_and_new_chat_cancel(self):
+        self.provider.chunk_latency = 0.2
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'stream', 'session_key': 'ws-new', 'message': 'Hi'})
+        await self.receive_until(communicator, 'token')
+        await AsyncClient().post(
+            reverse('core:new-chat-api'), {'session_key': 'ws-new'}, content_type='application/json'
+        )
+        self.assertEqual((await self.receive_until(communicator, 'cancelled'))[-1]['session_key'], 'ws-new')
+
+        await communicator.send_json_to({'type': 'stream', 'session_key': 'ws-gone', 'message': 'Hi'})
+        await self.receive_until(communicator, 'token')
+        await communicator.disconnect()
+        self.assertTrue(await ChatMessage.objects.filter(session__session_key='ws-gone', message_type='ai').aexists())
+
+    async def test_rejects_foreign_origin(self):
+        communicator = WebsocketCommunicator(asgi_application, '/ws/chat/', headers=[(b'origin', b'http://evil.test')])
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class HistoryPaginationTest(APITestCase):
+    def setUp(self):
+        self.client = Client()
+        self.chat_url = reverse('core:chat-api')
+        self.session = ChatSession.objects.create(session_key='paged-session')
+        for i in range(7):
+            ChatMessage.objects.create(session=self.session, message_type='user', content=f'message {i}')
+
+    def _get(self, **params):
+        response = self.client.get(self.chat_url, {'session_key': 'paged-session', **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_latest_page_then_older(self):
+        page = self._get(page_size=3)
+        self.assertEqual([m['text'] for m in page['messages']], ['message 4', 'message 5', 'message 6'])
+        self.assertIsNone(page['next_cursor'])
+
+        older = self._get(page_size=3, before=page['previous_cursor'])
+        self.assertEqual([m['text'] for m in older['messages']], ['message 1', 'message 2', 'message 3'])
+
+        oldest = self._get(page_size=3, before=older['previous_cursor'])
+        self.assertEqual([m['text'] for m in oldest['messages']], ['message 0'])
+        self.assertIsNone(oldest['previous_cursor'])
+
+    def test_after_cursor_returns_newer_messages(self):
+        oldest = self._get(page_size=2, before=self._get(page_size=5)['previous_cursor'])
+        newer = self._get(page_size=3, after=oldest['next_cursor'])
+        self.assertEqual([m['text'] for m in newer['messages']], ['message 2', 'message 3', 'message 4'])
+        self.assertIsNotNone(newer['next_cursor'])
+
+    def test_ties_on_timestamp_use_id(self):
+        ChatMessage.objects.filter(session=self.session).update(timestamp=self.session.created_at)
+        page = self._get(page_size=2)
+        texts = [m['text'] for m in page['messages']]
+        while page['previous_cursor']:
+            page = self._get(page_size=2, before=page['previous_cursor'])
+            texts = [m['text'] for m in page['messages']] + texts
+        self.assertEqual(texts, [f'message {i}' for i in range(7)])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.chat_url, {'session_key': 'paged-session', 'before': 'bogus'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unpaginated_history_unchanged(self):
+        data = self._get()
+        self.assertEqual(len(data['messages']), 7)
+        self.assertNotIn('next_cursor', data)
+
+    def test_transcript_streams_ndjson(self):
+        response = self.client.get(reverse('core:chat-transcript', args=['paged-session']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['text'] for line in lines], [f'message {i}' for i in range(7)])
+
+    def test_transcript_missing_session(self):
+        response = self.client.get(reverse('core:chat-transcript', args=['missing']))
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalSyncTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='syncer', password='pw')
+        self.client.force_authenticate(self.user)
+        self.history_url = reverse('core:chat-history')
+        self.chat_url = reverse('core:chat-api')
+        self.session = ChatSession.objects.create(session_key='synced', user=self.user)
+        for i in range(3):
+            ChatMessage.objects.create(session=self.session, message_type='user', content=f'message {i}')
+
+    def test_session_list_not_modified_costs_one_query(self):
+        response = self.client.get(self.history_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):
+            cached = self.client.get(self.history_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+        ChatMessage.objects.create(session=self.session, message_type='ai', content='new')
+        self.assertEqual(self.client.get(self.history_url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_session_list_delta(self):
+        other = ChatSession.objects.create(session_key='other', user=self.user)
+        ChatSession.objects.filter(pk__in=[self.session.pk, other.pk]).update(
+            updated_at=timezone.now() - datetime.timedelta(hours=1)
+        )
+        cursor = self.client.get(self.history_url).data['cursor']
+
+        nothing = self.client.get(self.history_url, {'since': cursor}).data
+        self.assertTrue(nothing['delta'])
+        self.assertEqual((nothing['sessions'], nothing['removed']), ([], []))
+
+        AIService().clear_session('other')
+        ChatMessage.objects.create(session=self.session, message_type='ai', content='new')
+        changes = self.client.get(self.history_url, {'since': cursor}).data
+        self.assertEqual([session['session_key'] for session in changes['sessions']], ['synced'])
+        self.assertEqual(changes['removed'], ['other'])
+        self.assertNotEqual(changes['cursor'], cursor)
+
+        self.assertEqual(self.client.get(self.history_url, {'since': 'bogus'}).status_code, 400)
+
+    def test_history_conditional_and_delta(self):
+        response = self.client.get(self.chat_url, {'session_key': 'synced'})
+        self.assertEqual(len(response.data['messages']), 3)
+
+        with self.assertNumQueries(2):
+            cached = self.client.get(
+                self.chat_url, {'session_key': 'synced'}, HTTP_IF_NONE_MATCH=response['ETag']
+            )
+        self.assertEqual(cached.status_code, 304)
+
+        ChatMessage.objects.create(session=self.session, message_type='ai', content='reply')
+        delta = self.client.get(self.chat_url, {'session_key': 'synced', 'since': response.data['cursor']}).data
+        self.assertEqual([m['text'] for m in delta['messages']], ['reply'])
+        self.assertFalse(delta['has_more'])
+
+        empty = self.client.get(self.chat_url, {'session_key': 'synced', 'since': delta['cursor']}).data
+        self.assertEqual((empty['messages'], empty['cursor']), ([], delta['cursor']))
+
+    def test_frozen_history_has_a_cursor(self):
+        last = self.session.messages.order_by('timestamp', 'id').last()
+        freeze_session(self.session)
+        response = self.client.get(self.chat_url, {'session_key': 'synced'})
+        self.assertEqual(len(response.data['messages']), 3)
+        self.assertEqual(response.data['cursor'], encode_cursor(last))
+        cached = self.client.get(self.chat_url, {'session_key': 'synced'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        empty = self.client.get(self.chat_url, {'session_key': 'synced', 'since': response.data['cursor']}).data
+        self.assertEqual((empty['messages'], empty['cursor']), ([], response.data['cursor']))
+
+
+@override_settings(LLM_PROVIDER='fake')
+class IdempotencyTest(APITestCase):
+    def setUp(self):
+        self.client = Client()
+        self.chat_url = reverse('core:chat-api')
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.provider = get_llm_client().provider
+        self.token = issue_client_token('idem-client')
+        # Keys are stored scoped to the caller
+        self.stored_key = hashlib.sha256(b'client:idem-client|retry-key').hexdigest()
+
+    def _post(self, url, body, key='retry-key', token=None):
+        return self.client.post(
+            url, json.dumps(body), content_type='application/json', HTTP_IDEMPOTENCY_KEY=key,
+            HTTP_X_CHAT_CLIENT=token or self.token
+        )
+
+    def test_retry_replays_stored_response(self):
+        body = {'message': 'Hello', 'session_key': 'idem-session'}
+        first = self._post(self.chat_url, body)
+        second = self._post(self.chat_url, body)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertEqual(ChatMessage.objects.filter(session__session_key='idem-session').count(), 2)
+
+    def test_legacy_talk_endpoint(self):
+        body = {'message': 'Hello', 'session_key': 'idem-talk'}
+        self._post(reverse('core:talk'), body)
+        replay = self._post(reverse('core:talk'), body)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(self.provider.requests), 1)
+
+    def test_key_reused_with_different_body(self):
+        self._post(self.chat_url, {'message': 'Hello'})
+        response = self._post(self.chat_url, {'message': 'Something else'})
+        self.assertEqual(response.status_code, 422)
+
+    def test_without_key_every_request_runs(self):
+        for _ in range(2):
+            self.client.post(self.chat_url, json.dumps({'message': 'Hi'}), content_type='application/json')
+        self.assertEqual(len(self.provider.requests), 2)
+
+    def test_server_errors_are_not_stored(self):
+        self.provider.reply = mock.Mock(side_effect=[RuntimeError('provider down'), 'Recovered'])
+        body = {'message': 'Hello'}
+        self.assertEqual(self._post(self.chat_url, body).status_code, 500)
+        retry = self._post(self.chat_url, body)
+        self.assertEqual(retry.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', retry)
+
+    def test_duplicate_waits_for_in_flight_original(self):
+        body = {'message': 'Hello'}
+        request_hash = hashlib.sha256(json.dumps(body).encode()).hexdigest()
+        record = IdempotencyRecord.objects.create(
+            scope='chat', key=self.stored_key, request_hash=request_hash,
+            expires_at=timezone.now() + datetime.timedelta(hours=1)
+        )
+
+        def original_finishes(seconds):
+            IdempotencyRecord.objects.filter(pk=record.pk).update(
+                status='completed', response_status=200, response_body={'response': 'done'}
+            )
+
+        with mock.patch('core.idempotency.time.sleep', side_effect=original_finishes):
+            response = self._post(self.chat_url, body)
+        self.assertEqual(response.json(), {'response': 'done'})
+        self.assertEqual(self.provider.requests, [])
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0)
+    def test_duplicate_times_out_with_conflict(self):
+        body = {'message': 'Hello'}
+        IdempotencyRecord.objects.create(
+            scope='chat', key=self.stored_key,
+            request_hash=hashlib.sha256(json.dumps(body).encode()).hexdigest(),
+            expires_at=timezone.now() + datetime.timedelta(hours=1)
+        )
+        response = self._post(self.chat_url, body)
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('Retry-After', response)
+
+    def test_expired_key_runs_again(self):
+        body = {'message': 'Hello'}
+        self._post(self.chat_url, body)
+        IdempotencyRecord.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        response = self._post(self.chat_url, body)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(len(self.provider.requests), 2)
+
+    @override_settings(IDEMPOTENCY_PENDING_LEASE=30, IDEMPOTENCY_KEY_TTL=3600)
+    def test_pending_claim_is_leased_until_completed(self):
+        leases = []
+
+        def reply(*args, **kwargs):
+            leases.append(IdempotencyRecord.objects.get().expires_at - timezone.now())
+            return 'Hi there'
+
+        self.provider.reply = mock.Mock(side_effect=reply)
+        self._post(self.chat_url, {'message': 'Hello'})
+        self.assertLessEqual(leases[0], datetime.timedelta(seconds=30))
+        self.assertGreater(IdempotencyRecord.objects.get().expires_at - timezone.now(),
+                           datetime.timedelta(seconds=3000))
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0)
+    def test_retry_takes_over_an_expired_pending_claim(self):
+        body = {'message': 'Hello'}
+        IdempotencyRecord.objects.create(
+            scope='chat', key=self.stored_key,
+            request_hash=hashlib.sha256(json.dumps(body).encode()).hexdigest(),
+            expires_at=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        response = self._post(self.chat_url, body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.provider.requests), 1)
+        self.assertEqual(IdempotencyRecord.objects.get().status, 'completed')
+
+    def test_keys_are_scoped_to_the_client(self):
+        body = {'message': 'Hello'}
+        self._post(self.chat_url, body)
+        other = self._post(self.chat_url, body, token=issue_client_token('other-client'))
+        self.assertNotIn('Idempotent-Replayed', other)
+        self.assertEqual(len(self.provider.requests), 2)
+        # A different body under another client's key is not a conflict either
+        self.assertEqual(self._post(self.chat_url, {'message': 'Bye'}, token=issue_client_token('third')).status_code,
+                         200)
+
+    def test_tokenless_retry_replays(self):
+        body = {'message': 'Hello', 'session_key': 'idem-tokenless'}
+
+        def post(address):
+            return self.client.post(
+                self.chat_url, json.dumps(body), content_type='application/json',
+                HTTP_IDEMPOTENCY_KEY='retry-key', REMOTE_ADDR=address
+            )
+
+        first = post('203.0.113.7')
+        # The first response, and the client token it carried, never arrived
+        self.client.cookies.clear()
+        retry = post('203.0.113.7')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(len(self.provider.requests), 1)
+
+        self.client.cookies.clear()
+        self.assertNotIn('Idempotent-Replayed', post('198.51.100.2'))
+        self.assertEqual(len(self.provider.requests), 2)
+
+
+@override_settings(LLM_PROVIDER='fake')
+class ClientIdentityTest(APITestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        self.chat_url = reverse('core:chat-api')
+        self.history_url = reverse('core:chat-history')
+
+    def send(self, message, session_key):
+        return self.client.post(self.chat_url, {'message': message, 'session_key': session_key}, format='json')
+
+    def test_anonymous_client_sees_only_its_sessions(self):
+        response = self.send('Hello', 'mine')
+        self.assertIn('chat_client', response.cookies)
+        self.assertEqual(ChatSession.objects.get(session_key='mine').client_id,
+                         self.client.get(self.history_url).data['user_id'])
+
+        other = APIClient()
+        other.post(self.chat_url, {'message': 'Hi', 'session_key': 'theirs'}, format='json')
+
+        sessions = self.client.get(self.history_url).data['sessions']
+        self.assertEqual([session['session_key'] for session in sessions], ['mine'])
+
+    def test_chat_endpoints_do_not_touch_session_table(self):
+        self.send('Hello', 'no-session-io')
+        with CaptureQueriesContext(connection) as queries:
+            self.send('Again', 'no-session-io')
+            self.client.get(self.history_url)
+        self.assertFalse([query['sql'] for query in queries if 'django_session' in query['sql']])
+
+    def test_header_token_and_tampering(self):
+        token = issue_client_token('header-client')
+        ChatSession.objects.create(session_key='by-header', client_id='header-client')
+
+        response = self.client.get(self.history_url, HTTP_X_CHAT_CLIENT=token)
+        self.assertEqual(response.data['user_id'], 'header-client')
+        self.assertEqual(len(response.data['sessions']), 1)
+        self.assertNotIn('X-Chat-Client', response)  # Fresh tokens are not reissued
+
+        response = self.client.get(self.history_url, HTTP_X_CHAT_CLIENT=token[:-1] + 'x')
+        self.assertNotEqual(response.data['user_id'], 'header-client')
+        self.assertEqual(response.data['sessions'], [])
+        self.assertIn('X-Chat-Client', response)
+
+
 class NewChatAPIViewTest(APITestCase):
     def setUp(self):
         self.client = Client()
@@ -147,12 +1936,115 @@ class NewChatAPIViewTest(APITestCase):
 
 
 class HealthCheckTest(APITestCase):
+    def setUp(self):
+        reset_llm_client()
+
     def test_health_check(self):
         response = self.client.get(reverse('core:health-check'))
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertEqual(data['status'], 'healthy')
+        self.assertEqual(data['checks'], {'database': 'ok', 'cache': 'ok'})
         self.assertIn('service', data)
+        self.assertLess(abs(datetime.datetime.fromisoformat(data['timestamp']) - timezone.now()),
+                        datetime.timedelta(minutes=1))
+
+    def test_database_outage_is_unhealthy(self):
+        with mock.patch('core.views.connection.cursor', side_effect=Exception('down')):
+            response = self.client.get(reverse('core:health-check'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'unhealthy')
+
+
+@override_settings(LLM_PROVIDER='fake')
+class MetricsTest(APITestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+
+    def test_chat_turn_reports_server_timing(self):
+        response = self.client.post(reverse('core:chat-api'), {'message': 'Hi', 'session_key': 'timed'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        for name in ('session', 'lock_wait', 'history', 'llm', 'persist', 'db', 'total'):
+            self.assertIn(f'{name};dur=', timing)
+        queries = int(re.search(r'"(\d+) queries"', timing).group(1))
+        self.assertGreater(queries, 0)
+
+    def test_metrics_endpoint(self):
+        self.client.post(reverse('core:chat-api'), {'message': 'Hi', 'session_key': 'scraped'}, format='json')
+        response = self.client.get(reverse('core:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chat_stage_duration_seconds histogram', body)
+        self.assertIn('chat_stage_duration_seconds_bucket{stage="llm",le="+Inf"}', body)
+        self.assertIn('http_request_db_queries_count{view="core:chat-api"}', body)
+        self.assertIn('chat_turns_total{outcome="success"}', body)
+        self.assertIn('# TYPE llm_calls_total counter', body)
+        self.assertIn('llm_calls_total{event="calls"}', body)
+        self.assertIn('# TYPE chat_history_cache_lookups_total counter', body)
+        self.assertIn('chat_history_cache_lookups_total{result="misses"}', body)
+        self.assertIn('chat_inflight_generations 0', body)
+        self.assertIn('chat_write_behind_queue_depth 0', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse('core:metrics')).status_code, 401)
+        response = self.client.get(reverse('core:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(LLM_PROVIDER='fake', PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=0.0)
+class ProfilingTest(APITestCase):
+    def setUp(self):
+        reset_llm_client()
+        self.addCleanup(reset_llm_client)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        override = override_settings(PROFILING_DIR=self.dir)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _chat(self, **headers):
+        return self.client.post(reverse('core:chat-api'), {'message': 'Hi', 'session_key': 'profiled'},
+                                format='json', **headers)
+
+    def test_only_sampled_or_signed_requests_are_profiled(self):
+        self._chat(HTTP_X_PROFILE='forged')
+        self.assertEqual(os.listdir(self.dir), [])
+
+        self._chat(HTTP_X_PROFILE=issue_profile_token(memory=True))
+        names = sorted(os.listdir(self.dir))
+        self.assertEqual([name.rsplit('.', 1)[1] for name in names], ['json', 'prof', 'snapshot'])
+        self.assertIn('core_chat-api', names[0])
+
+        with override_settings(PROFILING_SAMPLE_RATE=1.0):
+            self.client.get(reverse('core:health-check'))
+        self.assertEqual(len(os.listdir(self.dir)), 5)
+
+        out = StringIO()
+        call_command('profile_report', dir=self.dir, view='core:chat-api', stdout=out)
+        self.assertIn('Memory held at the end of the request (1 snapshots', out.getvalue())
+        self.assertNotIn('core:health-check', out.getvalue())
+
+    def test_rotation_and_report(self):
+        for _ in range(3):
+            self._chat(HTTP_X_PROFILE=issue_profile_token())
+        rotate(self.dir, 2)
+        self.assertEqual(len([name for name in os.listdir(self.dir) if name.endswith('.prof')]), 2)
+
+        out = StringIO()
+        call_command('profile_report', dir=self.dir, limit=5, stdout=out)
+        report = out.getvalue()
+        self.assertIn('core:chat-api: 2 samples', report)
+        self.assertIn('function calls', report)
+
+    def test_issue_token(self):
+        out = StringIO()
+        call_command('profile_report', issue_token=True, stdout=out)
+        self.assertTrue(out.getvalue().startswith(f'{PROFILE_HEADER}: cpu:'))
 
 
 class CSRFTokenTest(APITestCase):
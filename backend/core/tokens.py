@@ -0,0 +1,10 @@
+def estimate_tokens(text):
+    """Estimate the number of model tokens in a piece of text.
+
+    Gemini tokenises English prose at roughly four characters per token.
+    An estimate is used instead of the provider's count_tokens endpoint so
+    that counting never costs a network round trip.
+    """
+    if not text:
+        return 0
+    return max(1, (len(text) + 3) // 4)
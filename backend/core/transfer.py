@@ -0,0 +1,229 @@
+"""
+Streaming export and import of chat sessions as JSON Lines.
+
+An export is a header line followed by each session and then its messages,
+one JSON object per line:
+
+    {"kind": "export", "version": 1, "exported_at": "..."}
+    {"kind": "session", "session_key": "...", "user": "alice", ...}
+    {"kind": "message", "session_key": "...", "message_type": "user", ...}
+
+Sessions are read in keyset-paginated chunks and their messages with a
+chunked iterator, so memory use does not depend on the size of the export.
+Imports insert messages with bulk_create in batches, one transaction per
+session, and skip sessions whose key already exists, so an interrupted
+import can simply be run again. Message ids are not carried over; the point
+up to which a session's summary covers its messages is, as a flag on each
+message.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import ChatSession, ChatMessage
+from .cold_storage import session_messages
+import itertools
+import json
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+SESSION_CHUNK_SIZE = 200
+MESSAGE_CHUNK_SIZE = 1000
+IMPORT_BATCH_SIZE = 500
+MAX_CACHED_USERS = 10000
+
+
+class ImportFormatError(ValueError):
+    """Raised for input that is not a chat export"""
+
+
+def filter_sessions(sessions=None, username=None, since=None, until=None, archived=None):
+    """Narrow a session queryset by owner, last update and archived state"""
+    sessions = sessions if sessions is not None else ChatSession.objects.all()
+    if username:
+        sessions = sessions.filter(user__username=username)
+    if since:
+        sessions = sessions.filter(updated_at__gte=since)
+    if until:
+        sessions = sessions.filter(updated_at__lt=until)
+    if archived is not None:
+        sessions = sessions.filter(is_archived=archived)
+    return sessions
+
+
+def _session_record(session):
+    return {
+        'kind': 'session',
+        'session_key': session.session_key,
+        'user': session.user.username if session.user_id else None,
+        'client_id': session.client_id,
+        'title': session.title,
+        'created_at': session.created_at.isoformat(),
+        'updated_at': session.updated_at.isoformat(),
+        'is_active': session.is_active,
+        'is_archived': session.is_archived,
+        'summary': session.summary,
+        'message_count': session.message_count,
+    }
+
+
+def _message_record(session, message):
+    return {
+        'kind': 'message',
+        'session_key': session.session_key,
+        'message_type': message.message_type,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'summarized': bool(session.summary_last_message_id) and message.id <= session.summary_last_message_id,
+    }
+
+
+def export_records(sessions):
+    """Yield the export header and every session and message of a queryset"""
+    yield {'kind': 'export', 'version': FORMAT_VERSION, 'exported_at': timezone.now().isoformat()}
+    sessions = sessions.select_related('user').order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(sessions.filter(id__gt=last_id)[:SESSION_CHUNK_SIZE])
+        if not chunk:
+            return
+        last_id = chunk[-1].id
+
+        # Hot messages of the whole chunk in one ordered pass over the session index
+        hot = ChatMessage.objects.filter(
+            session_id__in=[session.id for session in chunk if not session.is_cold]
+        ).order_by('session_id', 'timestamp', 'id').iterator(chunk_size=MESSAGE_CHUNK_SIZE)
+        groups = itertools.groupby(hot, key=lambda message: message.session_id)
+        group = next(groups, None)
+
+        for session in chunk:
+            yield _session_record(session)
+            if session.is_cold:
+                messages = session_messages(session)
+            elif group is not None and group[0] == session.id:
+                messages, group = group[1], None
+            else:
+                messages = ()
+            for message in messages:
+                yield _message_record(session, message)
+            if group is None:
+                group = next(groups, None)
+
+
+def export_lines(sessions):
+    """Export records as JSON lines"""
+    for record in export_records(sessions):
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def gzip_stream(lines, flush_every=64 * 1024):
+    """Gzip-compress an iterable of text lines into byte chunks of roughly flush_every"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header
+    buffered = 0
+    for line in lines:
+        data = compressor.compress(line.encode())
+        buffered += len(line)
+        if data:
+            yield data
+        if buffered >= flush_every:
+            buffered = 0
+            yield compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+class ChatImporter:
+    """Imports an export stream; sessions that already exist are skipped"""
+
+    def __init__(self, batch_size=None, create_users=False):
+        self.batch_size = batch_size or IMPORT_BATCH_SIZE
+        self.create_users = create_users
+        self.stats = {'sessions': 0, 'messages': 0, 'skipped': 0, 'unknown_users': 0}
+        self._users = {}
+
+    def _user(self, username):
+        if not username:
+            return None
+        if username not in self._users:
+            if len(self._users) >= MAX_CACHED_USERS:
+                self._users.clear()
+            user = User.objects.filter(username=username).first()
+            if user is None and self.create_users:
+                user = User(username=username, is_active=False)
+                user.set_unusable_password()
+                user.save()
+            self._users[username] = user
+        return self._users[username]
+
+    def run(self, lines):
+        records = (json.loads(line) for line in lines if line.strip())
+        try:
+            header = next(records)
+        except (StopIteration, ValueError):
+            raise ImportFormatError("Not a chat export: missing header line")
+        if header.get('kind') != 'export' or header.get('version') != FORMAT_VERSION:
+            raise ImportFormatError(f"Unsupported export header: {header}")
+
+        for session_key, group in itertools.groupby(records, key=lambda record: record.get('session_key')):
+            record = next(group)
+            if record.get('kind') != 'session':
+                raise ImportFormatError(f"Messages of session {session_key} do not follow its session line")
+            self.import_session(record, group)
+        return self.stats
+
+    def import_session(self, record, messages):
+        if ChatSession.objects.filter(session_key=record['session_key']).exists():
+            # Imported by an earlier run (or a clash): resume after it
+            for _ in messages:
+                pass
+            self.stats['skipped'] += 1
+            return
+
+        user = self._user(record['user'])
+        if record['user'] and user is None:
+            self.stats['unknown_users'] += 1
+
+        with transaction.atomic():
+            session = ChatSession.objects.create(
+                session_key=record['session_key'],
+                user=user,
+                client_id=record['client_id'] or '',
+                title=record['title'],
+                is_active=record['is_active'],
+                is_archived=record['is_archived'],
+                summary=record['summary'] or '',
+            )
+            summarized = count = 0
+            for batch in iter(lambda: list(itertools.islice(messages, self.batch_size)), []):
+                rows = [
+                    ChatMessage(
+                        session=session,
+                        message_type=message['message_type'],
+                        content=message['content'],
+                        timestamp=parse_datetime(message['timestamp']),
+                    )
+                    for message in batch
+                ]
+                for row in rows:
+                    row.fill_counts()
+                # bulk_create skips save(), so the counters are added here, in the same transaction
+                ChatMessage.objects.bulk_create(rows)
+                ChatMessage.update_session_counters(rows)
+                summarized += sum(1 for message in batch if message.get('summarized'))
+                count += len(batch)
+
+            changes = {
+                'created_at': parse_datetime(record['created_at']),
+                'updated_at': parse_datetime(record['updated_at']),
+            }
+            if summarized:
+                # Ids are new here: point the summary at the same message as in the source
+                changes['summary_last_message_id'] = session.messages.order_by(
+                    'timestamp', 'id'
+                ).values_list('id', flat=True)[summarized - 1]
+            ChatSession.objects.filter(pk=session.pk).update(**changes)
+
+        self.stats['sessions'] += 1
+        self.stats['messages'] += count
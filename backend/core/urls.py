@@ -6,8 +6,12 @@ app_name = 'core'
 urlpatterns = [
     # New API endpoints
     path('chat/', views.ChatAPIView.as_view(), name='chat-api'),
+    path('chat/stream/', views.ChatStreamAPIView.as_view(), name='chat-stream'),
+    path('chat/async/', views.AsyncChatView.as_view(), name='chat-async'),
     path('chat/new/', views.NewChatAPIView.as_view(), name='new-chat-api'),
     path('chat/history/', views.ChatHistoryAPIView.as_view(), name='chat-history'),
+    path('chat/search/', views.ChatSearchAPIView.as_view(), name='chat-search'),
+    path('chat/transcript/<str:session_key>/', views.TranscriptAPIView.as_view(), name='chat-transcript'),
     path('chat/archive/<str:session_key>/', views.ArchiveSessionAPIView.as_view(), name='archive-session'),
     path('chat/stats/<str:session_key>/', views.SessionStatsAPIView.as_view(), name='session-stats'),
     
@@ -17,5 +21,6 @@ urlpatterns = [
     
     # Utility endpoints
     path('health/', views.health_check, name='health-check'),
+    path('metrics/', views.metrics, name='metrics'),
     path('csrf/', views.get_csrf_token, name='csrf-token'),
 ]
@@ -1,7 +1,13 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from django.views.decorators.http import require_http_methods
+from django.middleware.csrf import CsrfViewMiddleware
 from django.utils.decorators import method_decorator
 from django.views import View
 from rest_framework import status
@@ -13,17 +19,56 @@ import json
 import logging
 
 from .services import AIService, SessionManager
+from .consumers import cancel_generation
+from .locks import TurnLockTimeout
+from .resilience import request_deadline
+from .identity import get_client_id
+from .history_cache import get_history_cache
+from .metrics import render as render_metrics
+from .ratelimit import inflight_generations
+from . import llm
+from .idempotency import idempotent
 from .serializers import ChatRequestSerializer, ChatResponseSerializer, ChatSessionSerializer
 from .models import ChatSession, ChatMessage
+from .pagination import parse_page_size
+from .search import search_messages
+from .sync import session_list_version, session_version, not_modified, add_validators, encode_since, decode_since, owner_sessions
 
 logger = logging.getLogger(__name__)
 
+UNAVAILABLE_RETRY_AFTER = 5  # seconds a client waits before retrying a turn the model could not serve
+SEARCH_MAX_PAGE_SIZE = 50
+SESSION_LIST_LIMIT = 50  # sessions in the sidebar listing
+
+
+def sse_event(event):
+    """Encode a service event as a Server-Sent Events frame"""
+    data = {key: value for key, value in event.items() if key != 'event'}
+    return f"event: {event['event']}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    """Wrap an iterable of service events in a streaming SSE response"""
+    if hasattr(events, '__aiter__'):
+        async def frames():
+            async for event in events:
+                yield sse_event(event)
+        content = frames()
+    else:
+        content = (sse_event(event) for event in events)
+    
+    response = StreamingHttpResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx)
+    return response
+
 
 class ChatAPIView(APIView):
     """
     API view for handling chat interactions
     """
     permission_classes = [AllowAny]
+    stream = False  # Stream the reply as Server-Sent Events
     
     def get(self, request):
         """Get chat history for a session"""
@@ -35,14 +80,68 @@ class ChatAPIView(APIView):
                 "session_key": SessionManager.generate_session_key()
             }, status=status.HTTP_200_OK)
         
+        # Revalidation: answer from the session row alone if nothing changed
+        session = ChatSession.objects.filter(session_key=session_key, is_active=True).first()
+        if session is not None:
+            etag, last_modified, cursor = session_version(session)
+            response = not_modified(request, etag, last_modified)
+            if response is None:
+                response = self.history_response(request, session_key, cursor)
+            if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+                add_validators(response, etag, last_modified)
+            return response
+        
+        return self.history_response(request, session_key, None)
+    
+    def history_response(self, request, session_key, cursor):
         ai_service = AIService()
+        
+        # Delta sync: only the messages after the client's cursor
+        if request.GET.get('since'):
+            try:
+                changes = ai_service.get_session_history_since(
+                    session_key,
+                    request.GET['since'],
+                    page_size=parse_page_size(request.GET.get('page_size'))
+                )
+            except ValueError as e:
+                return Response({
+                    "error": str(e)
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            return Response({
+                **changes,
+                "session_key": session_key
+            }, status=status.HTTP_200_OK)
+        
+        # Keyset pagination when the client asks for a page
+        if any(param in request.GET for param in ('before', 'after', 'page_size')):
+            try:
+                page = ai_service.get_session_history_page(
+                    session_key,
+                    before=request.GET.get('before'),
+                    after=request.GET.get('after'),
+                    page_size=parse_page_size(request.GET.get('page_size'))
+                )
+            except ValueError as e:
+                return Response({
+                    "error": str(e)
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            return Response({
+                **page,
+                "session_key": session_key
+            }, status=status.HTTP_200_OK)
+        
         messages = ai_service.get_session_history(session_key)
         
         return Response({
             "messages": messages,
-            "session_key": session_key
+            "session_key": session_key,
+            "cursor": cursor
         }, status=status.HTTP_200_OK)
     
+    @method_decorator(idempotent('chat'))
     def post(self, request):
         """Send a message to the AI"""
         serializer = ChatRequestSerializer(data=request.data)
@@ -59,16 +158,156 @@ class ChatAPIView(APIView):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         ai_service = AIService()
-        result = ai_service.send_message(
-            user_message=user_message,
-            session_key=session_key,
-            user=request.user if request.user.is_authenticated else None
-        )
+        
+        if self.stream or request.GET.get('stream') in ('1', 'true'):
+            return sse_response(ai_service.stream_message(
+                user_message=user_message,
+                session_key=session_key,
+                user=request.user if request.user.is_authenticated else None,
+                client_id=anonymous_client_id(request, request.user),
+                deadline=request_deadline(request)
+            ))
+        
+        try:
+            result = ai_service.send_message(
+                user_message=user_message,
+                session_key=session_key,
+                user=request.user if request.user.is_authenticated else None,
+                client_id=anonymous_client_id(request, request.user),
+                deadline=request_deadline(request)
+            )
+        except TurnLockTimeout as e:
+            return session_busy_response(e)
         
         if result['success']:
             return Response(result, status=status.HTTP_200_OK)
         else:
-            return Response(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return chat_failure_response(result)
+
+
+class ChatStreamAPIView(ChatAPIView):
+    """
+    API view for streaming AI responses as Server-Sent Events
+    """
+    http_method_names = ['post', 'options']
+    stream = True
+
+
+def anonymous_client_id(request, user):
+    """Client id to record on new sessions; logged-in users are identified by their account"""
+    return '' if user.is_authenticated else get_client_id(request)
+
+
+def session_busy_response(error, response_class=Response):
+    """409 telling the client another turn on this session is still running"""
+    response = response_class({
+        "error": str(error),
+        "success": False
+    }, status=status.HTTP_409_CONFLICT)
+    response['Retry-After'] = '1'
+    return response
+
+
+def chat_failure_response(result, response_class=Response):
+    """500 for a failed turn, or 503 with Retry-After when the model was unavailable"""
+    if not result.get('unavailable'):
+        return response_class(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    response = response_class(result, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(UNAVAILABLE_RETRY_AFTER)
+    return response
+
+
+def csrf_failure_response(request):
+    """Run Django's CSRF check, returning the rejection response if it fails"""
+    check = CsrfViewMiddleware(lambda req: None)
+    check.process_request(request)
+    return check.process_view(request, None, (), {})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatView(View):
+    """
+    Async view for chat interactions, served without holding a worker thread
+    when the app runs under ASGI (backend/asgi.py)
+    """
+    
+    async def post(self, request):
+        """Send a message to the AI"""
+        user = await request.auser()
+        
+        # Match DRF's SessionAuthentication: only enforce CSRF for logged-in users
+        if user.is_authenticated:
+            rejection = csrf_failure_response(request)
+            if rejection is not None:
+                return rejection
+        
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body)
+            except json.JSONDecodeError:
+                return JsonResponse({
+                    "error": "Invalid JSON"
+                }, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            data = request.POST
+        
+        serializer = ChatRequestSerializer(data=data)
+        
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        user_message = serializer.validated_data['message']
+        session_key = serializer.validated_data.get('session_key') or SessionManager.generate_session_key()
+        
+        if not user_message.strip():
+            return JsonResponse({
+                "error": "Message cannot be empty"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        ai_service = AIService()
+        
+        if request.GET.get('stream') in ('1', 'true'):
+            return sse_response(ai_service.astream_message(
+                user_message=user_message,
+                session_key=session_key,
+                user=user if user.is_authenticated else None,
+                client_id=anonymous_client_id(request, user),
+                deadline=request_deadline(request)
+            ))
+        
+        try:
+            result = await ai_service.asend_message(
+                user_message=user_message,
+                session_key=session_key,
+                user=user if user.is_authenticated else None,
+                client_id=anonymous_client_id(request, user),
+                deadline=request_deadline(request)
+            )
+        except TurnLockTimeout as e:
+            return session_busy_response(e, JsonResponse)
+        
+        if result['success']:
+            return JsonResponse(result, status=status.HTTP_200_OK)
+        else:
+            return chat_failure_response(result, JsonResponse)
+
+
+class TranscriptAPIView(APIView):
+    """
+    API view for streaming a session's full transcript as NDJSON
+    """
+    permission_classes = [AllowAny]
+    
+    def get(self, request, session_key):
+        """Stream every message of a session, one JSON object per line"""
+        if not ChatSession.objects.filter(session_key=session_key, is_active=True).exists():
+            return Response({
+                "error": "Session not found"
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        ai_service = AIService()
+        lines = (json.dumps(message) + "\n" for message in ai_service.iter_session_history(session_key))
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
 
 
 class NewChatAPIView(APIView):
@@ -84,6 +323,8 @@ class NewChatAPIView(APIView):
         if session_key:
             ai_service = AIService()
             ai_service.clear_session(session_key)
+            # The old chat's reply is no longer wanted: stop paying for it
+            cancel_generation(session_key)
         
         new_session_key = SessionManager.generate_session_key()
         
@@ -101,36 +342,74 @@ class ChatHistoryAPIView(APIView):
     permission_classes = [AllowAny]
     
     def get(self, request):
-        """Get all chat sessions for a user"""
-        # For now, we'll use session-based identification
-        # In production, you'd want proper user authentication
-        user_id = request.session.get('user_id')
-        if not user_id:
-            # Create a temporary user ID for session tracking
-            import uuid
-            user_id = str(uuid.uuid4())
-            request.session['user_id'] = user_id
+        """Get the chat sessions of the logged-in user or anonymous client"""
+        # Anonymous clients are identified by a signed token rather than a
+        # server-side session, so this poll never touches django_session
+        if request.user.is_authenticated:
+            user, client_id = request.user, None
+        else:
+            user, client_id = None, get_client_id(request)
+        
+        # Most polls change nothing: one aggregate query, then 304
+        etag, last_modified = session_list_version(user, client_id)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return add_validators(response, etag, last_modified)
+        
+        try:
+            since = decode_since(request.GET['since']) if request.GET.get('since') else None
+        except ValueError as e:
+            return Response({
+                "error": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
         
         ai_service = AIService()
-        # For now, get sessions without user authentication
-        # In production, pass the actual user object
-        sessions = ChatSession.objects.filter(
-            is_active=True
-        ).order_by('-updated_at')[:50]  # Limit to 50 most recent
-        
-        session_list = [{
-            'session_key': session.session_key,
-            'title': session.get_title(),
-            'created_at': session.created_at.isoformat(),
-            'updated_at': session.updated_at.isoformat(),
-            'is_archived': session.is_archived,
-            'message_count': session.messages.count()
-        } for session in sessions]
+        body = {
+            'user_id': str(request.user.pk) if user is not None else client_id,
+            'cursor': encode_since(last_modified) if last_modified else None,
+            'delta': False
+        }
+        changes = None
+        if since is not None:
+            changes = ai_service.get_session_changes(owner_sessions(user, client_id), since, limit=SESSION_LIST_LIMIT)
+        if changes is not None:
+            body.update(changes, delta=True)
+        elif user is not None:
+            body['sessions'] = ai_service.get_user_sessions(user, limit=SESSION_LIST_LIMIT)
+        else:
+            body['sessions'] = ai_service.get_client_sessions(client_id, limit=SESSION_LIST_LIMIT)
         
-        return Response({
-            'sessions': session_list,
-            'user_id': user_id
-        }, status=status.HTTP_200_OK)
+        return add_validators(Response(body, status=status.HTTP_200_OK), etag, last_modified)
+
+
+class ChatSearchAPIView(APIView):
+    """
+    API view for searching the caller's chat transcripts
+    """
+    permission_classes = [AllowAny]
+    
+    def get(self, request):
+        """Search the messages of the logged-in user's or anonymous client's sessions"""
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response({
+                "error": "Search query (q) is required"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page = int(request.GET.get('page') or 1)
+            if page < 1:
+                raise ValueError("page must be positive")
+            page_size = min(parse_page_size(request.GET.get('page_size')), SEARCH_MAX_PAGE_SIZE)
+        except ValueError as e:
+            return Response({
+                "error": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if request.user.is_authenticated:
+            found = search_messages(query, user=request.user, page=page, page_size=page_size)
+        else:
+            found = search_messages(query, client_id=get_client_id(request), page=page, page_size=page_size)
+        return Response({'query': query, **found}, status=status.HTTP_200_OK)
 
 
 class ArchiveSessionAPIView(APIView):
@@ -189,6 +468,7 @@ class SessionStatsAPIView(APIView):
 @ensure_csrf_cookie
 @api_view(['GET', 'POST'])
 @permission_classes([AllowAny])
+@idempotent('talk')
 def talk(request):
     """
     Legacy talk endpoint - redirects to new API structure
@@ -229,11 +509,16 @@ def talk(request):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         ai_service = AIService()
-        result = ai_service.send_message(
-            user_message=user_message,
-            session_key=session_key,
-            user=request.user if request.user.is_authenticated else None
-        )
+        try:
+            result = ai_service.send_message(
+                user_message=user_message,
+                session_key=session_key,
+                user=request.user if request.user.is_authenticated else None,
+                client_id=anonymous_client_id(request, request.user),
+                deadline=request_deadline(request)
+            )
+        except TurnLockTimeout as e:
+            return session_busy_response(e)
         
         return Response(result)
 
@@ -250,6 +535,7 @@ def new_chat(request):
     if session_key:
         ai_service = AIService()
         ai_service.clear_session(session_key)
+        cancel_generation(session_key)
     
     new_session_key = SessionManager.generate_session_key()
     
@@ -267,11 +553,51 @@ def health_check(request):
     """
     Health check endpoint for monitoring
     """
+    checks = {}
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        checks["database"] = "ok"
+    except Exception as e:
+        logger.error(f"Health check: database unavailable: {str(e)}")
+        checks["database"] = "unavailable"
+    try:
+        cache.set('core:health', 1, 10)
+        checks["cache"] = "ok" if cache.get('core:health') == 1 else "unavailable"
+    except Exception as e:
+        logger.warning(f"Health check: cache unavailable: {str(e)}")
+        checks["cache"] = "unavailable"
+    
+    client = llm._client
+    circuits = {
+        name: breaker.state for name, breaker in client.resilience.breakers().items()
+    } if client is not None else {}
+    
+    # Only the database is fatal; the cache and the model degrade gracefully
+    healthy = checks["database"] == "ok"
+    degraded = checks["cache"] != "ok" or any(state != 'closed' for state in circuits.values())
+    history_cache = get_history_cache()
     return Response({
-        "status": "healthy",
+        "status": "unhealthy" if not healthy else "degraded" if degraded else "healthy",
         "service": "AI Chat Backend",
-        "timestamp": "2025-08-03T00:00:00Z"
-    })
+        "timestamp": timezone.now().isoformat(),
+        "checks": checks,
+        "circuits": circuits,
+        "inflight_generations": inflight_generations(),
+        "history_cache": history_cache.stats() if history_cache else None
+    }, status=status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+# Metrics endpoint
+@require_http_methods(['GET'])
+def metrics(request):
+    """
+    Prometheus metrics of this process (see core/metrics.py)
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 # CSRF token endpoint
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from 'react';
+import { useState, useEffect, useCallback, useRef } from 'react';
 import { apiService } from '../services/api';
 
 interface ChatSession {
@@ -14,14 +14,28 @@ export const useChatSessions = () => {
   const [sessions, setSessions] = useState<ChatSession[]>([]);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState<string | null>(null);
+  const cursor = useRef<string | null>(null);
 
   const loadSessions = useCallback(async () => {
     setIsLoading(true);
     setError(null);
     
     try {
-      const response = await apiService.getChatSessions();
-      setSessions(response.sessions);
+      const response = await apiService.getChatSessions(cursor.current);
+      if (response.delta) {
+        // Merge the changed sessions into the list we already have
+        const changed = new Set([
+          ...response.sessions.map(session => session.session_key),
+          ...(response.removed ?? []),
+        ]);
+        setSessions(prev => [
+          ...response.sessions,
+          ...prev.filter(session => !changed.has(session.session_key)),
+        ].sort((a, b) => b.updated_at.localeCompare(a.updated_at)));
+      } else {
+        setSessions(response.sessions);
+      }
+      cursor.current = response.cursor ?? null;
     } catch (err) {
       console.error('Failed to load chat sessions:', err);
       setError('Failed to load chat sessions');
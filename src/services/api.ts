@@ -35,6 +35,9 @@ interface ChatSession {
 interface ChatHistoryResponse {
   sessions: ChatSession[];
   user_id: string;
+  cursor?: string | null;
+  delta?: boolean;
+  removed?: string[];
 }
 
 class ApiService {
@@ -46,9 +49,11 @@ class ApiService {
     this.baseUrl = 'http://127.0.0.1:8000';
   }
 
-  async getChatSessions(): Promise<ChatHistoryResponse> {
+  async getChatSessions(since?: string | null): Promise<ChatHistoryResponse> {
     try {
-      const response = await fetch(`${this.baseUrl}/api/chat/history/`, {
+      // With a cursor only the sessions changed since are returned
+      const query = since ? `?since=${encodeURIComponent(since)}` : '';
+      const response = await fetch(`${this.baseUrl}/api/chat/history/${query}`, {
         method: 'GET',
         credentials: 'include',
       });
@@ -121,14 +126,33 @@ class ApiService {
         session_key: this.sessionKey
       };
       
-      const response = await fetch(`${this.baseUrl}/api/chat/`, {
+      // Retries of the same message reuse its key, so the backend replays
+      // the stored reply instead of generating (and billing) a new one
+      const idempotencyKey = crypto.randomUUID();
+      const request = () => fetch(`${this.baseUrl}/api/chat/`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Idempotency-Key': idempotencyKey,
         },
         credentials: 'include',
         body: JSON.stringify(requestBody),
       });
+      
+      let response: Response;
+      try {
+        response = await request();
+      } catch (networkError) {
+        console.warn('Retrying message after network error:', networkError);
+        response = await request();
+      }
+      
+      // Original still in progress on the server: wait for its result
+      if (response.status === 409) {
+        const retryAfter = Number(response.headers.get('Retry-After') || 1);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        response = await request();
+      }
 
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);